@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+# Token buckets limiting ingest requests per API key and per collector. A
+# collector is identified only by its X-Computer-Name header: the client
+# address is shared by every machine behind a NAT or relay, so it would
+# throttle a whole site as one collector. Collectors that do not send the
+# header only count against their API key.
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() in ("1", "true", "yes")
+ADMISSION_KEY_RATE = float(os.getenv("ADMISSION_KEY_RATE", "500"))  # requests/sec
+ADMISSION_KEY_BURST = float(os.getenv("ADMISSION_KEY_BURST", "1000"))
+ADMISSION_CLIENT_ENABLED = os.getenv("ADMISSION_CLIENT_ENABLED", "true").lower() in ("1", "true", "yes")
+ADMISSION_CLIENT_RATE = float(os.getenv("ADMISSION_CLIENT_RATE", "1"))
+ADMISSION_CLIENT_BURST = float(os.getenv("ADMISSION_CLIENT_BURST", "20"))
+ADMISSION_MAX_BUCKETS = int(os.getenv("ADMISSION_MAX_BUCKETS", "100000"))
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, rate: float, burst: float, now: float):
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+
+class BucketSet:
+    """Token buckets for one scope (API key or collector), bounded as an LRU."""
+
+    def __init__(self, rate: float, burst: float, max_entries: int = ADMISSION_MAX_BUCKETS):
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = max_entries
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self.admitted = 0
+        self.rejected = 0
+
+    def get(self, key: str, now: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.burst, now)
+            if len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket.refill(self.rate, self.burst, now)
+        return bucket
+
+    def wait_time(self, bucket: TokenBucket) -> float:
+        return 0.0 if bucket.tokens >= 1 else (1 - bucket.tokens) / self.rate
+
+    def snapshot(self, limit: int) -> dict:
+        now = time.monotonic()
+        recent = list(self._buckets.items())[-limit:]
+        return {
+            "rate_per_sec": self.rate,
+            "burst": self.burst,
+            "tracked": len(self._buckets),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "buckets": [
+                {"id": key, "tokens": round(min(self.burst, b.tokens + (now - b.updated) * self.rate), 2)}
+                for key, b in reversed(recent)
+            ],
+        }
+
+
+def key_label(api_key: str) -> str:
+    """Stable, non-reversible label for an API key in operator output."""
+    return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:12]
+
+
+class AdmissionController:
+    def __init__(self):
+        self.keys = BucketSet(ADMISSION_KEY_RATE, ADMISSION_KEY_BURST)
+        self.clients = BucketSet(ADMISSION_CLIENT_RATE, ADMISSION_CLIENT_BURST)
+
+    def admit(self, api_key: str, client_id: Optional[str]) -> Optional[float]:
+        """Take a token from the key's and the collector's bucket, or return the seconds to wait.
+
+        Tokens are only consumed when both the key and the collector have
+        one, so a throttled collector does not drain the shared key budget.
+        Requests without a *client_id*, or with per-collector admission
+        disabled, only use the key's bucket.
+        """
+        if not ADMISSION_ENABLED:
+            return None
+        now = time.monotonic()
+        key_bucket = self.keys.get(key_label(api_key), now)
+        client_bucket = self.clients.get(client_id, now) if ADMISSION_CLIENT_ENABLED and client_id else None
+        wait = self.keys.wait_time(key_bucket)
+        if client_bucket is not None:
+            wait = max(wait, self.clients.wait_time(client_bucket))
+        if wait > 0:
+            scope = self.keys if key_bucket.tokens < 1 else self.clients
+            scope.rejected += 1
+            return wait
+        key_bucket.tokens -= 1
+        self.keys.admitted += 1
+        if client_bucket is not None:
+            client_bucket.tokens -= 1
+            self.clients.admitted += 1
+        return None
+
+    def snapshot(self, limit: int = 100) -> dict:
+        return {
+            "enabled": ADMISSION_ENABLED,
+            "api_keys": self.keys.snapshot(limit),
+            "collectors": dict(self.clients.snapshot(limit), enabled=ADMISSION_CLIENT_ENABLED),
+        }
+
+
+admission = AdmissionController()
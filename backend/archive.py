@@ -0,0 +1,411 @@
+from __future__ import annotations
+
+import asyncio
+import gzip
+import json
+import os
+import re
+import threading
+import time
+from datetime import date, datetime
+from typing import Callable, Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import text
+
+from .crud import subtract_user_rollups
+from .database import engine
+from .responsecache import response_cache
+from .partitions import (
+    DEFAULT_PARTITION, VISIT_PARTITION_CHECK_SECONDS, VISIT_RETENTION_MONTHS, add_months, current_month,
+    drop_partition, expire_rollups, is_partitioned, month_partitions, month_start, try_partition_lock,
+)
+from .rollups import ROLLUP_TIMEZONE
+
+# Month partitions older than VISIT_ARCHIVE_AFTER_MONTHS whole months are
+# moved out of Postgres into gzipped NDJSON files, one per homegroup and
+# month, listed in manifest.json. 0 disables archiving. Archived months
+# leave the rollups like dropped ones do; VISIT_RETENTION_MONTHS also
+# deletes archive files.
+VISIT_ARCHIVE_AFTER_MONTHS = int(os.getenv("VISIT_ARCHIVE_AFTER_MONTHS", "0"))
+VISIT_ARCHIVE_DIR = os.getenv(
+    "VISIT_ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "archive")
+)
+VISIT_ARCHIVE_FETCH_ROWS = int(os.getenv("VISIT_ARCHIVE_FETCH_ROWS", "5000"))
+
+MANIFEST = "manifest.json"
+
+# One batch of rows of a visits partition, in id order, with the owner's
+# homegroup. Batches are keyed on id: a server-side cursor left open would
+# keep the partition from being dropped in the same transaction.
+_ARCHIVE_ROWS = """
+SELECT v.id, usr.username, coalesce(usr.homegroup, '') AS homegroup, v.visit_time,
+       coalesce(v.url, u.url) AS url, coalesce(v.title, t.title) AS title, v.computer_name, v.domain
+FROM {source} v
+JOIN users usr ON usr.id = v.user_id
+LEFT JOIN visit_urls u ON u.id = v.url_id
+LEFT JOIN visit_titles t ON t.id = v.title_id
+WHERE v.id > :after AND v.visit_time < :before
+ORDER BY v.id
+LIMIT :limit
+"""
+
+_SAFE_NAME = re.compile(r"[^A-Za-z0-9._-]")
+
+
+def month_of(visit_time: datetime) -> str:
+    """Archive month (in ROLLUP_TIMEZONE, like the partitions) of a visit time."""
+    return f"{visit_time.astimezone(ZoneInfo(ROLLUP_TIMEZONE)):%Y-%m}"
+
+
+class ArchivedVisit:
+    """An archived visit, shaped like the rows of reports_user's query."""
+
+    __slots__ = ("id", "visit_time", "title", "url", "computer_name")
+
+    def __init__(self, record: dict):
+        self.id = record["id"]
+        self.visit_time = datetime.fromisoformat(record["timestamp"])
+        self.title = record["title"]
+        self.url = record["url"]
+        self.computer_name = record["computerName"]
+
+
+def visit_filter(
+    q: Optional[str], url: Optional[str], title: Optional[str], computer: Optional[str]
+) -> Callable[[ArchivedVisit], bool]:
+    """The reports_user filters (case-insensitive substrings, exact computer) for archived visits."""
+
+    def contains(value: Optional[str], part: str) -> bool:
+        return value is not None and part.lower() in value.lower()
+
+    def match(v: ArchivedVisit) -> bool:
+        return (
+            (not q or contains(v.url, q) or contains(v.title, q))
+            and (not url or contains(v.url, url))
+            and (not title or contains(v.title, title))
+            and (not computer or v.computer_name == computer)
+        )
+
+    return match
+
+
+class ArchiveWriter:
+    """Gzipped NDJSON files of one archive run, one per homegroup and month.
+
+    Encoding and compression are CPU-bound, so the archiver calls
+    write_rows and finish in a worker thread. A cancelled archive run
+    aborts while such a thread may still be writing, hence the lock.
+    """
+
+    def __init__(self, directory: str, tag: str):
+        self.directory = directory
+        self.tag = tag
+        self._files: Dict[Tuple[str, str], dict] = {}
+        self._lock = threading.Lock()
+        self._aborted = False
+
+    def write(self, month: str, row):
+        key = (month, row.homegroup)
+        entry = self._files.get(key)
+        if entry is None:
+            name = f"{_SAFE_NAME.sub('_', row.homegroup) or '_'}-{self.tag}.ndjson.gz"
+            path = os.path.join(month, name)
+            os.makedirs(os.path.join(self.directory, month), exist_ok=True)
+            entry = self._files[key] = {
+                "month": month, "homegroup": row.homegroup, "path": path, "visits": 0,
+                "users": set(), "first": row.visit_time, "last": row.visit_time,
+                "stream": gzip.open(os.path.join(self.directory, path + ".tmp"), "wt", encoding="utf-8"),
+            }
+        entry["stream"].write(json.dumps({
+            "id": row.id,
+            "username": row.username,
+            "timestamp": row.visit_time.isoformat(),
+            "url": row.url,
+            "title": row.title,
+            "computerName": row.computer_name,
+            "domain": row.domain,
+        }, ensure_ascii=False) + "\n")
+        entry["visits"] += 1
+        entry["users"].add(row.username)
+        entry["first"] = min(entry["first"], row.visit_time)
+        entry["last"] = max(entry["last"], row.visit_time)
+
+    def write_rows(self, rows):
+        with self._lock:
+            if self._aborted:
+                return
+            for row in rows:
+                self.write(month_of(row.visit_time), row)
+
+    def finish(self) -> List[dict]:
+        """Close and publish the files; returns their manifest entries."""
+        entries = []
+        for entry in self._files.values():
+            entry.pop("stream").close()
+            os.replace(os.path.join(self.directory, entry["path"] + ".tmp"), os.path.join(self.directory, entry["path"]))
+            entry.update(users=sorted(entry["users"]), first=entry["first"].isoformat(), last=entry["last"].isoformat())
+            entries.append(entry)
+        return entries
+
+    def abort(self):
+        with self._lock:
+            self._aborted = True
+            for entry in self._files.values():
+                entry["stream"].close()
+                os.remove(os.path.join(self.directory, entry["path"] + ".tmp"))
+
+
+class VisitArchive:
+    """The manifest of archived visit files and reads from them.
+
+    Every server process archives and reads, so the cached manifest is
+    only reused while the file's mtime is unchanged, and changes to it
+    re-read the file while holding the partition lock.
+    """
+
+    def __init__(self, directory: str = VISIT_ARCHIVE_DIR):
+        self.directory = directory
+        self._manifest: Optional[dict] = None
+        self._mtime: Optional[int] = None
+
+    def manifest(self, reload: bool = False) -> dict:
+        path = os.path.join(self.directory, MANIFEST)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if reload or self._manifest is None or mtime != self._mtime:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self._manifest = json.load(f)
+            except FileNotFoundError:
+                self._manifest = {"files": []}
+            self._mtime = mtime
+        return self._manifest
+
+    def save_manifest(self, files: List[dict]):
+        manifest = {"files": sorted(files, key=lambda f: (f["month"], f["homegroup"], f["path"]))}
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(path + ".tmp", path)
+        self._manifest = manifest
+        self._mtime = os.stat(path).st_mtime_ns
+
+    def add(self, entries: List[dict]):
+        """List *entries* in the manifest; call while holding the partition lock."""
+        # A month whose transaction failed after its files were listed is
+        # archived again into the same paths
+        paths = {e["path"] for e in entries}
+        self.save_manifest([f for f in self.manifest(reload=True)["files"] if f["path"] not in paths] + entries)
+
+    def remove_files(self, entries: List[dict]):
+        for f in entries:
+            try:
+                os.remove(os.path.join(self.directory, f["path"]))
+            except FileNotFoundError:
+                pass
+
+    def newest(self) -> Optional[datetime]:
+        files = self.manifest()["files"]
+        return max(datetime.fromisoformat(f["last"]) for f in files) if files else None
+
+    def expire(self, cutoff_month: date) -> int:
+        """Delete the files of months before *cutoff_month*; call while holding the partition lock."""
+        cutoff = f"{cutoff_month:%Y-%m}"
+        files = self.manifest(reload=True)["files"]
+        expired = [f for f in files if f["month"] < cutoff]
+        if not expired:
+            return 0
+        self.save_manifest([f for f in files if f["month"] >= cutoff])
+        self.remove_files(expired)
+        return len(expired)
+
+    def user_visits(
+        self,
+        username: str,
+        before: Optional[Tuple[datetime, int]],
+        since: Optional[datetime],
+        limit: Optional[int],
+        match: Callable[[ArchivedVisit], bool] = lambda v: True,
+    ) -> List[ArchivedVisit]:
+        """Up to *limit* (None: all) archived visits of *username*, newest first.
+
+        Keyset pagination matches reports_user: only visits ordered before
+        the (visit_time, id) pair *before* are returned. Months are read
+        newest first and reading stops once a month completes the page.
+        """
+        by_month: Dict[str, List[dict]] = {}
+        for f in self.manifest()["files"]:
+            if username in f["users"]:
+                by_month.setdefault(f["month"], []).append(f)
+
+        found: Dict[int, ArchivedVisit] = {}
+        for month in sorted(by_month, reverse=True):
+            files = by_month[month]
+            if since and all(datetime.fromisoformat(f["last"]) < since for f in files):
+                break
+            if before and all(datetime.fromisoformat(f["first"]) > before[0] for f in files):
+                continue
+            for f in files:
+                with gzip.open(os.path.join(self.directory, f["path"]), "rt", encoding="utf-8") as stream:
+                    for line in stream:
+                        record = json.loads(line)
+                        if record["username"] != username:
+                            continue
+                        visit = ArchivedVisit(record)
+                        if since and visit.visit_time < since:
+                            continue
+                        if before and (visit.visit_time, visit.id) >= before:
+                            continue
+                        if match(visit):
+                            found[visit.id] = visit  # a retried run may have archived a row twice
+            if limit is not None and len(found) >= limit:
+                break
+        return sorted(found.values(), key=lambda v: (v.visit_time, v.id), reverse=True)[:limit]
+
+
+visit_archive = VisitArchive()
+
+
+class VisitArchiver:
+    """Background task moving old visit months from Postgres into the archive."""
+
+    def __init__(self, archive: VisitArchive = visit_archive):
+        self.archive = archive
+        self._task: Optional[asyncio.Task] = None
+        self.months = 0
+        self.visits = 0
+        self.expired_files = 0
+        self.seconds = 0.0
+        self.last_error: Optional[str] = None
+
+    async def _export(self, conn, source: str, tag: str, before: datetime) -> List[dict]:
+        """Write the visits of *source* before *before* to archive files, after locking it against writes."""
+        await conn.execute(text(f"LOCK TABLE {source} IN SHARE MODE"))
+        writer = ArchiveWriter(self.archive.directory, tag)
+        query = text(_ARCHIVE_ROWS.format(source=source))
+        after = 0
+        try:
+            while True:
+                rows = (await conn.execute(
+                    query, {"after": after, "before": before, "limit": VISIT_ARCHIVE_FETCH_ROWS}
+                )).all()
+                # Off the event loop, so requests on this worker keep being served
+                await asyncio.to_thread(writer.write_rows, rows)
+                if len(rows) < VISIT_ARCHIVE_FETCH_ROWS:
+                    break
+                after = rows[-1].id
+        except BaseException:
+            writer.abort()
+            raise
+        return await asyncio.to_thread(writer.finish)
+
+    async def archive_month(self, conn, month: date, name: str) -> int:
+        """Write partition *name* to the archive and drop it, within *conn*'s transaction.
+
+        The partition is locked against writes first, so no visit can land
+        in it between being read and being dropped.
+        """
+        before = month_start(add_months(month, 1))
+        entries = await self._export(conn, name, name, before)
+        try:
+            await subtract_user_rollups(conn, [name], before)
+            await drop_partition(conn, name)
+        except BaseException:
+            self.archive.remove_files(entries)
+            raise
+        self.archive.add(entries)
+        return sum(e["visits"] for e in entries)
+
+    async def archive_expired(self, after_months: int = VISIT_ARCHIVE_AFTER_MONTHS) -> int:
+        """Archive every month partition older than *after_months* whole months.
+
+        Visits dated in those months that arrived later (and so sit in the
+        default partition) are archived as well.
+        """
+        started = time.perf_counter()
+        cutoff_month = add_months(current_month(), -after_months)
+        archived = 0
+        async with engine.begin() as conn:
+            if not await is_partitioned(conn) or not await try_partition_lock(conn):
+                return 0
+            months = sorted((m, n) for m, n in (await month_partitions(conn)).items() if m < cutoff_month)
+        for month, name in months:
+            async with engine.begin() as conn:
+                if not await try_partition_lock(conn):
+                    return archived
+                count = await self.archive_month(conn, month, name)
+                await expire_rollups(conn, add_months(month, 1))
+            archived += count
+            self.months += 1
+            print(f"✅ Archived {count} visits of {month:%Y-%m} ({name})")
+
+        async with engine.begin() as conn:
+            if not await try_partition_lock(conn):
+                return archived
+            cutoff = month_start(cutoff_month)
+            entries = await self._export(conn, DEFAULT_PARTITION, f"late-{int(time.time())}", cutoff)
+            if entries:
+                await subtract_user_rollups(conn, [DEFAULT_PARTITION], cutoff)
+                await conn.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE visit_time < :cutoff"), {"cutoff": cutoff})
+                self.archive.add(entries)
+                archived += sum(e["visits"] for e in entries)
+                await expire_rollups(conn, cutoff_month)
+
+        if archived:
+            # Cached pages without include_archived still list the moved visits
+            response_cache.clear()
+        self.visits += archived
+        self.seconds += time.perf_counter() - started
+        return archived
+
+    async def run_once(self):
+        if VISIT_ARCHIVE_AFTER_MONTHS > 0:
+            await self.archive_expired()
+        if VISIT_RETENTION_MONTHS > 0:
+            async with engine.begin() as conn:
+                if await try_partition_lock(conn):
+                    self.expired_files += self.archive.expire(add_months(current_month(), -VISIT_RETENTION_MONTHS))
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"⚠️  Visit archiving failed: {e}")
+            await asyncio.sleep(VISIT_PARTITION_CHECK_SECONDS)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def snapshot(self) -> dict:
+        files = self.archive.manifest()["files"]
+        return {
+            "after_months": VISIT_ARCHIVE_AFTER_MONTHS,
+            "directory": self.archive.directory,
+            "files": len(files),
+            "archived_visits": sum(f["visits"] for f in files),
+            "months_archived": self.months,
+            "visits_archived": self.visits,
+            "expired_files": self.expired_files,
+            "seconds": round(self.seconds, 6),
+            "last_error": self.last_error,
+        }
+
+
+visit_archiver = VisitArchiver()
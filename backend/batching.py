@@ -0,0 +1,219 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from collections import deque
+from typing import List, Optional
+
+from .database import AsyncSessionLocal
+from .ingest import ingest_reports_isolated
+from .schemas import ReportIn
+
+# Reports arriving within this window are written together in one transaction.
+INGEST_BATCH_ENABLED = os.getenv("INGEST_BATCH_ENABLED", "true").lower() in ("1", "true", "yes")
+INGEST_BATCH_WINDOW_MS = float(os.getenv("INGEST_BATCH_WINDOW_MS", "20"))
+INGEST_BATCH_MAX_REPORTS = int(os.getenv("INGEST_BATCH_MAX_REPORTS", "200"))
+INGEST_BATCH_MAX_VISITS = int(os.getenv("INGEST_BATCH_MAX_VISITS", "20000"))
+# Backpressure: queued reports beyond this make submitters wait, and a wait
+# longer than the timeout is rejected so the collector retries later.
+INGEST_QUEUE_MAX_REPORTS = int(os.getenv("INGEST_QUEUE_MAX_REPORTS", "2000"))
+INGEST_QUEUE_TIMEOUT_SECONDS = float(os.getenv("INGEST_QUEUE_TIMEOUT_SECONDS", "5"))
+# On shutdown, how long queued reports may take to be written before the rest fail
+INGEST_BATCH_STOP_TIMEOUT_SECONDS = float(os.getenv("INGEST_BATCH_STOP_TIMEOUT_SECONDS", "30"))
+
+
+class IngestOverloaded(Exception):
+    """Raised when the batch queue stays full for longer than the timeout."""
+
+
+class IngestStopped(IngestOverloaded):
+    """Raised for reports submitted to, or left unwritten by, a stopping batcher."""
+
+
+# Queued by stop(): reports ahead of it are still written
+_STOP = object()
+
+
+class _Pending:
+    __slots__ = ("report", "future", "enqueued_at")
+
+    def __init__(self, report: ReportIn, future: asyncio.Future):
+        self.report = report
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+
+
+class BatchStats:
+    """Per-batch size and latency statistics."""
+
+    def __init__(self, recent: int = 256):
+        self.batches = 0
+        self.reports = 0
+        self.visits = 0
+        self.failed_batches = 0
+        self.rejected_reports = 0
+        self.max_batch_reports = 0
+        self.max_flush_seconds = 0.0
+        self._flush_seconds: deque = deque(maxlen=recent)
+        self._queue_wait_seconds: deque = deque(maxlen=recent)
+        self._batch_reports: deque = deque(maxlen=recent)
+
+    def record(self, reports: int, visits: int, flush_seconds: float, queue_wait_seconds: float):
+        self.batches += 1
+        self.reports += reports
+        self.visits += visits
+        self.max_batch_reports = max(self.max_batch_reports, reports)
+        self.max_flush_seconds = max(self.max_flush_seconds, flush_seconds)
+        self._flush_seconds.append(flush_seconds)
+        self._queue_wait_seconds.append(queue_wait_seconds)
+        self._batch_reports.append(reports)
+
+    @staticmethod
+    def _percentile(values, pct: float) -> Optional[float]:
+        if not values:
+            return None
+        ordered = sorted(values)
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct))], 6)
+
+    def snapshot(self) -> dict:
+        return {
+            "batches": self.batches,
+            "reports": self.reports,
+            "visits": self.visits,
+            "failed_batches": self.failed_batches,
+            "rejected_reports": self.rejected_reports,
+            "avg_batch_reports": round(self.reports / self.batches, 2) if self.batches else None,
+            "max_batch_reports": self.max_batch_reports,
+            "recent_batch_reports_p50": self._percentile(self._batch_reports, 0.5),
+            "flush_seconds_p50": self._percentile(self._flush_seconds, 0.5),
+            "flush_seconds_p95": self._percentile(self._flush_seconds, 0.95),
+            "flush_seconds_max": round(self.max_flush_seconds, 6),
+            "queue_wait_seconds_p50": self._percentile(self._queue_wait_seconds, 0.5),
+            "queue_wait_seconds_p95": self._percentile(self._queue_wait_seconds, 0.95),
+        }
+
+
+class IngestBatcher:
+    """Coalesces reports from concurrent requests into shared transactions.
+
+    ``submit`` enqueues a report and resolves once the batch containing it
+    has been committed, so a successful response still means the data is
+    durable.
+    """
+
+    def __init__(self, session_factory=AsyncSessionLocal):
+        self.session_factory = session_factory
+        self.stats = BatchStats()
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        # The batch being collected or written, failed if the task is cancelled
+        self._batch: List[_Pending] = []
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=INGEST_QUEUE_MAX_REPORTS)
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop accepting work and write everything already queued.
+
+        The batch task drains the queue and exits on its own. Only if that
+        takes longer than INGEST_BATCH_STOP_TIMEOUT_SECONDS is it cancelled;
+        the reports it had not written then fail with IngestStopped, so no
+        request is left waiting.
+        """
+        if self._task is None:
+            return
+        self._stopping = True
+        await self._queue.put(_STOP)
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), INGEST_BATCH_STOP_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            print("⚠️  Ingest batcher did not drain in time; failing the reports still queued")
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._fail_pending()
+
+    def _fail_pending(self):
+        pending = list(self._batch)
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not _STOP:
+                pending.append(item)
+        self._batch = []
+        for item in pending:
+            if not item.future.done():
+                item.future.set_exception(IngestStopped())
+
+    async def submit(self, report: ReportIn):
+        if self._task is None:
+            raise RuntimeError("Ingest batcher is not running")
+        if self._stopping:
+            raise IngestStopped()
+        pending = _Pending(report, asyncio.get_running_loop().create_future())
+        try:
+            await asyncio.wait_for(self._queue.put(pending), INGEST_QUEUE_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            self.stats.rejected_reports += 1
+            raise IngestOverloaded()
+        await pending.future
+
+    async def _run(self):
+        window = INGEST_BATCH_WINDOW_MS / 1000.0
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while True:
+            if stopping and self._queue.empty():
+                return
+            first = await self._queue.get()
+            if first is _STOP:
+                stopping = True
+                continue
+            batch = self._batch = [first]
+            visits = len(first.report.Visits)
+            deadline = loop.time() + window
+            while len(batch) < INGEST_BATCH_MAX_REPORTS and visits < INGEST_BATCH_MAX_VISITS:
+                remaining = deadline - loop.time()
+                if remaining <= 0 or stopping and self._queue.empty():
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    continue
+                batch.append(item)
+                visits += len(item.report.Visits)
+            await self._flush(batch)
+            self._batch = []
+
+    async def _flush(self, batch: List[_Pending]):
+        started = time.perf_counter()
+        queue_wait = started - min(p.enqueued_at for p in batch)
+        # A single bad payload only fails its own request, not the whole batch
+        visits, errors = await ingest_reports_isolated([p.report for p in batch], self.session_factory)
+        if any(errors):
+            self.stats.failed_batches += 1
+        self.stats.record(len(batch), visits, time.perf_counter() - started, queue_wait)
+        for pending, exc in zip(batch, errors):
+            if pending.future.done():
+                continue
+            if exc is None:
+                pending.future.set_result(None)
+            else:
+                pending.future.set_exception(exc)
+
+
+ingest_batcher = IngestBatcher()
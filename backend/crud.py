@@ -1,14 +1,17 @@
 from __future__ import annotations
 
-from datetime import datetime, timezone
-from typing import Sequence, Optional, List
+import hashlib
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Sequence, Optional, List
+from urllib.parse import urlsplit
 
-from sqlalchemy import insert, select, update, delete
+from sqlalchemy import func, select, text, update, delete
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.dialects.postgresql import insert as pg_insert
 from passlib.context import CryptContext
 
-from .models import User, Visit, DashboardUser, DashboardRoleEnum
+from .models import User, Visit, VisitUrl, VisitTitle, DashboardUser, DashboardRoleEnum
+from .rollups import USER_ROLLUP_REBUILD, USER_ROLLUP_RECONCILE, USER_ROLLUP_SUBTRACT, local_day_sql
 from .schemas import ReportIn, UserInfoIn, VisitIn
 
 # Password hashing
@@ -47,20 +50,321 @@ async def upsert_user(db: AsyncSession, info: UserInfoIn) -> int:
     return user_id
 
 
-async def bulk_insert_visits(db: AsyncSession, user_id: int, visits: Sequence[VisitIn]):
-    rows = []
-    for v in visits:
-        rows.append(
-            dict(
-                user_id=user_id,
-                computer_name=v.ComputerName,
-                url=v.Url,
-                title=v.Title,
-                visit_time=datetime.fromtimestamp(v.VisitTime / 1000.0, tz=timezone.utc),
-            )
+async def upsert_users(db: AsyncSession, infos: Sequence[UserInfoIn]) -> Dict[str, int]:
+    """Upsert several users in one statement and return a username -> id map.
+
+    When a username appears more than once the last info wins, since a single
+    INSERT ... ON CONFLICT cannot touch the same row twice.
+    """
+    latest = {info.Username: info for info in infos}
+    if not latest:
+        return {}
+    now = datetime.now(timezone.utc)
+    stmt = pg_insert(User).values([
+        dict(
+            username=info.Username,
+            display_name=info.DisplayName or info.Username,
+            first_name=info.FirstName,
+            last_name=info.LastName,
+            homegroup=info.Department,
+            email=info.Email,
+            last_seen_at=now,
         )
+        for info in latest.values()
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.username],
+        set_={
+            col: stmt.excluded[col]
+            for col in ("display_name", "first_name", "last_name", "homegroup", "email", "last_seen_at")
+        },
+    ).returning(User.username, User.id)
+
+    result = await db.execute(stmt)
+    return {username: user_id for username, user_id in result.all()}
+
+
+# Column order shared by the executemany and COPY visit writers.
+VISIT_COLUMNS = ("user_id", "computer_name", "url", "title", "visit_time", "inserted_at", "domain")
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def epoch_ms_to_datetimes(values: Sequence[int]) -> List[datetime]:
+    """Convert a column of epoch-millisecond timestamps to aware datetimes in one pass."""
+    epoch = _EPOCH
+    return [epoch + timedelta(0, 0, 0, ms) for ms in values]
+
+
+def url_domain(url: Optional[str]) -> Optional[str]:
+    """Lowercased host of *url* without a leading "www.", or None if it has none."""
+    try:
+        host = urlsplit(url).hostname if url else None
+    except ValueError:
+        return None
+    if not host:
+        return None
+    return host[4:] if host.startswith("www.") else host
+
+
+def visit_records(user_id: int, visits: Sequence[VisitIn]) -> List[tuple]:
+    """Build insert-ready tuples (in VISIT_COLUMNS order) for *visits*."""
+    now = datetime.now(timezone.utc)
+    times = epoch_ms_to_datetimes([v.VisitTime for v in visits])
+    return [
+        (user_id, v.ComputerName, v.Url, v.Title, t, now, url_domain(v.Url))
+        for v, t in zip(visits, times)
+    ]
+
+
+# Column order for visits stored in interned mode (see interning.py).
+INTERNED_VISIT_COLUMNS = ("user_id", "computer_name", "url_id", "title_id", "visit_time", "inserted_at", "domain")
+
+# Conflict targets matching models.Visit's natural key indexes.
+VISIT_NATURAL_KEY = (Visit.user_id, Visit.visit_time, func.md5(Visit.url))
+INTERNED_VISIT_NATURAL_KEY = (Visit.user_id, Visit.visit_time, Visit.url_id)
+
+# Per-connection staging table: COPY cannot express ON CONFLICT, so rows are
+# copied here first and then moved into visits in a single statement.
+_CREATE_VISIT_STAGING = """
+CREATE TEMP TABLE IF NOT EXISTS visits_staging (
+    user_id integer,
+    computer_name varchar,
+    url text,
+    title text,
+    url_id bigint,
+    title_id bigint,
+    visit_time timestamptz,
+    inserted_at timestamptz,
+    domain varchar
+) ON COMMIT DELETE ROWS
+"""
+
+
+# Folds the rows of an `inserted` CTE (user_id, computer_name, visit_time and
+# url or url_id) into user_urls / user_rollups and queues their days for the
+# daily rollup compactor. Only rows that were actually inserted are counted,
+# so duplicates skipped by ON CONFLICT never inflate the totals. Rows are
+# upserted in key order to keep concurrent writers from deadlocking. Queued
+# days are re-touched rather than skipped, so the compactor cannot take a
+# day while this transaction's visits for it are still uncommitted.
+def _rollup_ctes(interned: bool) -> str:
+    if interned:
+        keys = """SELECT i.user_id, i.computer_name, i.visit_time, u.url_hash
+    FROM inserted i JOIN visit_urls u ON u.id = i.url_id"""
+    else:
+        keys = "SELECT user_id, computer_name, visit_time, decode(md5(url), 'hex') AS url_hash FROM inserted"
+    return f"""
+, keys AS (
+    {keys}
+), new_urls AS (
+    INSERT INTO user_urls (user_id, url_hash)
+    SELECT DISTINCT user_id, url_hash FROM keys
+    ON CONFLICT DO NOTHING
+    RETURNING user_id
+), rolled AS (
+    INSERT INTO user_rollups AS r (user_id, total_visits, unique_urls, last_activity, computers)
+    SELECT k.user_id, k.visits, coalesce(n.urls, 0), k.last_activity, k.computers
+    FROM (
+        SELECT user_id, count(*) AS visits, max(visit_time) AS last_activity,
+               array_agg(DISTINCT computer_name ORDER BY computer_name)
+                   FILTER (WHERE computer_name IS NOT NULL) AS computers
+        FROM keys GROUP BY user_id
+    ) k
+    LEFT JOIN (SELECT user_id, count(*) AS urls FROM new_urls GROUP BY user_id) n USING (user_id)
+    ORDER BY k.user_id
+    ON CONFLICT (user_id) DO UPDATE SET
+        total_visits = r.total_visits + EXCLUDED.total_visits,
+        unique_urls = r.unique_urls + EXCLUDED.unique_urls,
+        last_activity = GREATEST(r.last_activity, EXCLUDED.last_activity),
+        computers = CASE WHEN EXCLUDED.computers <@ r.computers THEN r.computers ELSE ARRAY(
+            SELECT DISTINCT c FROM unnest(r.computers || EXCLUDED.computers) AS c ORDER BY c
+        ) END
+), queued_days AS (
+    INSERT INTO user_daily_rollup_queue (user_id, day)
+    SELECT DISTINCT user_id, {local_day_sql("visit_time")} FROM keys
+    ORDER BY 1, 2
+    ON CONFLICT (user_id, day) DO UPDATE SET day = EXCLUDED.day
+)"""
+
+
+def _move_visit_staging(columns: Sequence[str], conflict_target: str, interned: bool) -> str:
+    column_list = ", ".join(columns)
+    return f"""
+WITH staged AS (DELETE FROM visits_staging RETURNING {column_list}),
+inserted AS (
+    INSERT INTO visits ({column_list})
+    SELECT {column_list} FROM staged
+    ON CONFLICT {conflict_target} DO NOTHING
+    RETURNING user_id, computer_name, visit_time, {"url_id" if interned else "url"}
+){_rollup_ctes(interned)}
+SELECT user_id, count(*) FROM inserted GROUP BY user_id
+"""
+
+
+_MOVE_VISIT_STAGING = {
+    False: _move_visit_staging(VISIT_COLUMNS, "(user_id, visit_time, md5(url))", False),
+    True: _move_visit_staging(INTERNED_VISIT_COLUMNS, "(user_id, visit_time, url_id) WHERE url_id IS NOT NULL", True),
+}
+
+# The same rollup update for rows returned by the executemany writer.
+_ROLLUP_INSERTED = {
+    interned: text(f"""
+WITH inserted AS (
+    SELECT * FROM unnest(
+        CAST(:user_ids AS integer[]), CAST(:computers AS varchar[]),
+        CAST(:times AS timestamptz[]), CAST(:urls AS {"bigint" if interned else "text"}[])
+    ) AS t(user_id, computer_name, visit_time, {"url_id" if interned else "url"})
+){_rollup_ctes(interned)}
+SELECT 1
+""")
+    for interned in (False, True)
+}
+
+
+async def bulk_insert_visits(db: AsyncSession, records: Sequence[tuple], interned: bool = False) -> Dict[int, int]:
+    """Insert visit records through SQLAlchemy executemany, skipping duplicates.
+
+    *records* follow INTERNED_VISIT_COLUMNS when *interned* is set and
+    VISIT_COLUMNS otherwise. Returns the number of rows actually inserted
+    per user id.
+    """
+    if not records:
+        return {}
+    if interned:
+        columns = INTERNED_VISIT_COLUMNS
+        stmt = pg_insert(Visit).on_conflict_do_nothing(
+            index_elements=list(INTERNED_VISIT_NATURAL_KEY), index_where=Visit.url_id.isnot(None)
+        )
+    else:
+        columns = VISIT_COLUMNS
+        stmt = pg_insert(Visit).on_conflict_do_nothing(index_elements=list(VISIT_NATURAL_KEY))
+    stmt = stmt.returning(
+        Visit.user_id, Visit.computer_name, Visit.visit_time, Visit.url_id if interned else Visit.url
+    )
+    result = await db.execute(stmt, [dict(zip(columns, r)) for r in records])
+    rows = result.all()
     if rows:
-        await db.execute(insert(Visit), rows)
+        user_ids, computers, times, urls = (list(col) for col in zip(*rows))
+        await db.execute(
+            _ROLLUP_INSERTED[interned],
+            {"user_ids": user_ids, "computers": computers, "times": times, "urls": urls},
+        )
+    inserted: Dict[int, int] = {}
+    for row in rows:
+        inserted[row.user_id] = inserted.get(row.user_id, 0) + 1
+    return inserted
+
+
+async def copy_insert_visits(db: AsyncSession, records: Sequence[tuple], interned: bool = False) -> Dict[int, int]:
+    """Stream visit records into Postgres with asyncpg's binary COPY, skipping duplicates.
+
+    Runs on the session's own connection, so the rows are part of the
+    current transaction. Returns the number of rows actually inserted per
+    user id.
+    """
+    if not records:
+        return {}
+    conn = await db.connection()
+    # Going through SQLAlchemy first makes the asyncpg adapter open its
+    # transaction; raw driver calls on their own would run in autocommit.
+    await conn.exec_driver_sql(_CREATE_VISIT_STAGING)
+    raw = await conn.get_raw_connection()
+    await raw.driver_connection.copy_records_to_table(
+        "visits_staging", records=records, columns=INTERNED_VISIT_COLUMNS if interned else VISIT_COLUMNS
+    )
+    result = await conn.exec_driver_sql(_MOVE_VISIT_STAGING[interned])
+    return dict(result.all())
+
+
+async def rebuild_user_rollups(conn) -> int:
+    """Recompute user_urls / user_rollups from visits on *conn*.
+
+    Returns the number of rollup rows that were missing, stale or orphaned.
+    Ingest writes wait on the table locks until the caller commits.
+    """
+    for sql in USER_ROLLUP_REBUILD:
+        await conn.execute(text(sql))
+    corrected = 0
+    for sql in USER_ROLLUP_RECONCILE:
+        corrected += (await conn.execute(text(sql))).rowcount
+    return corrected
+
+
+async def subtract_user_rollups(conn, sources: Sequence[str], before: datetime):
+    """Take the visits of tables *sources* before *before* out of user_urls / user_rollups.
+
+    *sources* are partitions of visits. Call in the transaction that
+    removes those visits, before removing them; unlike
+    rebuild_user_rollups this only locks the affected users' rows.
+    """
+    removed = " UNION ALL ".join(
+        f"SELECT user_id, url, url_id, computer_name, visit_time FROM {source} WHERE visit_time < :before"
+        for source in sources
+    )
+    tables = ", ".join(f"'{source}'::regclass" for source in sources)
+    remaining = f"NOT (rv.tableoid IN ({tables}) AND rv.visit_time < :before)"
+    for sql in USER_ROLLUP_SUBTRACT:
+        await conn.execute(text(sql.format(removed=removed, remaining=remaining)), {"before": before})
+
+
+# URL / title of a visit in either storage mode; queries using these must be
+# passed through join_visit_text.
+VISIT_URL = func.coalesce(Visit.url, VisitUrl.url)
+VISIT_TITLE = func.coalesce(Visit.title, VisitTitle.title)
+
+
+def join_visit_text(query):
+    """Outer-join the URL/title dictionaries so VISIT_URL / VISIT_TITLE resolve."""
+    return (
+        query.outerjoin(VisitUrl, VisitUrl.id == Visit.url_id)
+        .outerjoin(VisitTitle, VisitTitle.id == Visit.title_id)
+    )
+
+
+def content_hash(value: str) -> bytes:
+    """md5 digest used as the dictionary key for interned URLs and titles."""
+    return hashlib.md5(value.encode("utf-8")).digest()
+
+
+_INTERN_SQL = {
+    kind: (
+        text(f"""
+WITH added AS (
+    INSERT INTO {table} ({kind}_hash, {kind})
+    SELECT * FROM unnest(CAST(:hashes AS bytea[]), CAST(:values AS text[]))
+    ON CONFLICT ({kind}_hash) DO NOTHING
+    RETURNING {kind}_hash, id
+)
+SELECT {kind}_hash, id FROM added
+UNION ALL
+SELECT {kind}_hash, id FROM {table} WHERE {kind}_hash = ANY(CAST(:hashes AS bytea[]))
+"""),
+        text(f"SELECT {kind}_hash, id FROM {table} WHERE {kind}_hash = ANY(CAST(:hashes AS bytea[]))"),
+    )
+    for kind, table in (("url", VisitUrl.__tablename__), ("title", VisitTitle.__tablename__))
+}
+
+
+async def intern_strings(db: AsyncSession, kind: str, values: Sequence[str]) -> Dict[str, int]:
+    """Return dictionary ids for *values*, inserting the ones not stored yet.
+
+    *kind* is "url" or "title".
+    """
+    by_hash = {content_hash(v): v for v in set(values)}
+    if not by_hash:
+        return {}
+    upsert, lookup = _INTERN_SQL[kind]
+    hashes = list(by_hash)
+    result = await db.execute(upsert, {"hashes": hashes, "values": [by_hash[h] for h in hashes]})
+    ids = dict(result.all())
+    missing = [h for h in hashes if h not in ids]
+    if missing:
+        # Rows committed by a concurrent transaction after this statement's
+        # snapshot conflict but are not visible yet; a new statement sees them.
+        result = await db.execute(lookup, {"hashes": missing})
+        ids.update(result.all())
+    return {by_hash[h]: ids[h] for h in hashes}
 
 
 # Admin Management CRUD Operations
@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import os
+import re
+import time
+from collections import deque
+from functools import lru_cache
+from typing import Dict, Optional
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+# Statement timings are grouped by shape: the SQL with literals and bind
+# placeholders replaced, so one query run with different values (or
+# different numbers of VALUES rows) is one entry.
+DB_QUERY_STATS_ENABLED = os.getenv("DB_QUERY_STATS_ENABLED", "true").lower() in ("1", "true", "yes")
+# Shapes tracked per process; statements of further shapes are counted as "(other)"
+DB_QUERY_STATS_MAX_SHAPES = int(os.getenv("DB_QUERY_STATS_MAX_SHAPES", "500"))
+
+_OTHER_SHAPE = "(other)"
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_PLACEHOLDER = re.compile(r"\$\d+")
+_NUMBER = re.compile(r"(?<![\w.])\d+(?:\.\d+)?\b")
+_LIST = re.compile(r"\?(?:, \?)+")
+_ROWS = re.compile(r"(\([?., ]+\))(?:, \([?., ]+\))+")
+
+
+@lru_cache(maxsize=4096)
+def query_shape(statement: str) -> str:
+    """*statement* with whitespace collapsed and every value replaced by ``?``."""
+    shape = " ".join(statement.split())
+    shape = _STRING.sub("?", shape)
+    shape = _PLACEHOLDER.sub("?", shape)
+    shape = _NUMBER.sub("?", shape)
+    shape = _LIST.sub("?, ...", shape)
+    return _ROWS.sub(r"\1, ...", shape)
+
+
+def _percentile(values, pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct))], 6)
+
+
+class PoolStats:
+    """Connection checkouts: how long they waited for the pool and how long they were held."""
+
+    def __init__(self, recent: int = 1024):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._wait_seconds: deque = deque(maxlen=recent)
+        self._held_seconds: deque = deque(maxlen=recent)
+
+    def record_wait(self, elapsed: float):
+        self.checkouts += 1
+        self.wait_seconds += elapsed
+        self.max_wait_seconds = max(self.max_wait_seconds, elapsed)
+        self._wait_seconds.append(elapsed)
+
+    def record_held(self, elapsed: float):
+        self._held_seconds.append(elapsed)
+
+    def snapshot(self, pool) -> dict:
+        return {
+            "size": pool.size(),
+            "max_overflow": pool._max_overflow,
+            "timeout_seconds": pool.timeout(),
+            "checked_out": pool.checkedout(),
+            "idle": pool.checkedin(),
+            "overflow": max(pool.overflow(), 0),
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_seconds_avg": round(self.wait_seconds / self.checkouts, 6) if self.checkouts else None,
+            "wait_seconds_p50": _percentile(self._wait_seconds, 0.5),
+            "wait_seconds_p95": _percentile(self._wait_seconds, 0.95),
+            "wait_seconds_max": round(self.max_wait_seconds, 6),
+            "held_seconds_p50": _percentile(self._held_seconds, 0.5),
+            "held_seconds_p95": _percentile(self._held_seconds, 0.95),
+        }
+
+
+pool_stats = PoolStats()
+
+
+def _checkout(dbapi_connection, record, proxy):
+    record.info["checked_out_at"] = time.perf_counter()
+
+
+def _checkin(dbapi_connection, record):
+    started = record.info.pop("checked_out_at", None)
+    if started is not None:
+        pool_stats.record_held(time.perf_counter() - started)
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """The asyncio queue pool, timing each checkout including any wait for a free connection."""
+
+    def connect(self):
+        pool_stats.waiting += 1
+        pool_stats.max_waiting = max(pool_stats.max_waiting, pool_stats.waiting)
+        started = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeout:
+            pool_stats.timeouts += 1
+            raise
+        finally:
+            pool_stats.waiting -= 1
+        pool_stats.record_wait(time.perf_counter() - started)
+        return connection
+
+
+class _ShapeStats:
+    __slots__ = ("calls", "seconds", "max_seconds")
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+
+class QueryStats:
+    """Per-shape statement timings collected from engine cursor events."""
+
+    def __init__(self):
+        self.shapes: Dict[str, _ShapeStats] = {}
+        self.since = time.time()
+
+    @staticmethod
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        context._query_started = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_query_started", None)
+        if started is not None:
+            self.record(statement, time.perf_counter() - started)
+
+    def record(self, statement: str, elapsed: float):
+        shape = query_shape(statement)
+        stats = self.shapes.get(shape)
+        if stats is None:
+            if len(self.shapes) >= DB_QUERY_STATS_MAX_SHAPES:
+                shape = _OTHER_SHAPE
+            stats = self.shapes.setdefault(shape, _ShapeStats())
+        stats.calls += 1
+        stats.seconds += elapsed
+        if elapsed > stats.max_seconds:
+            stats.max_seconds = elapsed
+
+    def reset(self):
+        self.shapes = {}
+        self.since = time.time()
+
+    def snapshot(self, limit: int = 50, sort: str = "seconds") -> dict:
+        key = {
+            "seconds": lambda s: s.seconds,
+            "calls": lambda s: s.calls,
+            "mean": lambda s: s.seconds / s.calls,
+            "max": lambda s: s.max_seconds,
+        }[sort]
+        ranked = sorted(self.shapes.items(), key=lambda item: key(item[1]), reverse=True)
+        return {
+            "enabled": DB_QUERY_STATS_ENABLED,
+            "since": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.since)),
+            "shapes": len(self.shapes),
+            "calls": sum(s.calls for s in self.shapes.values()),
+            "seconds": round(sum(s.seconds for s in self.shapes.values()), 6),
+            "queries": [
+                {
+                    "query": shape,
+                    "calls": s.calls,
+                    "seconds": round(s.seconds, 6),
+                    "mean_ms": round(s.seconds / s.calls * 1000, 3),
+                    "max_ms": round(s.max_seconds * 1000, 3),
+                }
+                for shape, s in ranked[:limit]
+            ],
+        }
+
+
+query_stats = QueryStats()
+
+
+def instrument(engine):
+    """Collect pool and statement stats for *engine*, an AsyncEngine's sync_engine."""
+    event.listen(engine.pool, "checkout", _checkout)
+    event.listen(engine.pool, "checkin", _checkin)
+    if DB_QUERY_STATS_ENABLED:
+        event.listen(engine, "before_cursor_execute", query_stats._before)
+        event.listen(engine, "after_cursor_execute", query_stats._after)
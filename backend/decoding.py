@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import json
+import os
+from typing import Any, List, Optional
+
+from pydantic import ValidationError
+
+from .schemas import ReportIn, UserInfoIn, VisitIn
+
+try:
+    import msgspec
+except ImportError:  # pragma: no cover
+    msgspec = None  # type: ignore
+
+# "pydantic" validates into schemas.ReportIn; "fast" decodes straight into
+# msgspec structs with the same fields and rules.
+INGEST_DECODER = os.getenv("INGEST_DECODER", "fast").lower()
+
+if INGEST_DECODER == "fast" and msgspec is None:  # pragma: no cover
+    print("⚠️  msgspec not installed. INGEST_DECODER=fast falls back to Pydantic.")
+
+
+class ReportDecodeError(ValueError):
+    """Raised when a report body fails decoding or validation.
+
+    ``errors`` follows FastAPI's request validation error format.
+    """
+
+    def __init__(self, errors: List[dict]):
+        super().__init__(errors[0]["msg"] if errors else "Invalid report")
+        self.errors = errors
+
+
+if msgspec is not None:
+
+    class VisitStruct(msgspec.Struct):
+        Url: str
+        Title: str
+        VisitTime: int  # epoch milliseconds
+        ComputerName: str
+
+    class UserInfoStruct(msgspec.Struct):
+        Username: str
+        DisplayName: Optional[str] = None
+        FirstName: Optional[str] = None
+        LastName: Optional[str] = None
+        Department: Optional[str] = None
+        Email: Optional[str] = None
+
+    class ReportStruct(msgspec.Struct):
+        Username: str
+        Visits: List[VisitStruct]
+        UserInfo: UserInfoStruct
+
+    # strict=False mirrors Pydantic's lax mode for numeric strings.
+    _report_decoder = msgspec.json.Decoder(ReportStruct, strict=False)
+    _visit_decoder = msgspec.json.Decoder(VisitStruct, strict=False)
+    _user_info_decoder = msgspec.json.Decoder(UserInfoStruct, strict=False)
+else:  # pragma: no cover
+    _report_decoder = _visit_decoder = _user_info_decoder = None
+
+
+def fast_decoder_enabled() -> bool:
+    return INGEST_DECODER == "fast" and msgspec is not None
+
+
+def _pydantic_errors(exc: ValidationError) -> List[dict]:
+    return [
+        {"loc": ["body", *err["loc"]], "msg": err["msg"], "type": err["type"]}
+        for err in exc.errors(include_url=False)
+    ]
+
+
+def _decode(body: bytes, decoder, model) -> Any:
+    if fast_decoder_enabled():
+        try:
+            return decoder.decode(body)
+        except (msgspec.ValidationError, msgspec.DecodeError) as exc:
+            raise ReportDecodeError([{"loc": ["body"], "msg": str(exc), "type": "value_error"}])
+    try:
+        return model.model_validate_json(body)
+    except ValidationError as exc:
+        raise ReportDecodeError(_pydantic_errors(exc))
+
+
+def decode_report(body: bytes):
+    """Decode a /api/reports/data body into a ReportIn or equivalent struct.
+
+    Both decoders produce objects with the same attribute names, so the
+    result can be passed straight to ingest.store_reports.
+    """
+    report = _decode(body, _report_decoder, ReportIn)
+    if not report.Visits:
+        # ReportIn's validator already enforces this; the struct needs it here.
+        raise ReportDecodeError([
+            {"loc": ["body", "Visits"], "msg": "Value error, Visits list cannot be empty", "type": "value_error"}
+        ])
+    return report
+
+
+def decode_report_batch(body: bytes) -> List[Any]:
+    """Decode a JSON array of reports, validating each one independently.
+
+    Returns one entry per array element: the decoded report, or the
+    ReportDecodeError it failed with. Only a body that is not a JSON array
+    raises.
+    """
+    if msgspec is not None:
+        try:
+            items = msgspec.json.decode(body, type=List[msgspec.Raw])
+        except (msgspec.ValidationError, msgspec.DecodeError) as exc:
+            raise ReportDecodeError([{"loc": ["body"], "msg": str(exc), "type": "value_error"}])
+    else:  # pragma: no cover
+        try:
+            parsed = json.loads(body)
+        except ValueError as exc:
+            raise ReportDecodeError([{"loc": ["body"], "msg": str(exc), "type": "json_invalid"}])
+        if not isinstance(parsed, list):
+            raise ReportDecodeError([{"loc": ["body"], "msg": "Expected an array of reports", "type": "list_type"}])
+        items = [json.dumps(item).encode() for item in parsed]
+
+    results: List[Any] = []
+    for item in items:
+        try:
+            results.append(decode_report(item))
+        except ReportDecodeError as exc:
+            results.append(exc)
+    return results
+
+
+def decode_visit(line: bytes):
+    return _decode(line, _visit_decoder, VisitIn)
+
+
+def decode_user_info(line: bytes):
+    return _decode(line, _user_info_decoder, UserInfoIn)
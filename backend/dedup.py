@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import os
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Bound on the number of (user, computer) watermarks kept in memory.
+DEDUP_WATERMARK_MAX_ENTRIES = int(os.getenv("DEDUP_WATERMARK_MAX_ENTRIES", "100000"))
+
+# Positions within a crud.VISIT_COLUMNS record.
+_USER_ID, _COMPUTER, _VISIT_TIME = 0, 1, 4
+
+
+class VisitWatermarks:
+    """Latest stored visit_time per (user_id, computer_name).
+
+    Each collector resends its whole recent history on every sync, so visits
+    strictly older than what that machine already delivered for the user are
+    dropped before they reach the database. Visits at exactly the watermark
+    are passed through and left to the unique index. Watermarks only advance
+    after a commit, so a failed write never hides data from a retry.
+    """
+
+    def __init__(self, max_entries: int = DEDUP_WATERMARK_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._marks: "OrderedDict[Tuple[int, str], datetime]" = OrderedDict()
+        self.dropped_by_watermark = 0
+        self.dropped_by_conflict = 0
+        self.inserted = 0
+
+    def filter(self, records: Sequence[tuple]) -> List[tuple]:
+        marks = self._marks
+        kept = []
+        for r in records:
+            mark = marks.get((r[_USER_ID], r[_COMPUTER]))
+            if mark is None or r[_VISIT_TIME] >= mark:
+                kept.append(r)
+        self.dropped_by_watermark += len(records) - len(kept)
+        return kept
+
+    @staticmethod
+    def latest(records: Sequence[tuple], into: Optional[Dict] = None) -> Dict:
+        """Collect the newest visit_time per (user, computer) in *records*."""
+        latest = {} if into is None else into
+        for r in records:
+            key = (r[_USER_ID], r[_COMPUTER])
+            if key not in latest or r[_VISIT_TIME] > latest[key]:
+                latest[key] = r[_VISIT_TIME]
+        return latest
+
+    def advance(self, records: Sequence[tuple]):
+        self.merge(self.latest(records))
+
+    def merge(self, latest: Dict):
+        marks = self._marks
+        for key, visit_time in latest.items():
+            current = marks.get(key)
+            marks[key] = visit_time if current is None or visit_time > current else current
+            marks.move_to_end(key)
+        while len(marks) > self.max_entries:
+            marks.popitem(last=False)
+
+    def record_insert(self, attempted: int, inserted: int):
+        self.inserted += inserted
+        self.dropped_by_conflict += attempted - inserted
+
+    def snapshot(self) -> dict:
+        return {
+            "tracked_watermarks": len(self._marks),
+            "inserted": self.inserted,
+            "duplicates_dropped_by_watermark": self.dropped_by_watermark,
+            "duplicates_dropped_by_conflict": self.dropped_by_conflict,
+            "duplicates_suppressed": self.dropped_by_watermark + self.dropped_by_conflict,
+        }
+
+
+visit_watermarks = VisitWatermarks()
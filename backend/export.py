@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from typing import AsyncIterator, Optional
+
+from sqlalchemy import select
+
+from .crud import VISIT_TITLE, VISIT_URL, join_visit_text
+from .database import AsyncSessionLocal
+from .models import Visit
+
+# Rows fetched from the server-side cursor per round trip; also the rows
+# encoded into each chunk of the response.
+EXPORT_FETCH_ROWS = int(os.getenv("EXPORT_FETCH_ROWS", "2000"))
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+CSV_COLUMNS = ["timestamp", "title", "url", "computerName"]
+
+
+def _ndjson_chunk(rows) -> bytes:
+    return "".join(
+        json.dumps({
+            "timestamp": r.visit_time.isoformat(),
+            "title": r.title,
+            "url": r.url,
+            "computerName": r.computer_name,
+        }, ensure_ascii=False) + "\n"
+        for r in rows
+    ).encode()
+
+
+def _csv_chunk(rows, header: bool = False) -> bytes:
+    out = io.StringIO()
+    writer = csv.writer(out)
+    if header:
+        writer.writerow(CSV_COLUMNS)
+    writer.writerows((r.visit_time.isoformat(), r.title, r.url, r.computer_name) for r in rows)
+    return out.getvalue().encode()
+
+
+async def export_visits(
+    user_id: int,
+    fmt: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    session_factory=AsyncSessionLocal,
+) -> AsyncIterator[bytes]:
+    """Yield a user's visits, oldest first, as NDJSON or CSV chunks.
+
+    Rows come from a server-side cursor EXPORT_FETCH_ROWS at a time, so
+    memory does not grow with the size of the export. The session is
+    opened here rather than taken from the request: the response body is
+    produced after the endpoint's dependencies have been closed.
+    """
+    query = join_visit_text(
+        select(Visit.visit_time, VISIT_TITLE.label("title"), VISIT_URL.label("url"), Visit.computer_name)
+    ).where(Visit.user_id == user_id)
+    if start is not None:
+        query = query.where(Visit.visit_time >= start)
+    if end is not None:
+        query = query.where(Visit.visit_time < end)
+    query = query.order_by(Visit.visit_time, Visit.id).execution_options(yield_per=EXPORT_FETCH_ROWS)
+
+    if fmt == "csv":
+        yield _csv_chunk([], header=True)
+    async with session_factory() as db:
+        result = await db.stream(query)
+        async for rows in result.partitions():
+            yield _csv_chunk(rows) if fmt == "csv" else _ndjson_chunk(rows)
@@ -0,0 +1,255 @@
+from __future__ import annotations
+
+import os
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy.exc import DBAPIError, IntegrityError, TimeoutError as PoolTimeout
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .database import AsyncSessionLocal
+from .crud import VISIT_COLUMNS, bulk_insert_visits, copy_insert_visits, visit_records
+from .dedup import visit_watermarks
+from .pacing import sync_advisor
+from .partitions import drop_expired_records
+from .responsecache import report_generations
+from .livefeed import live_feed
+from .metrics import ingest_commit_rows, ingest_commit_seconds, ingest_rows_inserted, ingest_visits
+from .interning import intern_records, interned_storage, publish_interned, snapshot as interning_snapshot
+from .schemas import ReportIn
+from .usercache import resolve_users, user_cache
+
+# "copy" streams visits through asyncpg's binary COPY; "executemany" keeps
+# the original SQLAlchemy insert path.
+INGEST_ENGINE = os.getenv("INGEST_ENGINE", "copy").lower()
+
+_USER_ID = VISIT_COLUMNS.index("user_id")
+_COMPUTER_NAME = VISIT_COLUMNS.index("computer_name")
+_VISIT_TIME = VISIT_COLUMNS.index("visit_time")
+
+
+class IngestPathStats:
+    """Running totals for one visit write path."""
+
+    def __init__(self):
+        self.calls = 0
+        self.rows = 0
+        self.seconds = 0.0
+
+    def record(self, rows: int, elapsed: float):
+        self.calls += 1
+        self.rows += rows
+        self.seconds += elapsed
+
+    def snapshot(self) -> dict:
+        return {
+            "calls": self.calls,
+            "rows": self.rows,
+            "seconds": round(self.seconds, 6),
+            "rows_per_sec": round(self.rows / self.seconds, 1) if self.seconds else None,
+        }
+
+
+class IngestStats:
+    def __init__(self):
+        self.paths: Dict[str, IngestPathStats] = {
+            "copy": IngestPathStats(),
+            "executemany": IngestPathStats(),
+        }
+
+    def snapshot(self) -> dict:
+        return {
+            "engine": INGEST_ENGINE,
+            "paths": {name: p.snapshot() for name, p in self.paths.items()},
+            "dedup": visit_watermarks.snapshot(),
+            "user_cache": user_cache.snapshot(),
+            "interning": interning_snapshot(),
+        }
+
+
+ingest_stats = IngestStats()
+
+
+def _copy_supported(db: AsyncSession) -> bool:
+    return db.bind is not None and db.bind.dialect.driver == "asyncpg"
+
+
+def choose_path(db: AsyncSession) -> str:
+    if INGEST_ENGINE == "copy" and _copy_supported(db):
+        return "copy"
+    return "executemany"
+
+
+async def write_visits(
+    db: AsyncSession, records: Sequence[tuple], path: str | None = None, interned: bool = False
+) -> Dict[int, int]:
+    """Write visit *records* using the configured engine.
+
+    Rows already stored (same natural key) are skipped; the number of rows
+    actually inserted per user id is returned. *interned* records carry url/title ids
+    (crud.INTERNED_VISIT_COLUMNS) instead of text.
+
+    *path* forces a specific writer ("copy" or "executemany"); by default it
+    is chosen from INGEST_ENGINE, falling back to executemany on drivers
+    without COPY support.
+    """
+    if not records:
+        return {}
+    path = path or choose_path(db)
+    writer = copy_insert_visits if path == "copy" else bulk_insert_visits
+    started = time.perf_counter()
+    inserted = await writer(db, records, interned=interned)
+    ingest_stats.paths[path].record(len(records), time.perf_counter() - started)
+    visit_watermarks.record_insert(len(records), sum(inserted.values()))
+    return inserted
+
+
+class StoredReports:
+    """What a store_reports call wrote, to be published once it commits."""
+
+    __slots__ = (
+        "records", "inserted", "inserted_by_user", "usernames", "new_users", "cached_user_ids", "interned", "profiles",
+    )
+
+    def __init__(
+        self, records: List[tuple], inserted_by_user: Dict[int, int], usernames: List[str],
+        new_users: dict, cached_user_ids: List[int], interned: dict, profiles: Dict[int, Tuple[str, Optional[str]]],
+    ):
+        self.records = records
+        self.inserted_by_user = inserted_by_user
+        self.inserted = sum(inserted_by_user.values())
+        self.usernames = usernames
+        self.new_users = new_users
+        self.cached_user_ids = cached_user_ids
+        self.interned = interned
+        self.profiles = profiles
+
+    def activity_events(self) -> List[dict]:
+        """One live feed event per user with new visits: how many were inserted and the latest reported."""
+        latest: Dict[int, tuple] = {}
+        for record in self.records:
+            user_id = record[_USER_ID]
+            if user_id not in self.inserted_by_user:
+                continue
+            if user_id not in latest or record[_VISIT_TIME] > latest[user_id][_VISIT_TIME]:
+                latest[user_id] = record
+        events = []
+        for user_id, record in latest.items():
+            username, homegroup = self.profiles[user_id]
+            events.append({
+                "username": username,
+                "homegroup": homegroup,
+                "visits": self.inserted_by_user[user_id],
+                "lastVisit": record[_VISIT_TIME].isoformat(),
+                "computerName": record[_COMPUTER_NAME],
+            })
+        return events
+
+    def publish_caches(self):
+        user_cache.remember(self.new_users)
+        user_cache.touch(self.cached_user_ids)
+        publish_interned(self.interned)
+        # Upserted profiles show in reports even when no visit was new
+        if self.inserted or self.new_users:
+            report_generations.bump(self.usernames)
+        ingest_visits.inc(amount=len(self.records))
+        ingest_rows_inserted.inc(amount=self.inserted)
+        ingest_commit_rows.observe(self.inserted)
+        if self.inserted and live_feed.has_subscribers:
+            live_feed.publish(self.activity_events())
+
+    def publish(self):
+        self.publish_caches()
+        visit_watermarks.advance(self.records)
+
+
+async def store_reports(db: AsyncSession, reports: Sequence[ReportIn]) -> StoredReports:
+    """Upsert the users of *reports* and write all of their visits.
+
+    Uses at most one multi-row user upsert (users unchanged since they were
+    last cached are skipped) and one visit write regardless of how many
+    reports are passed. Visits older than the per-machine watermark or the
+    retention cutoff are dropped first. The caller owns the transaction and
+    must call ``publish()`` on the result once it has committed.
+    """
+    user_ids, new_users = await resolve_users(db, [r.UserInfo for r in reports])
+    records: List[tuple] = []
+    for r in reports:
+        records.extend(visit_records(user_ids[r.UserInfo.Username], r.Visits))
+    records = drop_expired_records(visit_watermarks.filter(records))
+    try:
+        if interned_storage():
+            interned_records, resolved = await intern_records(db, records)
+            inserted = await write_visits(db, interned_records, interned=True)
+        else:
+            resolved = {}
+            inserted = await write_visits(db, records)
+    except IntegrityError:
+        # Possibly a cached id of a user row deleted since; upsert them on the next attempt
+        user_cache.forget(list(user_ids))
+        raise
+    cached = [user_id for username, user_id in user_ids.items() if username not in new_users]
+    profiles = {user_ids[r.UserInfo.Username]: (r.UserInfo.Username, r.UserInfo.Department) for r in reports}
+    return StoredReports(records, inserted, list(user_ids), new_users, cached, resolved, profiles)
+
+
+async def ingest_reports(db: AsyncSession, reports: Sequence[ReportIn]) -> int:
+    """Store *reports* in one transaction, commit, and publish the result.
+
+    Returns the number of visits sent to the database.
+    """
+    started = time.perf_counter()
+    stored = await store_reports(db, reports)
+    await db.commit()
+    elapsed = time.perf_counter() - started
+    sync_advisor.latency.observe(elapsed)
+    ingest_commit_seconds.observe(elapsed)
+    stored.publish()
+    return len(stored.records)
+
+
+def is_connection_error(exc: BaseException) -> bool:
+    """Whether *exc* means the database is unreachable, rather than that a report was rejected."""
+    if isinstance(exc, (OSError, PoolTimeout)):
+        return True
+    if isinstance(exc, DBAPIError):
+        if exc.connection_invalidated:
+            return True
+        # connection_exception, operator_intervention (shutdown) and too_many_connections
+        sqlstate = getattr(exc.orig, "sqlstate", None) or ""
+        return sqlstate.startswith(("08", "57P")) or sqlstate == "53300"
+    return False
+
+
+async def ingest_reports_isolated(
+    reports: Sequence[ReportIn], session_factory=AsyncSessionLocal
+) -> Tuple[int, List[Optional[BaseException]]]:
+    """Ingest *reports* in one transaction, isolating failures per report.
+
+    If the combined write fails, every report is retried in its own
+    transaction so only the reports that actually fail report an error.
+    When the database cannot be reached, the remaining reports fail with
+    that error instead of each being retried.
+    Returns the number of visits written and one error (or None) per report.
+    """
+    try:
+        async with session_factory() as db:
+            visits = await ingest_reports(db, reports)
+        return visits, [None] * len(reports)
+    except Exception as exc:
+        if len(reports) == 1 or is_connection_error(exc):
+            return 0, [exc] * len(reports)
+
+    visits = 0
+    errors: List[Optional[BaseException]] = []
+    for report in reports:
+        try:
+            async with session_factory() as db:
+                visits += await ingest_reports(db, [report])
+            errors.append(None)
+        except Exception as exc:
+            errors.append(exc)
+            if is_connection_error(exc):
+                errors.extend([exc] * (len(reports) - len(errors)))
+                break
+    return visits, errors
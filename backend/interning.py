@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import os
+from collections import OrderedDict
+from typing import Dict, List, Sequence, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .crud import intern_strings
+
+# "text" stores url/title on every visit row; "interned" stores them once in
+# the visit_urls / visit_titles dictionaries and keeps integer ids on visits.
+# Existing rows are converted with `python -m backend.manage intern-visits`.
+VISIT_STORAGE = os.getenv("VISIT_STORAGE", "text").lower()
+INTERN_CACHE_MAX_ENTRIES = int(os.getenv("INTERN_CACHE_MAX_ENTRIES", "200000"))
+
+# Positions within a crud.VISIT_COLUMNS record.
+_URL, _TITLE = 2, 3
+
+
+def interned_storage() -> bool:
+    return VISIT_STORAGE == "interned"
+
+
+class InternCache:
+    """Bounded LRU of string -> dictionary id for one dictionary table.
+
+    Keyed by the string itself, so hits cost a dict lookup and only misses
+    pay for the content hash and a database round trip. Ids are added only
+    after the transaction that created them commits.
+    """
+
+    def __init__(self, max_entries: int = INTERN_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._ids: "OrderedDict[str, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def split(self, values: Sequence[str]) -> Tuple[Dict[str, int], List[str]]:
+        """Return the cached ids among *values* and the values still to look up."""
+        known: Dict[str, int] = {}
+        unknown: List[str] = []
+        ids = self._ids
+        for value in set(values):
+            value_id = ids.get(value)
+            if value_id is None:
+                unknown.append(value)
+            else:
+                ids.move_to_end(value)
+                known[value] = value_id
+        self.hits += len(known)
+        self.misses += len(unknown)
+        return known, unknown
+
+    def remember(self, entries: Dict[str, int]):
+        ids = self._ids
+        ids.update(entries)
+        while len(ids) > self.max_entries:
+            ids.popitem(last=False)
+
+    def snapshot(self) -> dict:
+        return {"entries": len(self._ids), "hits": self.hits, "misses": self.misses}
+
+
+url_cache = InternCache()
+title_cache = InternCache()
+
+
+async def intern_records(db: AsyncSession, records: Sequence[tuple]) -> Tuple[List[tuple], dict]:
+    """Turn VISIT_COLUMNS records into INTERNED_VISIT_COLUMNS records.
+
+    Returns the converted records and the newly resolved ids, to be passed
+    to ``publish_interned`` after commit.
+    """
+    url_ids, new_urls = url_cache.split([r[_URL] for r in records])
+    title_ids, new_titles = title_cache.split([r[_TITLE] for r in records])
+    resolved = {
+        "url": await intern_strings(db, "url", new_urls),
+        "title": await intern_strings(db, "title", new_titles),
+    }
+    url_ids.update(resolved["url"])
+    title_ids.update(resolved["title"])
+    interned = [
+        (r[0], r[1], url_ids[r[_URL]], title_ids[r[_TITLE]], r[4], r[5], r[6])
+        for r in records
+    ]
+    return interned, resolved
+
+
+def publish_interned(resolved: dict):
+    url_cache.remember(resolved.get("url", {}))
+    title_cache.remember(resolved.get("title", {}))
+
+
+def snapshot() -> dict:
+    return {"storage": VISIT_STORAGE, "url_cache": url_cache.snapshot(), "title_cache": title_cache.snapshot()}
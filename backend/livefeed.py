@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+# Events queued per subscriber. A client that falls this far behind is
+# disconnected (EventSource reconnects on its own) rather than let ingest
+# wait on it or the queue grow.
+LIVE_FEED_QUEUE_SIZE = int(os.getenv("LIVE_FEED_QUEUE_SIZE", "256"))
+LIVE_FEED_MAX_SUBSCRIBERS = int(os.getenv("LIVE_FEED_MAX_SUBSCRIBERS", "200"))
+# Comment lines sent while idle keep proxies from closing the stream
+LIVE_FEED_KEEPALIVE_SECONDS = float(os.getenv("LIVE_FEED_KEEPALIVE_SECONDS", "15"))
+
+_KEEPALIVE = b": keepalive\n\n"
+
+
+class Subscriber:
+    __slots__ = ("queue", "homegroup", "dropped")
+
+    def __init__(self, homegroup: Optional[str]):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=LIVE_FEED_QUEUE_SIZE)
+        self.homegroup = homegroup
+        self.dropped = False
+
+
+class LiveFeed:
+    """In-process broadcast of ingest activity to Server-Sent Events streams.
+
+    ``publish`` never waits: each event is put on every matching
+    subscriber's bounded queue, and a subscriber whose queue is full is
+    dropped. Each server process has its own hub, so a stream only sees
+    reports ingested by the worker serving it.
+    """
+
+    def __init__(self):
+        self._subscribers: Set[Subscriber] = set()
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    @property
+    def has_subscribers(self) -> bool:
+        return bool(self._subscribers)
+
+    @property
+    def full(self) -> bool:
+        return len(self._subscribers) >= LIVE_FEED_MAX_SUBSCRIBERS
+
+    def subscribe(self, homegroup: Optional[str] = None) -> Subscriber:
+        subscriber = Subscriber(homegroup)
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self._subscribers.discard(subscriber)
+
+    def publish(self, events: List[dict]):
+        if not events or not self._subscribers:
+            return
+        self.published += len(events)
+        for subscriber in list(self._subscribers):
+            for event in events:
+                if subscriber.homegroup and event["homegroup"] != subscriber.homegroup:
+                    continue
+                try:
+                    subscriber.queue.put_nowait(event)
+                    self.delivered += 1
+                except asyncio.QueueFull:
+                    subscriber.dropped = True
+                    self._subscribers.discard(subscriber)
+                    self.dropped += 1
+                    # Wake the stream so it ends now rather than at the next keepalive
+                    subscriber.queue.get_nowait()
+                    subscriber.queue.put_nowait(None)
+                    break
+
+    async def stream(self, homegroup: Optional[str], is_disconnected) -> AsyncIterator[bytes]:
+        """SSE body of one subscription; ends when the client goes away or is dropped.
+
+        Subscribing here rather than in the endpoint ties the subscription's
+        lifetime to the response body, which is closed however it ends.
+        """
+        subscriber = self.subscribe(homegroup)
+        try:
+            yield b"retry: 5000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), LIVE_FEED_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await is_disconnected():
+                        return
+                    yield _KEEPALIVE
+                    continue
+                if event is None or subscriber.dropped:
+                    return
+                yield b"event: activity\ndata: " + json.dumps(event, separators=(",", ":")).encode() + b"\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+    def snapshot(self) -> dict:
+        by_homegroup: Dict[str, int] = {}
+        for subscriber in self._subscribers:
+            key = subscriber.homegroup or "*"
+            by_homegroup[key] = by_homegroup.get(key, 0) + 1
+        return {
+            "subscribers": len(self._subscribers),
+            "by_homegroup": by_homegroup,
+            "max_subscribers": LIVE_FEED_MAX_SUBSCRIBERS,
+            "queue_size": LIVE_FEED_QUEUE_SIZE,
+            "events_published": self.published,
+            "events_delivered": self.delivered,
+            "subscribers_dropped": self.dropped,
+        }
+
+
+live_feed = LiveFeed()
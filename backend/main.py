@@ -1,38 +1,88 @@
 from __future__ import annotations
 
+import asyncio
 import os
+import re
+import math
 import secrets
+import time
 import csv
 import io
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
 from typing import Optional, List
+from zoneinfo import ZoneInfo
 
-from fastapi import FastAPI, Depends, Request, Form, HTTPException, status, UploadFile, File
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, FileResponse
+from fastapi import FastAPI, Depends, Request, Form, HTTPException, status, UploadFile, File, Query
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse, Response, PlainTextResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, text
+from sqlalchemy import select, func, text, tuple_, or_
 
-from .database import get_db, engine, Base, AsyncSessionLocal
-from .schemas import ReportIn, DashboardUserCreate, DashboardUserUpdate, DashboardUserResponse
+from .database import get_db, engine, AsyncSessionLocal, DB_POOL_RECYCLE, DB_POOL_PRE_PING, DB_STATEMENT_CACHE_SIZE
+from .schemas import DashboardUserCreate, DashboardUserUpdate, DashboardUserResponse, ReportIn
 from .crud import (
-    upsert_user, bulk_insert_visits, get_dashboard_users, get_dashboard_user_by_username,
+    get_dashboard_users, get_dashboard_user_by_username,
     create_dashboard_user, update_dashboard_user_password, update_dashboard_user_role,
-    delete_dashboard_user, verify_password, get_password_hash
+    delete_dashboard_user, verify_password, get_password_hash,
+    VISIT_URL, VISIT_TITLE, join_visit_text, rebuild_user_rollups,
 )
-from .models import DashboardUser, DashboardRoleEnum, User, Visit
-from .utils import encrypt_secure_config, decrypt_secure_config
+from .models import DashboardUser, DashboardRoleEnum, User, Visit, UserRollup
+from .migrations import check_schema
+from .utils import encrypt_secure_config, decrypt_secure_config, encode_visit_cursor, decode_visit_cursor
+from .ingest import ingest_reports, ingest_reports_isolated, ingest_stats
+from .batching import ingest_batcher, IngestOverloaded, IngestStopped, INGEST_BATCH_ENABLED
+from .decoding import decode_report, decode_report_batch, ReportDecodeError
+from .usercache import user_cache
+from .admission import admission
+from .pacing import sync_advisor
+from .responsecache import response_cache, report_generations
+from .partitions import visit_partitions
+from .archive import visit_archive, visit_archiver, visit_filter
+from .rollups import rollup_compactor, activity_series, top_domains, QUEUE_ALL_DAYS, ROLLUP_TIMEZONE, TIMESERIES_MAX_DAYS
+from .streaming import ingest_ndjson, BodyEncodingError, StreamFormatError, UnsupportedEncoding
+from .export import export_visits, EXPORT_FORMATS
+from .search import search_visits, SEARCH_MAX_DAYS
+from .livefeed import live_feed
+from .dbstats import pool_stats, query_stats
+from .metrics import (
+    registry, metrics_writer, MetricsMiddleware, METRICS_ENABLED, METRICS_TOKEN, METRICS_ALLOW_ANONYMOUS,
+    ingest_reports as ingest_reports_metric, ingest_payload_bytes, logins, login_password_seconds,
+    secureconfig_fetches,
+)
+from .profiling import profiler, slow_queries, ProfilingMiddleware
 
 import uvicorn
 
 API_KEY = os.getenv("API_KEY", "your-secure-api-key-here")
+REPORT_BATCH_MAX_REPORTS = int(os.getenv("REPORT_BATCH_MAX_REPORTS", "500"))
+# Page size of /api/reports/all and /api/reports/user/{username} (default and largest allowed)
+REPORTS_PAGE_SIZE = int(os.getenv("REPORTS_PAGE_SIZE", "100"))
+REPORTS_PAGE_MAX = int(os.getenv("REPORTS_PAGE_MAX", "1000"))
 SESSION_SECRET = os.getenv("SESSION_SECRET", secrets.token_urlsafe(32))
 
 app = FastAPI(title="Browser Reporter Server")
 
+
+def _report_schemas() -> dict:
+    """ReportIn and its nested models as OpenAPI component schemas."""
+    schema = ReportIn.model_json_schema(ref_template="#/components/schemas/{model}")
+    return {**schema.pop("$defs", {}), "ReportIn": schema}
+
+
+def _openapi():
+    # Ingest endpoints read the raw body, so FastAPI does not see the report
+    # model; add it to the components the request body below refers to.
+    if app.openapi_schema is None:
+        schema = FastAPI.openapi(app)
+        schema.setdefault("components", {}).setdefault("schemas", {}).update(_report_schemas())
+    return app.openapi_schema
+
+
+app.openapi = _openapi
+
 # CORS (optional - you can restrict origins within LAN)
 app.add_middleware(
     CORSMiddleware,
@@ -45,6 +95,12 @@ app.add_middleware(
 # Session middleware for login state
 app.add_middleware(SessionMiddleware, secret_key=SESSION_SECRET, same_site="lax")
 
+app.add_middleware(ProfilingMiddleware)
+
+# Outermost, so it times whole requests
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
 # Static files & templates
 base_dir = os.path.dirname(os.path.abspath(__file__))
 app.mount("/static", StaticFiles(directory=os.path.join(base_dir, "static")), name="static")
@@ -74,6 +130,46 @@ async def require_admin(request: Request, db: AsyncSession) -> DashboardUser:
     return user
 
 
+async def require_ingest_access(request: Request):
+    """Authenticate and admit an ingest request before its body is read.
+
+    Ingest endpoints take no body parameters, so FastAPI resolves this
+    dependency before anything is parsed.
+    """
+    api_key = request.headers.get("X-API-Key") or ""
+    if not secrets.compare_digest(api_key.encode(), API_KEY.encode()):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    retry_after = admission.admit(api_key, request.headers.get("X-Computer-Name"))
+    if retry_after is not None:
+        raise HTTPException(
+            status_code=429,
+            detail="Too Many Requests",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+
+async def build_missing_rollups():
+    """Populate the rollup tables once for databases that predate them."""
+    async with engine.begin() as conn:
+        missing = await conn.scalar(text(
+            "SELECT NOT EXISTS (SELECT 1 FROM user_rollups) AND EXISTS (SELECT 1 FROM visits)"
+        ))
+        if missing:
+            print("⚙️  Building per-user rollups from existing visits...")
+            corrected = await rebuild_user_rollups(conn)
+            print(f"✅ Built rollups for {corrected} users")
+        missing_daily = await conn.scalar(text(
+            "SELECT NOT EXISTS (SELECT 1 FROM user_daily_rollups) "
+            "AND NOT EXISTS (SELECT 1 FROM user_daily_rollup_queue) AND EXISTS (SELECT 1 FROM visits)"
+        ))
+        if missing_daily:
+            # The compactor builds them in the background
+            for sql in QUEUE_ALL_DAYS:
+                await conn.execute(text(sql))
+            print("⚙️  Queued existing visit days for daily rollups")
+
+
 async def create_initial_admin():
     async with AsyncSessionLocal() as session:
         try:
@@ -97,21 +193,244 @@ async def create_initial_admin():
             pass
 
 
+def next_sync_seconds() -> int:
+    return sync_advisor.next_sync_seconds(ingest_batcher.queue_depth)
+
+
 # --------------------------- API Endpoints ------------------------------
 
-@app.post("/api/reports/data")
-async def ingest_report(report: ReportIn, request: Request, db: AsyncSession = Depends(get_db)):
-    # Check API key
-    api_key = request.headers.get("X-API-Key")
-    if api_key != API_KEY:
-        raise HTTPException(status_code=403, detail="Forbidden")
+@app.post(
+    "/api/reports/data",
+    dependencies=[Depends(require_ingest_access)],
+    openapi_extra={
+        "requestBody": {
+            "content": {"application/json": {"schema": {"$ref": "#/components/schemas/ReportIn"}}},
+            "required": True,
+        },
+    },
+)
+async def ingest_report(request: Request, db: AsyncSession = Depends(get_db)):
+    # Decode the raw body ourselves so INGEST_DECODER can pick the fast path
+    body = await request.body()
+    ingest_payload_bytes.observe(len(body), "data")
+    try:
+        report = decode_report(body)
+    except ReportDecodeError as exc:
+        raise HTTPException(status_code=422, detail=exc.errors)
 
-    user_id = await upsert_user(db, report.UserInfo)
-    await bulk_insert_visits(db, user_id, report.Visits)
-    await db.commit()
+    if INGEST_BATCH_ENABLED:
+        try:
+            await ingest_batcher.submit(report)
+        except IngestStopped:
+            raise HTTPException(status_code=503, detail="Server shutting down", headers={"Retry-After": "30"})
+        except IngestOverloaded:
+            raise HTTPException(status_code=503, detail="Ingest queue full", headers={"Retry-After": "30"})
+    else:
+        await ingest_reports(db, [report])
+    ingest_reports_metric.inc("data")
+    return {"success": True, "next_sync_seconds": next_sync_seconds()}
+
+
+@app.post("/api/reports/batch", dependencies=[Depends(require_ingest_access)])
+async def ingest_report_batch(request: Request):
+    """Ingest an array of reports (e.g. from a relay collector) in one transaction.
+
+    Each report is validated and, if the combined write fails, written on
+    its own, so the response carries a per-report result and only failed
+    reports need to be resent.
+    """
+    body = await request.body()
+    ingest_payload_bytes.observe(len(body), "batch")
+    try:
+        decoded = decode_report_batch(body)
+    except ReportDecodeError as exc:
+        raise HTTPException(status_code=422, detail=exc.errors)
+    if len(decoded) > REPORT_BATCH_MAX_REPORTS:
+        raise HTTPException(status_code=413, detail=f"At most {REPORT_BATCH_MAX_REPORTS} reports per batch")
+
+    results = [
+        {"index": i, "success": False, "error": item.errors}
+        if isinstance(item, ReportDecodeError) else None
+        for i, item in enumerate(decoded)
+    ]
+    valid = [(i, item) for i, item in enumerate(decoded) if results[i] is None]
+    if valid:
+        _, errors = await ingest_reports_isolated([report for _, report in valid])
+        logged = set()
+        for (i, _), exc in zip(valid, errors):
+            if exc is None:
+                results[i] = {"index": i, "success": True}
+            else:
+                # Database errors can carry schema details; collectors only need to resend
+                if id(exc) not in logged:
+                    logged.add(id(exc))
+                    print(f"⚠️  Batch report {i} failed: {exc!r}")
+                results[i] = {"index": i, "success": False, "error": "Report could not be stored"}
+
+    failed = sum(1 for r in results if not r["success"])
+    ingest_reports_metric.inc("batch", amount=len(results) - failed)
+    return {
+        "success": failed == 0,
+        "accepted": len(results) - failed,
+        "failed": failed,
+        "results": results,
+        "next_sync_seconds": next_sync_seconds(),
+    }
+
+
+@app.post("/api/reports/stream", dependencies=[Depends(require_ingest_access)])
+async def ingest_report_stream(request: Request):
+    """Ingest a (optionally gzip/zstd encoded) NDJSON report.
+
+    The first line is the UserInfo object, every following line one visit.
+    The body is decoded and written incrementally in bounded chunks.
+    """
+    received = 0
+
+    async def body():
+        nonlocal received
+        async for chunk in request.stream():
+            received += len(chunk)
+            yield chunk
+
+    try:
+        result = await ingest_ndjson(body(), request.headers.get("Content-Encoding", "identity"))
+    except UnsupportedEncoding as exc:
+        raise HTTPException(status_code=415, detail=str(exc))
+    except BodyEncodingError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    except StreamFormatError as exc:
+        raise HTTPException(status_code=422, detail={"message": str(exc), "line": exc.line})
+    finally:
+        ingest_payload_bytes.observe(received, "stream")
+    ingest_reports_metric.inc("stream")
+    return {"success": True, **result, "next_sync_seconds": next_sync_seconds()}
+
+
+@app.get("/api/admin/ingest/admission")
+async def admin_ingest_admission(request: Request, limit: int = 100, db: AsyncSession = Depends(get_db)):
+    """Admission control settings and current token bucket state (admin only)."""
+    await require_admin(request, db)
+    return admission.snapshot(limit)
+
+
+@app.get("/api/admin/ingest/stats")
+async def admin_ingest_stats(request: Request, db: AsyncSession = Depends(get_db)):
+    """Visit write throughput per ingest path (admin only)."""
+    await require_admin(request, db)
+    stats = ingest_stats.snapshot()
+    stats["batching"] = {
+        "enabled": INGEST_BATCH_ENABLED,
+        "queue_depth": ingest_batcher.queue_depth,
+        **ingest_batcher.stats.snapshot(),
+    }
+    stats["sync_pacing"] = sync_advisor.snapshot(ingest_batcher.queue_depth)
+    stats["daily_rollups"] = await rollup_compactor.snapshot(db)
+    stats["response_cache"] = response_cache.snapshot()
+    stats["partitions"] = visit_partitions.snapshot()
+    stats["archive"] = visit_archiver.snapshot()
+    stats["live_feed"] = live_feed.snapshot()
+    stats["database_pool"] = pool_stats.snapshot(engine.pool)
+    return stats
+
+
+@app.get("/api/admin/db/stats")
+async def admin_db_stats(
+    request: Request,
+    limit: int = Query(50, ge=1, le=500),
+    sort: str = Query("seconds", pattern="^(seconds|calls|mean|max)$"),
+    db: AsyncSession = Depends(get_db),
+):
+    """Connection pool state and statement timings by query shape for this process (admin only)."""
+    await require_admin(request, db)
+    return {
+        "pool": {
+            **pool_stats.snapshot(engine.pool),
+            "recycle_seconds": DB_POOL_RECYCLE,
+            "pre_ping": DB_POOL_PRE_PING,
+            "statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+        },
+        "queries": query_stats.snapshot(limit, sort),
+    }
+
+
+@app.delete("/api/admin/db/stats")
+async def admin_db_stats_reset(request: Request, db: AsyncSession = Depends(get_db)):
+    """Start the statement timings afresh (admin only)."""
+    await require_admin(request, db)
+    query_stats.reset()
     return {"success": True}
 
 
+@app.get("/api/admin/db/slow-queries")
+async def admin_db_slow_queries(request: Request, limit: int = Query(50, ge=1, le=1000), db: AsyncSession = Depends(get_db)):
+    """Recent statements slower than SLOW_QUERY_MS, newest first, with their plans (admin only)."""
+    await require_admin(request, db)
+    return slow_queries.snapshot(limit)
+
+
+@app.get("/api/admin/profiles")
+async def admin_profiles(request: Request, db: AsyncSession = Depends(get_db)):
+    """Recently profiled requests of this process, newest first (admin only)."""
+    await require_admin(request, db)
+    return profiler.list()
+
+
+@app.get("/api/admin/profiles/{profile_id}")
+async def admin_profile(
+    profile_id: int,
+    request: Request,
+    format: str = Query("json", pattern="^(json|collapsed)$"),
+    limit: int = Query(100, ge=1, le=10000),
+    db: AsyncSession = Depends(get_db),
+):
+    """One request profile: its SQL statements and sampled stacks (admin only).
+
+    ``format=collapsed`` returns the stacks as ``frame;frame;... count`` lines
+    for flame graph tools.
+    """
+    await require_admin(request, db)
+    profile = profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "collapsed":
+        return PlainTextResponse(profile.collapsed())
+    return profile.detail(limit)
+
+
+# ------------------------------ Metrics ---------------------------------
+
+# State kept by other modules, read when scraped
+registry.gauge("ingest_queue_reports", "Reports waiting in the ingest batch queue", lambda: {(): ingest_batcher.queue_depth})
+registry.gauge(
+    "db_pool_connections", "Database connections by state",
+    lambda: {("checked_out",): engine.pool.checkedout(), ("idle",): engine.pool.checkedin()}, ("state",),
+)
+registry.gauge("db_pool_waiting", "Requests waiting for a database connection", lambda: {(): pool_stats.waiting})
+registry.gauge("db_pool_checkouts_total", "Database connection checkouts", lambda: {(): pool_stats.checkouts}, kind="counter")
+registry.gauge(
+    "db_pool_wait_seconds_total", "Time spent waiting for database connections",
+    lambda: {(): pool_stats.wait_seconds}, kind="counter",
+)
+registry.gauge(
+    "db_pool_timeouts_total", "Checkouts that gave up waiting for a connection",
+    lambda: {(): pool_stats.timeouts}, kind="counter",
+)
+registry.gauge("live_feed_subscribers", "Open live activity streams", lambda: {(): live_feed.snapshot()["subscribers"]})
+
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    """Prometheus text format metrics, summed over all server processes sharing METRICS_DIR."""
+    if not METRICS_ENABLED or not (METRICS_TOKEN or METRICS_ALLOW_ANONYMOUS):
+        raise HTTPException(status_code=404)
+    if METRICS_TOKEN and not secrets.compare_digest(
+        request.headers.get("Authorization", "").encode(), f"Bearer {METRICS_TOKEN}".encode()
+    ):
+        raise HTTPException(status_code=401, detail="Unauthorized", headers={"WWW-Authenticate": "Bearer"})
+    return Response(await metrics_writer.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 # -------------------------- Auth & Dashboard ----------------------------
 
 @app.get("/login", response_class=HTMLResponse)
@@ -123,9 +442,16 @@ async def login_page(request: Request):
 async def login(request: Request, username: str = Form(...), password: str = Form(...), db: AsyncSession = Depends(get_db)):
     result = await db.execute(select(DashboardUser).where(DashboardUser.username == username))
     user: Optional[DashboardUser] = result.scalar_one_or_none()
-    if not user or not verify_password(password, user.password_hash):
+    valid = False
+    if user:
+        started = time.perf_counter()
+        valid = verify_password(password, user.password_hash)
+        login_password_seconds.observe(time.perf_counter() - started)
+    if not valid:
+        logins.inc("failure")
         return templates.TemplateResponse("login.html", {"request": request, "error": "Invalid credentials"})
 
+    logins.inc("success")
     request.session["dashboard_user"] = username
     response = RedirectResponse(url="/", status_code=302)
     return response
@@ -164,29 +490,91 @@ async def api_logout(request: Request):
     return {"success": True}
 
 
+# Sortable columns of /api/reports/all; missing rollups (no visits) sort as smallest
+REPORTS_ALL_SORT = {
+    "username": User.username,
+    "displayName": func.coalesce(User.display_name, User.username),
+    "department": User.homegroup,
+    "totalVisits": UserRollup.total_visits,
+    "uniqueUrls": UserRollup.unique_urls,
+    "lastActivity": UserRollup.last_activity,
+}
+
+
 @app.get("/api/reports/all")
-async def reports_all(db: AsyncSession = Depends(get_db), request: Request = None):
-    # Ensure logged in
-    if request is not None:
-        require_login(request)
+async def reports_all(
+    request: Request,
+    homegroup: Optional[str] = None,
+    active_days: Optional[int] = Query(None, ge=1),
+    search: Optional[str] = None,
+    sort: str = Query("username", pattern="^(" + "|".join(REPORTS_ALL_SORT) + ")$"),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    limit: int = Query(REPORTS_PAGE_SIZE, ge=1, le=REPORTS_PAGE_MAX),
+    offset: int = Query(0, ge=0),
+    paged: bool = False,
+    db: AsyncSession = Depends(get_db),
+):
+    """Per-user totals of the users matching the filters.
+
+    Without ``paged`` this is the bare list of every matching user, as
+    existing clients expect. With ``paged=true`` it is one page,
+    ``{"items": [...], "total", "limit", "offset"}``.
+    ``search`` is a substring of username, display name, email or homegroup;
+    ``active_days`` keeps users with a visit in the last N days.
+    """
+    require_login(request)
+    if not paged:
+        limit, offset = None, 0
+    params = {
+        "homegroup": homegroup, "active_days": active_days, "search": search,
+        "sort": sort, "order": order, "limit": limit, "offset": offset,
+    }
+    return await response_cache.respond(
+        request, "reports_all", params, report_generations.fleet,
+        lambda: _reports_all_page(db, **params),
+    )
 
-    # Use SQLAlchemy query instead of raw SQL
+
+async def _reports_all_page(
+    db: AsyncSession, homegroup: Optional[str], active_days: Optional[int], search: Optional[str],
+    sort: str, order: str, limit: Optional[int], offset: int,
+):
+    """One page of reports_all, or every matching user as a list when *limit* is None."""
+    conditions = []
+    if homegroup:
+        conditions.append(User.homegroup == homegroup)
+    if active_days:
+        conditions.append(UserRollup.last_activity >= datetime.now(timezone.utc) - timedelta(days=active_days))
+    if search:
+        conditions.append(or_(
+            User.username.icontains(search, autoescape=True),
+            User.display_name.icontains(search, autoescape=True),
+            User.email.icontains(search, autoescape=True),
+            User.homegroup.icontains(search, autoescape=True),
+        ))
+
+    # Per-user totals come from the incrementally maintained rollup table
+    sort_column = REPORTS_ALL_SORT[sort]
+    ordering = sort_column.desc().nullslast() if order == "desc" else sort_column.asc().nullsfirst()
     query = (
         select(
             User.username,
             func.coalesce(User.display_name, User.username).label("display_name"),
             User.email,
             User.homegroup.label("department"),
-            func.count(Visit.id).label("total_visits"),
-            func.count(func.distinct(Visit.url)).label("unique_urls"),
-            func.max(Visit.visit_time).label("last_activity"),
-            func.string_agg(func.distinct(Visit.computer_name), text("', '")).label("computers")
+            func.coalesce(UserRollup.total_visits, 0).label("total_visits"),
+            func.coalesce(UserRollup.unique_urls, 0).label("unique_urls"),
+            UserRollup.last_activity,
+            func.array_to_string(UserRollup.computers, ", ").label("computers"),
         )
         .select_from(User)
-        .outerjoin(Visit, Visit.user_id == User.id)
-        .group_by(User.id)
+        .outerjoin(UserRollup, UserRollup.user_id == User.id)
+        .where(*conditions)
+        .order_by(ordering, User.username)
+        .limit(limit)
+        .offset(offset)
     )
-    
+
     result = await db.execute(query)
     rows = result.fetchall()
     data = []
@@ -201,12 +589,75 @@ async def reports_all(db: AsyncSession = Depends(get_db), request: Request = Non
             "lastActivity": r.last_activity.isoformat() if r.last_activity else None,
             "computers": r.computers,
         })
-    return data
+    if limit is None:
+        return data
+
+    total = (await db.execute(
+        select(func.count()).select_from(User).outerjoin(UserRollup, UserRollup.user_id == User.id).where(*conditions)
+    )).scalar_one()
+    return {"items": data, "total": total, "limit": limit, "offset": offset}
+
+
+@app.get("/api/reports/homegroups")
+async def reports_homegroups(request: Request, db: AsyncSession = Depends(get_db)):
+    """Homegroups with their number of users, for the dashboard filter."""
+    require_login(request)
+
+    async def homegroups():
+        result = await db.execute(
+            select(User.homegroup, func.count())
+            .where(User.homegroup.isnot(None), User.homegroup != "")
+            .group_by(User.homegroup)
+            .order_by(User.homegroup)
+        )
+        return [{"homegroup": homegroup, "users": users} for homegroup, users in result.all()]
+
+    return await response_cache.respond(request, "reports_homegroups", {}, report_generations.fleet, homegroups)
 
 
 @app.get("/api/reports/user/{username}")
-async def reports_user(username: str, request: Request, days: int | None = None, db: AsyncSession = Depends(get_db)):
+async def reports_user(
+    username: str,
+    request: Request,
+    days: int | None = None,
+    limit: int = Query(REPORTS_PAGE_SIZE, ge=1, le=REPORTS_PAGE_MAX),
+    cursor: Optional[str] = None,
+    q: Optional[str] = None,
+    url: Optional[str] = None,
+    title: Optional[str] = None,
+    computer: Optional[str] = None,
+    include_archived: bool = False,
+    paged: bool = False,
+    db: AsyncSession = Depends(get_db),
+):
+    """A user's visits, newest first.
+
+    Without ``paged`` this is the bare list of every matching visit, as
+    existing clients expect. With ``paged=true`` it is one page,
+    ``{"items": [...], "nextCursor": ...}``, keyed on (visit_time, id):
+    pass the returned ``nextCursor`` as ``cursor`` to get the next page.
+    ``url`` / ``title`` are substring filters, ``q`` matches either,
+    ``computer`` is an exact computer name. ``include_archived`` continues
+    into visits moved to the cold archive.
+    """
     require_login(request)
+    if not paged:
+        limit, cursor = None, None
+    params = {
+        "username": username, "days": days, "limit": limit, "cursor": cursor,
+        "q": q, "url": url, "title": title, "computer": computer, "include_archived": include_archived,
+    }
+    return await response_cache.respond(
+        request, "reports_user", params, report_generations.user(username),
+        lambda: _reports_user_page(db, **params),
+    )
+
+
+async def _reports_user_page(
+    db: AsyncSession, username: str, days: Optional[int], limit: Optional[int], cursor: Optional[str],
+    q: Optional[str], url: Optional[str], title: Optional[str], computer: Optional[str], include_archived: bool,
+):
+    """One page of reports_user, or every matching visit as a list when *limit* is None."""
     # Get user id
     result = await db.execute(select(User.id).where(User.username == username))
     user_id_row = result.scalar_one_or_none()
@@ -214,16 +665,59 @@ async def reports_user(username: str, request: Request, days: int | None = None,
         raise HTTPException(status_code=404, detail="User not found")
     user_id = user_id_row
 
-    query = select(Visit).where(Visit.user_id == user_id)
+    query = join_visit_text(
+        select(
+            Visit.id,
+            Visit.visit_time,
+            VISIT_TITLE.label("title"),
+            VISIT_URL.label("url"),
+            Visit.computer_name,
+        )
+    ).where(Visit.user_id == user_id)
+    cutoff = after = None
     if days:
         cutoff = datetime.now(timezone.utc) - timedelta(days=days)
         query = query.where(Visit.visit_time >= cutoff)
-    query = query.order_by(Visit.visit_time.desc())
-
-    result = await db.execute(query)
-    visits = result.scalars().all()
-
-    return [
+    if cursor:
+        try:
+            after_time, after_id = decode_visit_cursor(cursor)
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=str(exc))
+        after = (after_time, after_id)
+        query = query.where(tuple_(Visit.visit_time, Visit.id) < tuple_(after_time, after_id))
+    if q:
+        query = query.where(or_(VISIT_URL.icontains(q, autoescape=True), VISIT_TITLE.icontains(q, autoescape=True)))
+    if url:
+        query = query.where(VISIT_URL.icontains(url, autoescape=True))
+    if title:
+        query = query.where(VISIT_TITLE.icontains(title, autoescape=True))
+    if computer:
+        query = query.where(Visit.computer_name == computer)
+    # Matches ix_visits_user_time, so a page stops after limit + 1 rows
+    query = query.order_by(Visit.visit_time.desc(), Visit.id.desc())
+    fetch = None if limit is None else limit + 1
+    if fetch is not None:
+        query = query.limit(fetch)
+
+    visits = (await db.execute(query)).all()
+    if include_archived:
+        # The archive only holds visits older than those left in Postgres,
+        # so it is read when this page reaches past the newest archived one
+        newest = visit_archive.newest()
+        if newest is not None and (fetch is None or len(visits) < fetch or visits[-1].visit_time <= newest):
+            archived = await asyncio.to_thread(
+                visit_archive.user_visits, username, after, cutoff, fetch,
+                visit_filter(q, url, title, computer),
+            )
+            merged = {v.id: v for v in archived}
+            merged.update((v.id, v) for v in visits)
+            visits = sorted(merged.values(), key=lambda v: (v.visit_time, v.id), reverse=True)[:fetch]
+    next_cursor = None
+    if limit is not None and len(visits) > limit:
+        visits = visits[:limit]
+        next_cursor = encode_visit_cursor(visits[-1].visit_time, visits[-1].id)
+
+    items = [
         {
             "timestamp": v.visit_time.isoformat(),
             "title": v.title,
@@ -232,6 +726,168 @@ async def reports_user(username: str, request: Request, days: int | None = None,
         }
         for v in visits
     ]
+    if limit is None:
+        return items
+    return {"items": items, "nextCursor": next_cursor}
+
+
+@app.get("/api/reports/user/{username}/export")
+async def reports_user_export(
+    username: str,
+    request: Request,
+    format: str = Query("ndjson", pattern="^(" + "|".join(EXPORT_FORMATS) + ")$"),
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """Download a user's visits, oldest first, as NDJSON or CSV.
+
+    ``start`` / ``end`` are inclusive calendar days in ROLLUP_TIMEZONE. The
+    file is streamed, so exports of any size use constant server memory.
+    """
+    require_login(request)
+    user_id = (await db.execute(select(User.id).where(User.username == username))).scalar_one_or_none()
+    if user_id is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    if start and end and end < start:
+        raise HTTPException(status_code=400, detail="end is before start")
+
+    zone = ZoneInfo(ROLLUP_TIMEZONE)
+    since = datetime.combine(start, datetime.min.time(), zone) if start else None
+    until = datetime.combine(end + timedelta(days=1), datetime.min.time(), zone) if end else None
+    filename = re.sub(r"[^A-Za-z0-9._-]", "_", username) + f"-visits.{format}"
+    return StreamingResponse(
+        export_visits(user_id, format, since, until),
+        media_type=EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.get("/api/reports/timeseries")
+async def reports_timeseries(
+    request: Request,
+    bucket: str = Query("day", pattern="^(day|week)$"),
+    days: int = Query(30, ge=1, le=TIMESERIES_MAX_DAYS),
+    username: Optional[str] = None,
+    homegroup: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """Daily or weekly activity for a user, a homegroup or (by default) the fleet.
+
+    Served from the daily rollups, which trail ingest by up to
+    ROLLUP_COMPACT_SECONDS.
+    """
+    require_login(request)
+    user_id = None
+    if username:
+        user_id = (await db.execute(select(User.id).where(User.username == username))).scalar_one_or_none()
+        if user_id is None:
+            raise HTTPException(status_code=404, detail="User not found")
+
+    end = datetime.now(ZoneInfo(ROLLUP_TIMEZONE)).date()
+    start = end - timedelta(days=days - 1)
+    points = await activity_series(db, start, end, bucket, user_id=user_id, homegroup=homegroup or None)
+    return {
+        "scope": "user" if user_id is not None else "homegroup" if homegroup else "fleet",
+        "bucket": bucket,
+        "timezone": ROLLUP_TIMEZONE,
+        "points": points,
+    }
+
+
+@app.get("/api/reports/domains")
+async def reports_domains(
+    request: Request,
+    days: int = Query(30, ge=1, le=TIMESERIES_MAX_DAYS),
+    limit: int = Query(10, ge=1, le=REPORTS_PAGE_MAX),
+    username: Optional[str] = None,
+    homegroup: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """Most visited domains over the last N days for a user, a homegroup or the fleet.
+
+    Served from the per-domain daily rollups, which trail ingest by up to
+    ROLLUP_COMPACT_SECONDS.
+    """
+    require_login(request)
+    user_id = None
+    if username:
+        user_id = (await db.execute(select(User.id).where(User.username == username))).scalar_one_or_none()
+        if user_id is None:
+            raise HTTPException(status_code=404, detail="User not found")
+
+    end = datetime.now(ZoneInfo(ROLLUP_TIMEZONE)).date()
+    start = end - timedelta(days=days - 1)
+    domains = await top_domains(db, start, end, limit, user_id=user_id, homegroup=homegroup or None)
+    return {
+        "scope": "user" if user_id is not None else "homegroup" if homegroup else "fleet",
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "timezone": ROLLUP_TIMEZONE,
+        "domains": domains,
+    }
+
+
+@app.get("/api/reports/live")
+async def reports_live(request: Request, homegroup: Optional[str] = None):
+    """Server-Sent Events: an ``activity`` event each time ingest stores a user's visits.
+
+    Events carry ``username``, ``homegroup``, ``visits`` (reported in that
+    write), ``lastVisit`` and ``computerName``; ``homegroup`` filters them.
+    """
+    require_login(request)
+    if live_feed.full:
+        raise HTTPException(status_code=503, detail="Too many live feed subscribers")
+    return StreamingResponse(
+        live_feed.stream(homegroup or None, request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/api/reports/search")
+async def reports_search(
+    request: Request,
+    q: str = Query(..., min_length=1),
+    days: int = Query(7, ge=1, le=SEARCH_MAX_DAYS),
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    homegroup: Optional[str] = None,
+    limit: int = Query(REPORTS_PAGE_SIZE, ge=1, le=REPORTS_PAGE_MAX),
+    offset: int = Query(0, ge=0),
+    db: AsyncSession = Depends(get_db),
+):
+    """Visits across the fleet whose title or URL match ``q``, best match first.
+
+    ``q`` takes web-search syntax (``"quoted phrase"``, ``or``, ``-word``).
+    The range is the last ``days`` days, or ``start`` / ``end`` inclusive
+    calendar days in ROLLUP_TIMEZONE, at most SEARCH_MAX_DAYS long.
+    """
+    require_login(request)
+    zone = ZoneInfo(ROLLUP_TIMEZONE)
+    if end is None:
+        end = datetime.now(zone).date()
+    if start is None:
+        start = end - timedelta(days=days - 1)
+    if end < start:
+        raise HTTPException(status_code=400, detail="end is before start")
+    if (end - start).days >= SEARCH_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Search at most {SEARCH_MAX_DAYS} days at a time")
+
+    params = {
+        "q": q, "start": start, "end": end, "homegroup": homegroup or None, "limit": limit, "offset": offset,
+    }
+
+    async def search():
+        page = await search_visits(
+            db, q,
+            since=datetime.combine(start, datetime.min.time(), zone),
+            until=datetime.combine(end + timedelta(days=1), datetime.min.time(), zone),
+            limit=limit, offset=offset, homegroup=homegroup or None,
+        )
+        return {"query": q, "start": start.isoformat(), "end": end.isoformat(), "timezone": ROLLUP_TIMEZONE, **page}
+
+    return await response_cache.respond(request, "reports_search", params, report_generations.fleet, search)
 
 
 # Admin Management API Endpoints -------------------------------------
@@ -450,11 +1106,34 @@ async def root_redirect(request: Request):
 
 @app.on_event("startup")
 async def on_startup():
-    # Create tables
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    # Migrations run separately (`manage migrate`); refuse to serve an older schema
+    await check_schema()
+    # Partitions must exist before the first visit is written
+    await visit_partitions.maintain()
+    if not visit_partitions.partitioned:
+        print("⚠️  visits is not partitioned; run `python -m backend.manage partition-visits` to enable retention")
+    await build_missing_rollups()
     # ensure initial admin exists
     await create_initial_admin()
+    load_sync_interval()
+    if INGEST_BATCH_ENABLED:
+        ingest_batcher.start()
+    user_cache.start()
+    rollup_compactor.start()
+    visit_partitions.start()
+    visit_archiver.start()
+    metrics_writer.start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    # Flush reports still waiting in the batch window, then pending last_seen_at bumps
+    await ingest_batcher.stop()
+    await user_cache.stop()
+    await rollup_compactor.stop()
+    await visit_partitions.stop()
+    await visit_archiver.stop()
+    await metrics_writer.stop()
 
 
 # -------------------------- Secure Config -------------------------------
@@ -475,6 +1154,7 @@ async def admin_generate_secureconfig(
     await require_admin(request, db)
 
     encrypted = encrypt_secure_config(plain_config)
+    sync_advisor.configure(plain_config.get("sync_interval_minutes"))
 
     # Persist to disk so that the Windows collector can fetch it via GET /secureconfig.json
     try:
@@ -544,11 +1224,32 @@ async def download_secureconfig():
 
     No auth on purpose – the Windows collector expects to fetch it anonymously.
     You may wrap this with auth/IP restrictions if desired.
+
+    The server's current ``next_sync_seconds`` advice is added next to the
+    encrypted payload, so the checksum of the config itself is unaffected.
     """
     if not os.path.exists(SECURECONFIG_PATH):
+        secureconfig_fetches.inc("404")
         raise HTTPException(status_code=404, detail="secureconfig.json not found. Generate it first via the admin panel.")
 
-    return FileResponse(SECURECONFIG_PATH, media_type="application/json")
+    secureconfig_fetches.inc("200")
+    import json
+    with open(SECURECONFIG_PATH, "r", encoding="utf-8") as f:
+        envelope = json.load(f)
+    envelope["next_sync_seconds"] = next_sync_seconds()
+    return JSONResponse(envelope, headers={"Cache-Control": "no-store"})
+
+
+def load_sync_interval():
+    """Use the saved secure config's sync interval as the advised base delay."""
+    if not os.path.exists(SECURECONFIG_PATH):
+        return
+    try:
+        import json
+        with open(SECURECONFIG_PATH, "r", encoding="utf-8") as f:
+            sync_advisor.configure(decrypt_secure_config(json.load(f)).get("sync_interval_minutes"))
+    except Exception as e:
+        print(f"⚠️  Could not read sync interval from secureconfig.json: {e}")
 
 
 if __name__ == "__main__":
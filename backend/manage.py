@@ -0,0 +1,343 @@
+"""Management commands for Browser Reporter.
+
+Usage:
+    python -m backend.manage <command> [options]
+
+Run with the same DATABASE_URL as the server.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+
+from sqlalchemy import text
+
+from .archive import VISIT_ARCHIVE_AFTER_MONTHS, visit_archiver
+from .crud import rebuild_user_rollups, url_domain
+from .database import engine
+from .migrations import LATEST_VERSION, check_schema, current_version, migrate
+from .models import Visit
+from .partitions import (
+    DEFAULT_PARTITION, VISIT_PARTITION_MONTHS_AHEAD, add_months, current_month, ensure_partitions,
+    is_partitioned, month_start,
+)
+from .rollups import QUEUE_ALL_DAYS, local_day_sql, rollup_compactor
+from .search import VISIT_SEARCH_DDL
+
+
+# ------------------------------ migrate --------------------------------
+
+async def run_migrations():
+    async with engine.connect() as conn:
+        version = await current_version(conn)
+    applied = await migrate()
+    if applied:
+        print(f"✅ Applied {applied} migrations (schema version {version} -> {LATEST_VERSION})")
+    else:
+        print(f"✅ Schema is up to date (version {LATEST_VERSION})")
+
+
+# --------------------------- intern-visits -----------------------------
+
+_INTERN_URLS = text("""
+INSERT INTO visit_urls (url_hash, url)
+SELECT DISTINCT decode(md5(url), 'hex'), url FROM visits
+WHERE id BETWEEN :lo AND :hi AND url_id IS NULL AND url IS NOT NULL
+ON CONFLICT (url_hash) DO NOTHING
+""")
+
+_INTERN_TITLES = text("""
+INSERT INTO visit_titles (title_hash, title)
+SELECT DISTINCT decode(md5(title), 'hex'), title FROM visits
+WHERE id BETWEEN :lo AND :hi AND url_id IS NULL AND title IS NOT NULL
+ON CONFLICT (title_hash) DO NOTHING
+""")
+
+# Text and interned rows have separate unique keys, so a visit resent while
+# storage was being switched can exist in both forms. The text copy is
+# deleted (and taken out of the rollups) rather than converted into a
+# duplicate of the interned key.
+_DROP_INTERNED_TWINS = text(f"""
+WITH dropped AS (
+    DELETE FROM visits v
+    USING visit_urls u, visits i
+    WHERE v.id BETWEEN :lo AND :hi
+      AND v.url_id IS NULL
+      AND u.url_hash = decode(md5(v.url), 'hex')
+      AND i.user_id = v.user_id AND i.visit_time = v.visit_time AND i.url_id = u.id
+    RETURNING v.user_id, v.visit_time
+), counted AS (
+    UPDATE user_rollups r SET total_visits = r.total_visits - d.visits
+    FROM (SELECT user_id, count(*) AS visits FROM dropped GROUP BY user_id) d
+    WHERE r.user_id = d.user_id
+), queued_days AS (
+    INSERT INTO user_daily_rollup_queue (user_id, day)
+    SELECT DISTINCT user_id, {local_day_sql("visit_time")} FROM dropped
+    ON CONFLICT (user_id, day) DO UPDATE SET day = EXCLUDED.day
+)
+SELECT count(*) FROM dropped
+""")
+
+_INTERN_VISITS = text("""
+UPDATE visits v
+SET url_id = u.id,
+    title_id = (SELECT t.id FROM visit_titles t WHERE t.title_hash = decode(md5(v.title), 'hex')),
+    url = NULL,
+    title = NULL
+FROM visit_urls u
+WHERE v.id BETWEEN :lo AND :hi
+  AND v.url_id IS NULL
+  AND u.url_hash = decode(md5(v.url), 'hex')
+""")
+
+
+async def intern_visits(batch_size: int):
+    """Move url/title text of existing visits into the dictionary tables.
+
+    Run after every server process uses VISIT_STORAGE=interned, so no new
+    text rows arrive meanwhile; visits already resent in interned form are
+    removed instead of converted.
+    """
+    await check_schema()
+    async with engine.connect() as conn:
+        bounds = (await conn.execute(text("SELECT min(id), max(id) FROM visits WHERE url_id IS NULL"))).one()
+    if bounds[0] is None:
+        print("✅ No text-stored visits to convert")
+        return
+
+    lo, last = bounds
+    converted = 0
+    duplicates = 0
+    while lo <= last:
+        hi = lo + batch_size - 1
+        # One transaction per id range keeps locks and WAL bursts short
+        async with engine.begin() as conn:
+            params = {"lo": lo, "hi": hi}
+            await conn.execute(_INTERN_URLS, params)
+            await conn.execute(_INTERN_TITLES, params)
+            duplicates += await conn.scalar(_DROP_INTERNED_TWINS, params)
+            result = await conn.execute(_INTERN_VISITS, params)
+            converted += result.rowcount
+        print(f"   ids {lo}-{hi}: {converted} visits converted, {duplicates} duplicates removed")
+        lo = hi + 1
+    print(f"✅ Interned {converted} visits and removed {duplicates} stored twice")
+
+
+# -------------------------- rebuild-rollups ----------------------------
+
+async def rebuild_rollups():
+    """Reconcile the per-user and daily rollups with the visits table."""
+    await check_schema()
+    # One transaction: ingest waits on the rollup locks, so nothing written
+    # meanwhile is lost or counted twice.
+    async with engine.begin() as conn:
+        corrected = await rebuild_user_rollups(conn)
+        users = await conn.scalar(text("SELECT count(*) FROM user_rollups"))
+    print(f"✅ Rollups rebuilt for {users} users ({corrected} corrected)")
+
+    async with engine.begin() as conn:
+        for sql in QUEUE_ALL_DAYS:
+            await conn.execute(text(sql))
+    days = await rollup_compactor.compact_all()
+    print(f"✅ Daily rollups recomputed for {days} user-days")
+
+
+# -------------------------- backfill-domains ---------------------------
+
+_VISITS_WITHOUT_DOMAIN = text("""
+SELECT v.id, coalesce(v.url, u.url) AS url
+FROM visits v LEFT JOIN visit_urls u ON u.id = v.url_id
+WHERE v.id BETWEEN :lo AND :hi AND v.domain IS NULL
+""")
+
+_SET_DOMAINS = text("""
+UPDATE visits v SET domain = d.domain
+FROM unnest(CAST(:ids AS bigint[]), CAST(:domains AS varchar[])) AS d(id, domain)
+WHERE v.id = d.id
+""")
+
+
+async def backfill_domains(batch_size: int):
+    """Fill visits.domain for visits stored before it was extracted at ingest."""
+    await check_schema()
+    async with engine.connect() as conn:
+        bounds = (await conn.execute(text("SELECT min(id), max(id) FROM visits WHERE domain IS NULL"))).one()
+    if bounds[0] is None:
+        print("✅ Every visit already has its domain")
+        return
+
+    lo, last = bounds
+    updated = 0
+    while lo <= last:
+        hi = lo + batch_size - 1
+        # Domains are extracted in Python so they match crud.url_domain exactly
+        async with engine.begin() as conn:
+            rows = (await conn.execute(_VISITS_WITHOUT_DOMAIN, {"lo": lo, "hi": hi})).all()
+            found = [(row.id, url_domain(row.url)) for row in rows]
+            found = [(visit_id, domain) for visit_id, domain in found if domain]
+            if found:
+                ids, domains = (list(col) for col in zip(*found))
+                await conn.execute(_SET_DOMAINS, {"ids": ids, "domains": domains})
+            updated += len(found)
+        print(f"   ids {lo}-{hi}: {updated} visits updated")
+        lo = hi + 1
+
+    async with engine.begin() as conn:
+        for sql in QUEUE_ALL_DAYS:
+            await conn.execute(text(sql))
+    days = await rollup_compactor.compact_all()
+    print(f"✅ Backfilled domains of {updated} visits and recomputed {days} user-days")
+
+
+# --------------------------- backfill-search ---------------------------
+
+_SET_SEARCH_VECTORS = text("""
+UPDATE visits v
+SET search_vector = visit_search_vector(
+    coalesce(v.title, (SELECT title FROM visit_titles WHERE id = v.title_id)),
+    coalesce(v.url, (SELECT url FROM visit_urls WHERE id = v.url_id))
+)
+WHERE v.id BETWEEN :lo AND :hi AND v.search_vector IS NULL
+""")
+
+
+async def backfill_search(batch_size: int):
+    """Fill visits.search_vector for visits stored before full-text search existed."""
+    await check_schema()
+    async with engine.connect() as conn:
+        bounds = (await conn.execute(text("SELECT min(id), max(id) FROM visits WHERE search_vector IS NULL"))).one()
+    if bounds[0] is None:
+        print("✅ Every visit is already searchable")
+        return
+
+    lo, last = bounds
+    updated = 0
+    while lo <= last:
+        hi = lo + batch_size - 1
+        async with engine.begin() as conn:
+            updated += (await conn.execute(_SET_SEARCH_VECTORS, {"lo": lo, "hi": hi})).rowcount
+        print(f"   ids {lo}-{hi}: {updated} visits updated")
+        lo = hi + 1
+    print(f"✅ Indexed {updated} visits for search")
+
+
+# -------------------------- partition-visits ---------------------------
+
+async def partition_visits():
+    """Convert an existing visits table into monthly partitions.
+
+    Runs in one transaction holding an exclusive lock on visits, so ingest
+    and reports wait until it finishes; stop collectors or expect retries.
+    """
+    await check_schema()
+    columns = ", ".join(c.name for c in Visit.__table__.columns)
+    async with engine.begin() as conn:
+        if await is_partitioned(conn):
+            print("✅ visits is already partitioned")
+            return
+        await conn.execute(text("LOCK TABLE visits IN ACCESS EXCLUSIVE MODE"))
+        oldest = await conn.scalar(text("SELECT min(visit_time) FROM visits"))
+
+        # Keep the old table's names free for the partitioned one
+        indexes = (await conn.execute(text("SELECT indexname FROM pg_indexes WHERE tablename = 'visits'"))).scalars().all()
+        for name in indexes:
+            await conn.execute(text(f'ALTER INDEX "{name}" RENAME TO "{name}_unpartitioned"'))
+        await conn.execute(text("ALTER TABLE visits RENAME TO visits_unpartitioned"))
+        await conn.execute(text("ALTER SEQUENCE visits_id_seq RENAME TO visits_unpartitioned_id_seq"))
+        await conn.run_sync(Visit.__table__.create)
+        for ddl in VISIT_SEARCH_DDL:
+            await conn.execute(text(ddl))
+
+        last = add_months(current_month(), VISIT_PARTITION_MONTHS_AHEAD)
+        month = oldest.date().replace(day=1) if oldest else current_month()
+        # The local month of the oldest visit may start a month earlier
+        month = add_months(month, -1)
+        await ensure_partitions(conn, month, last)
+        moved = 0
+        while month <= last:
+            result = await conn.execute(text(
+                f"INSERT INTO visits ({columns}) SELECT {columns} FROM visits_unpartitioned "
+                "WHERE visit_time >= :lo AND visit_time < :hi"
+            ), {"lo": month_start(month), "hi": month_start(add_months(month, 1))})
+            moved += result.rowcount
+            if result.rowcount:
+                print(f"   {month:%Y-%m}: {result.rowcount} visits")
+            month = add_months(month, 1)
+        result = await conn.execute(text(
+            f"INSERT INTO visits ({columns}) SELECT {columns} FROM visits_unpartitioned WHERE visit_time >= :hi"
+        ), {"hi": month_start(month)})
+        if result.rowcount:
+            print(f"   {DEFAULT_PARTITION}: {result.rowcount} visits dated after {month:%Y-%m}")
+        moved += result.rowcount
+
+        await conn.execute(text("SELECT setval('visits_id_seq', (SELECT coalesce(max(id), 0) + 1 FROM visits), false)"))
+        await conn.execute(text("DROP TABLE visits_unpartitioned"))
+    async with engine.connect() as conn:
+        await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("ANALYZE visits"))
+    print(f"✅ Moved {moved} visits into monthly partitions")
+
+
+# --------------------------- archive-visits ----------------------------
+
+async def archive_visits(after_months: int):
+    async with engine.begin() as conn:
+        if not await is_partitioned(conn):
+            print("⚠️  visits is not partitioned; run partition-visits first")
+            return
+    archived = await visit_archiver.archive_expired(after_months)
+    print(f"✅ Archived {archived} visits older than {after_months} months to {visit_archiver.archive.directory}")
+
+
+# ------------------------------ main -----------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m backend.manage", description="Browser Reporter management commands")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sub.add_parser("migrate", help="apply pending schema migrations (indexes are built without locking writes)")
+
+    intern = sub.add_parser("intern-visits", help="convert stored visits to interned url/title storage")
+    intern.add_argument("--batch-size", type=int, default=50000, help="visit ids per transaction")
+
+    sub.add_parser("rebuild-rollups", help="recompute per-user report rollups from visits")
+
+    sub.add_parser("partition-visits", help="convert the visits table to monthly partitions (locks visits while it runs)")
+
+    domains = sub.add_parser("backfill-domains", help="extract the domain of visits stored without one")
+    domains.add_argument("--batch-size", type=int, default=50000, help="visit ids per transaction")
+
+    archive = sub.add_parser("archive-visits", help="move old visit months to the compressed file archive")
+    archive.add_argument(
+        "--after-months", type=int, default=VISIT_ARCHIVE_AFTER_MONTHS or 12, help="whole months kept in the database"
+    )
+
+    search = sub.add_parser("backfill-search", help="index visits stored before full-text search for /api/reports/search")
+    search.add_argument("--batch-size", type=int, default=50000, help="visit ids per transaction")
+
+    args = parser.parse_args(argv)
+
+    async def run():
+        try:
+            if args.command == "migrate":
+                await run_migrations()
+            elif args.command == "intern-visits":
+                await intern_visits(args.batch_size)
+            elif args.command == "rebuild-rollups":
+                await rebuild_rollups()
+            elif args.command == "backfill-search":
+                await backfill_search(args.batch_size)
+            elif args.command == "partition-visits":
+                await partition_visits()
+            elif args.command == "backfill-domains":
+                await backfill_domains(args.batch_size)
+            elif args.command == "archive-visits":
+                await archive_visits(args.after_months)
+        finally:
+            await engine.dispose()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
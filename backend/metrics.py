@@ -0,0 +1,367 @@
+from __future__ import annotations
+
+import asyncio
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Counters are plain per-process dicts updated on the event loop, so
+# recording a value takes no lock. With several server processes each one
+# writes its values to METRICS_DIR, and /metrics adds up every process's
+# file, so a scrape served by any worker covers the whole server. Like
+# prometheus_client's multiprocess mode, the counters and histograms of
+# workers that exit are kept in one file, so totals never go backwards;
+# their gauges are dropped.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "5"))
+# Bearer token /metrics requires. Without one /metrics is not served unless
+# METRICS_ALLOW_ANONYMOUS is set, for scrapers on a network that is
+# already restricted.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_ALLOW_ANONYMOUS = os.getenv("METRICS_ALLOW_ANONYMOUS", "false").lower() in ("1", "true", "yes")
+
+_RETIRED = "retired.json"
+_LOCK = "metrics.lock"
+
+PREFIX = "browser_reporter_"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+ROWS_BUCKETS = (0, 1, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def state(self) -> List[list]:
+        return [[list(labels), value] for labels, value in self.values.items()]
+
+    @staticmethod
+    def merge(total, value):
+        return (total or 0) + value
+
+    def render(self, values: Dict[Labels, object]) -> Iterable[str]:
+        for labels, value in values.items():
+            yield f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    """A value read when scraped; *collect* returns it per label tuple.
+
+    Totals kept by other modules' stats are exposed the same way, as
+    ``kind="counter"``.
+    """
+
+    def __init__(
+        self, name: str, help: str, collect: Callable[[], Dict[Labels, float]], labels: Sequence[str] = (),
+        kind: str = "gauge",
+    ):
+        super().__init__(name, help, labels)
+        self.collect = collect
+        self.kind = kind
+
+    def state(self) -> List[list]:
+        return [[list(labels), value] for labels, value in self.collect().items()]
+
+
+class Histogram:
+    """Observations counted into fixed buckets; each series is [count per bucket..., +Inf count, sum]."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float], labels: Sequence[str] = ()):
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values: Dict[Labels, list] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def state(self) -> List[list]:
+        return [[list(labels), list(series)] for labels, series in self.values.items()]
+
+    @staticmethod
+    def merge(total, series):
+        if total is None:
+            return list(series)
+        return [a + b for a, b in zip(total, series)]
+
+    def render(self, values: Dict[Labels, object]) -> Iterable[str]:
+        for labels, series in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = 'le="' + _format_value(float(bound)) + '"'
+                yield f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(series[-1])}"
+            yield f"{self.name}_count{_format_labels(self.labels, labels)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float], labels: Sequence[str] = ()) -> Histogram:
+        return self.register(Histogram(name, help, buckets, labels))
+
+    def gauge(self, name: str, help: str, collect, labels: Sequence[str] = (), kind: str = "gauge") -> Gauge:
+        return self.register(Gauge(name, help, collect, labels, kind))
+
+    def state(self) -> dict:
+        """This process's values, as written to METRICS_DIR."""
+        return {metric.name: metric.state() for metric in self.metrics}
+
+    @staticmethod
+    def _merge(metric, states: Sequence[dict]) -> Dict[Labels, object]:
+        values: Dict[Labels, object] = {}
+        for state in states:
+            for labels, value in state.get(metric.name, ()):
+                key = tuple(labels)
+                values[key] = metric.merge(values.get(key), value)
+        return values
+
+    def retire(self, states: Sequence[dict]) -> dict:
+        """The counters and histograms of *states* added up, without their gauges."""
+        return {
+            metric.name: [[list(labels), value] for labels, value in self._merge(metric, states).items()]
+            for metric in self.metrics
+            if metric.kind != "gauge"
+        }
+
+    def render(self, states: Sequence[dict]) -> str:
+        """Prometheus text exposition of the sum of *states*."""
+        lines = []
+        for metric in self.metrics:
+            values = self._merge(metric, states)
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render(values))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    "http_requests_total", "HTTP requests by route and status", ("method", "route", "status"),
+)
+http_request_seconds = registry.histogram(
+    "http_request_duration_seconds", "Time until the response starts, by route", LATENCY_BUCKETS, ("method", "route"),
+)
+ingest_reports = registry.counter("ingest_reports_total", "Reports accepted, by ingest endpoint", ("endpoint",))
+ingest_payload_bytes = registry.histogram(
+    "ingest_payload_bytes", "Request body size as received, by ingest endpoint", BYTES_BUCKETS, ("endpoint",),
+)
+ingest_visits = registry.counter("ingest_visits_total", "Visits sent to the database, including ones already stored")
+ingest_rows_inserted = registry.counter("ingest_rows_inserted_total", "Visit rows inserted")
+ingest_commit_rows = registry.histogram("ingest_commit_rows", "Visit rows inserted per ingest commit", ROWS_BUCKETS)
+ingest_commit_seconds = registry.histogram(
+    "ingest_commit_seconds", "Time to write and commit one ingest transaction", LATENCY_BUCKETS,
+)
+report_query_seconds = registry.histogram(
+    "report_query_seconds", "Time to compute a report response not served from the cache", LATENCY_BUCKETS, ("report",),
+)
+report_cache_lookups = registry.counter(
+    "report_cache_lookups_total", "Report responses served from the cache (hit) or computed (miss)", ("report", "result"),
+)
+logins = registry.counter("logins_total", "Dashboard login attempts", ("result",))
+login_password_seconds = registry.histogram(
+    "login_password_check_seconds", "Time to check a login password (bcrypt)",
+    (0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.0),
+)
+secureconfig_fetches = registry.counter("secureconfig_fetches_total", "Collector secureconfig.json fetches", ("status",))
+
+
+class MetricsMiddleware:
+    """Count and time every HTTP request under its route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = None
+
+        def observe():
+            # The router stores the matched route in the scope
+            route = getattr(scope.get("route"), "path", "(other)")
+            http_request_seconds.observe(time.perf_counter() - started, scope["method"], route)
+            return route
+
+        async def timed_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+                http_requests.inc(scope["method"], observe(), status)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            if status is None:
+                http_requests.inc(scope["method"], observe(), "500")
+
+
+def _read(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write(path: str, state: dict):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+class MetricsWriter:
+    """Background task writing this process's values to METRICS_DIR for the other workers' scrapes."""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self.path = os.path.join(METRICS_DIR, f"worker-{os.getpid()}.json") if METRICS_DIR else None
+
+    def write(self, state: dict):
+        _write(self.path, state)
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(METRICS_DIR, _LOCK), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def retire(self, path: str, state: Optional[dict] = None):
+        """Fold a finished worker's file (or its final *state*) into the retired totals and remove the file.
+
+        Runs under a file lock, so a worker's values are folded in once
+        even when several workers find its stale file at the same time.
+        """
+        retired_path = os.path.join(METRICS_DIR, _RETIRED)
+        with self._locked():
+            if state is None:
+                try:
+                    state = _read(path)
+                except FileNotFoundError:
+                    return  # already retired by another worker
+                except ValueError:
+                    state = {}
+            try:
+                retired = _read(retired_path)
+            except (FileNotFoundError, ValueError):
+                retired = {}
+            _write(retired_path, registry.retire([retired, state]))
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def other_states(self) -> List[dict]:
+        """The last values written by the other live workers, and the retired totals of exited ones."""
+        if not self.path:
+            return []
+        states = []
+        stale = time.time() - max(METRICS_FLUSH_SECONDS * 12, 60)
+        for name in os.listdir(METRICS_DIR):
+            path = os.path.join(METRICS_DIR, name)
+            if path == self.path or not name.startswith("worker-") or not name.endswith(".json"):
+                continue
+            try:
+                if os.path.getmtime(path) < stale:
+                    # A worker that exited without retiring its file
+                    self.retire(path)
+                    continue
+                states.append(_read(path))
+            except (OSError, ValueError):
+                continue
+        try:
+            states.append(_read(os.path.join(METRICS_DIR, _RETIRED)))
+        except (OSError, ValueError):
+            pass
+        return states
+
+    async def render(self) -> str:
+        others = await asyncio.to_thread(self.other_states) if self.path else []
+        return registry.render([registry.state(), *others])
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(METRICS_FLUSH_SECONDS)
+            try:
+                await asyncio.to_thread(self.write, registry.state())
+            except Exception as e:
+                print(f"⚠️  Writing metrics failed: {e}")
+
+    def start(self):
+        if self.path and self._task is None:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            if os.path.exists(self.path):
+                # Left by an earlier process with the same pid, e.g. a restarted container
+                self.retire(self.path)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            try:
+                self.retire(self.path, registry.state())
+            except OSError as e:
+                print(f"⚠️  Keeping metrics of this worker failed: {e}")
+
+
+metrics_writer = MetricsWriter()
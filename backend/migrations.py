@@ -0,0 +1,265 @@
+"""Versioned schema migrations.
+
+Each migration is applied once, in order, by ``python -m backend.manage
+migrate``, which records it in ``schema_version``. Server startup only
+compares that version with the latest one here.
+
+Steps must be idempotent: a migration interrupted part way (a failed
+concurrent index build, a lost connection) is rerun from its first step.
+Steps run in autocommit mode, so each SQL statement commits on its own;
+``ConcurrentIndex`` steps build their index without blocking writes to the
+table. Indexes a migration adds are also declared on the model, so new
+databases get them from the baseline's create_all.
+"""
+from __future__ import annotations
+
+import os
+from typing import List, Optional, Sequence, Union
+
+from sqlalchemy import text
+
+from .database import engine, Base
+from .search import VISIT_SEARCH_DDL
+
+# Rows deleted per statement by DeleteDuplicates steps; each batch commits
+# on its own, so ingest only ever waits for one batch's row locks.
+MIGRATION_DELETE_BATCH_ROWS = int(os.getenv("MIGRATION_DELETE_BATCH_ROWS", "5000"))
+
+_VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER PRIMARY KEY,
+    name VARCHAR NOT NULL,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+)
+"""
+_CURRENT_VERSION = text("SELECT coalesce(max(version), 0) FROM schema_version")
+_HAS_VERSION_TABLE = text("SELECT to_regclass('schema_version') IS NOT NULL")
+_RECORD_VERSION = text("INSERT INTO schema_version (version, name) VALUES (:version, :name) ON CONFLICT DO NOTHING")
+# Session lock: held across the autocommit steps of a whole run
+_MIGRATION_LOCK = text("SELECT pg_try_advisory_lock(hashtext('schema_migrations'))")
+_MIGRATION_UNLOCK = text("SELECT pg_advisory_unlock(hashtext('schema_migrations'))")
+
+_INDEX_VALID = text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)")
+_IS_PARTITIONED = text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:table)")
+# Partitions of :table without a partition of index :index attached
+_UNINDEXED_PARTITIONS = text("""
+SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = to_regclass(:table)
+  AND NOT EXISTS (
+      SELECT 1 FROM pg_inherits ii JOIN pg_index x ON x.indexrelid = ii.inhrelid
+      WHERE ii.inhparent = to_regclass(:index) AND x.indrelid = c.oid
+  )
+ORDER BY c.relname
+""")
+_HAS_EXTENSION = text("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = :name)")
+
+
+class SchemaOutOfDate(RuntimeError):
+    pass
+
+
+class CreateTables:
+    """Create the tables of the models that do not exist yet."""
+
+
+class ConcurrentIndex:
+    """CREATE INDEX CONCURRENTLY, also on partitioned tables.
+
+    Postgres cannot build a partitioned table's index concurrently, so the
+    parent index is created empty (ON ONLY), each partition's index is built
+    concurrently and attached, and the parent becomes valid once every
+    partition has one. An invalid index left by a failed build is dropped
+    and rebuilt.
+    """
+
+    def __init__(self, name: str, table: str, columns: str, unique: bool = False, using: str = "btree",
+                 where: Optional[str] = None, extension: Optional[str] = None):
+        self.name = name
+        self.table = table
+        self.columns = columns
+        self.unique = unique
+        self.using = using
+        self.where = where
+        # Only built when this extension (e.g. one providing the operator class) is installed
+        self.extension = extension
+
+    def definition(self, name: str, table: str, only: bool = False, concurrently: bool = False) -> str:
+        return " ".join(filter(None, [
+            "CREATE UNIQUE INDEX" if self.unique else "CREATE INDEX",
+            "CONCURRENTLY" if concurrently else None,
+            "IF NOT EXISTS",
+            name,
+            "ON ONLY" if only else "ON",
+            table,
+            f"USING {self.using} {self.columns}",
+            f"WHERE {self.where}" if self.where else None,
+        ]))
+
+    async def build(self, conn, name: str, table: str):
+        """Build *name* on a plain *table* concurrently; *conn* is in autocommit."""
+        valid = await conn.scalar(_INDEX_VALID, {"name": name})
+        if valid:
+            return
+        if valid is False:
+            await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        await conn.execute(text(self.definition(name, table, concurrently=True)))
+
+    async def apply(self, conn):
+        if self.extension and not await conn.scalar(_HAS_EXTENSION, {"name": self.extension}):
+            return
+        if not await conn.scalar(_IS_PARTITIONED, {"table": self.table}):
+            await self.build(conn, self.name, self.table)
+            return
+        if await conn.scalar(_INDEX_VALID, {"name": self.name}):
+            return
+        await conn.execute(text(self.definition(self.name, self.table, only=True)))
+        partitions = (await conn.execute(_UNINDEXED_PARTITIONS, {"table": self.table, "index": self.name})).scalars()
+        for partition in list(partitions):
+            child = f"{partition}_{self.name}"[:63]
+            await self.build(conn, child, partition)
+            await conn.execute(text(f"ALTER INDEX {self.name} ATTACH PARTITION {child}"))
+
+
+class DeleteDuplicates:
+    """Delete rows repeating the *key* of a row with a lower id, ahead of a unique index on it.
+
+    The duplicates are found with one read, which does not block writes,
+    and deleted MIGRATION_DELETE_BATCH_ROWS at a time. Nothing is read once
+    *index* is valid, since the key is then already unique. Rows inserted
+    between this step and the index build can still make the concurrent
+    build fail; the next ``migrate`` deletes them and rebuilds the index.
+    """
+
+    def __init__(self, table: str, key: str, index: str, where: Optional[str] = None):
+        self.table = table
+        self.key = key
+        self.index = index
+        self.where = where
+
+    async def apply(self, conn):
+        if await conn.scalar(_INDEX_VALID, {"name": self.index}):
+            return
+        where = f"WHERE {self.where}" if self.where else ""
+        ids = (await conn.execute(text(
+            f"SELECT id FROM (SELECT id, row_number() OVER (PARTITION BY {self.key} ORDER BY id) AS n "
+            f"FROM {self.table} {where}) d WHERE n > 1"
+        ))).scalars().all()
+        for start in range(0, len(ids), MIGRATION_DELETE_BATCH_ROWS):
+            batch = list(ids[start:start + MIGRATION_DELETE_BATCH_ROWS])
+            await conn.execute(text(f"DELETE FROM {self.table} WHERE id = ANY(:ids)"), {"ids": batch})
+        if ids:
+            print(f"   Deleted {len(ids)} duplicate rows of {self.table}")
+
+
+Step = Union[str, CreateTables, ConcurrentIndex, DeleteDuplicates]
+
+
+class Migration:
+    def __init__(self, version: int, name: str, steps: Sequence[Step]):
+        self.version = version
+        self.name = name
+        self.steps = steps
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "baseline schema", [
+        CreateTables(),
+        # Natural key of visits; rows stored twice before it existed are
+        # removed first.
+        DeleteDuplicates("visits", "user_id, visit_time, md5(url)", "uq_visits_natural_key", where="url IS NOT NULL"),
+        ConcurrentIndex("uq_visits_natural_key", "visits", "(user_id, visit_time, md5(url))", unique=True),
+        "ALTER TABLE visits ADD COLUMN IF NOT EXISTS url_id BIGINT REFERENCES visit_urls(id)",
+        "ALTER TABLE visits ADD COLUMN IF NOT EXISTS title_id BIGINT REFERENCES visit_titles(id)",
+        "ALTER TABLE visits ADD COLUMN IF NOT EXISTS domain VARCHAR",
+    ]),
+    Migration(2, "report indexes", [
+        ConcurrentIndex(
+            "uq_visits_natural_key_interned", "visits", "(user_id, visit_time, url_id)",
+            unique=True, where="url_id IS NOT NULL",
+        ),
+        ConcurrentIndex("ix_visits_user_time", "visits", "(user_id, visit_time DESC, id DESC)"),
+        ConcurrentIndex("ix_user_rollups_total_visits", "user_rollups", "(total_visits)"),
+        ConcurrentIndex("ix_user_rollups_last_activity", "user_rollups", "(last_activity)"),
+    ]),
+    # Trigram indexes let the substring user search of /api/reports/all use
+    # an index. pg_trgm is optional: without the extension (or the right to
+    # create it) the search still works, just by scanning users.
+    Migration(3, "user search trigram indexes", [
+        """
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+                CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            ELSE
+                RAISE NOTICE 'pg_trgm not available; user search will not use trigram indexes';
+            END IF;
+        EXCEPTION WHEN insufficient_privilege THEN
+            RAISE NOTICE 'Not allowed to create pg_trgm; user search will not use trigram indexes';
+        END $$;
+        """,
+        ConcurrentIndex("ix_users_username_trgm", "users", "(username gin_trgm_ops)", using="gin", extension="pg_trgm"),
+        ConcurrentIndex(
+            "ix_users_display_name_trgm", "users", "(display_name gin_trgm_ops)", using="gin", extension="pg_trgm",
+        ),
+        ConcurrentIndex("ix_users_email_trgm", "users", "(email gin_trgm_ops)", using="gin", extension="pg_trgm"),
+    ]),
+    # Existing visits are indexed by `manage backfill-search`
+    Migration(4, "visit full-text search", [
+        "ALTER TABLE visits ADD COLUMN IF NOT EXISTS search_vector TSVECTOR",
+        *VISIT_SEARCH_DDL,
+        ConcurrentIndex("ix_visits_search", "visits", "(search_vector)", using="gin"),
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+async def current_version(conn) -> int:
+    if not await conn.scalar(_HAS_VERSION_TABLE):
+        return 0
+    return await conn.scalar(_CURRENT_VERSION)
+
+
+async def check_schema():
+    """Fail fast when the database lacks migrations this code needs."""
+    async with engine.connect() as conn:
+        version = await current_version(conn)
+    if version < LATEST_VERSION:
+        raise SchemaOutOfDate(
+            f"Database schema is at version {version}, this server needs {LATEST_VERSION}; "
+            "run `python -m backend.manage migrate`"
+        )
+    if version > LATEST_VERSION:
+        print(f"⚠️  Database schema version {version} is newer than this server ({LATEST_VERSION})")
+
+
+async def apply_step(conn, step: Step):
+    if isinstance(step, (ConcurrentIndex, DeleteDuplicates)):
+        await step.apply(conn)
+    elif isinstance(step, CreateTables):
+        await conn.run_sync(Base.metadata.create_all)
+    else:
+        await conn.execute(text(step))
+
+
+async def migrate() -> int:
+    """Apply pending migrations; returns how many were applied."""
+    applied = 0
+    async with engine.connect() as conn:
+        await conn.execution_options(isolation_level="AUTOCOMMIT")
+        if not await conn.scalar(_MIGRATION_LOCK):
+            raise RuntimeError("Another migration is running")
+        try:
+            await conn.execute(text(_VERSION_TABLE))
+            version = await conn.scalar(_CURRENT_VERSION)
+            for migration in MIGRATIONS:
+                if migration.version <= version:
+                    continue
+                print(f"⚙️  Migration {migration.version}: {migration.name}")
+                for step in migration.steps:
+                    await apply_step(conn, step)
+                await conn.execute(_RECORD_VERSION, {"version": migration.version, "name": migration.name})
+                applied += 1
+        finally:
+            await conn.execute(_MIGRATION_UNLOCK)
+    return applied
@@ -1,7 +1,8 @@
 from __future__ import annotations
 
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Text, DateTime, Enum, BigInteger, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, Date, DateTime, Enum, BigInteger, ForeignKey, Index, LargeBinary, text
+from sqlalchemy.dialects.postgresql import ARRAY, TSVECTOR
 from sqlalchemy.orm import relationship
 from enum import Enum as PyEnum
 
@@ -26,18 +27,178 @@ class User(Base):
 
 class Visit(Base):
     __tablename__ = "visits"
+    __table_args__ = (
+        # Natural key: the collector resends overlapping history, so the same
+        # (user, url, visit_time) must only be stored once. url is hashed to
+        # keep long URLs within btree entry limits.
+        Index("uq_visits_natural_key", "user_id", "visit_time", text("md5(url)"), unique=True),
+        # Same key for rows stored in interned mode, where url is NULL.
+        Index(
+            "uq_visits_natural_key_interned", "user_id", "visit_time", "url_id",
+            unique=True, postgresql_where=text("url_id IS NOT NULL"),
+        ),
+        # Newest-first keyset pages of one user's visits
+        Index("ix_visits_user_time", "user_id", text("visit_time DESC"), text("id DESC")),
+        # Full-text search; search_vector is filled by a trigger (search.py)
+        Index("ix_visits_search", "search_vector", postgresql_using="gin"),
+        # Monthly partitions are managed by partitions.py; unique indexes
+        # of a partitioned table must include visit_time.
+        {"postgresql_partition_by": "RANGE (visit_time)"},
+    )
 
-    id = Column(BigInteger, primary_key=True, index=True)
+    id = Column(BigInteger, primary_key=True, autoincrement=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), index=True, nullable=False)
     computer_name = Column(String)
+    # Text storage keeps url/title inline; interned storage keeps them NULL
+    # and references the VisitUrl / VisitTitle dictionaries instead.
     url = Column(Text)
     title = Column(Text)
-    visit_time = Column(DateTime(timezone=True), nullable=False)  # actual visit time
+    url_id = Column(BigInteger, ForeignKey("visit_urls.id"))
+    title_id = Column(BigInteger, ForeignKey("visit_titles.id"))
+    visit_time = Column(DateTime(timezone=True), primary_key=True)  # actual visit time
     inserted_at = Column(DateTime(timezone=True), default=datetime.utcnow)
+    # Host of the url without "www.", extracted at ingest (crud.url_domain)
+    domain = Column(String)
+    search_vector = Column(TSVECTOR)
 
     user = relationship("User", back_populates="visits")
 
 
+class VisitUrl(Base):
+    """Deduplicated URL dictionary for interned visit storage."""
+
+    __tablename__ = "visit_urls"
+
+    id = Column(BigInteger, primary_key=True)
+    url_hash = Column(LargeBinary, unique=True, nullable=False)  # md5 digest of url
+    url = Column(Text, nullable=False)
+
+
+class VisitTitle(Base):
+    """Deduplicated title dictionary for interned visit storage."""
+
+    __tablename__ = "visit_titles"
+
+    id = Column(BigInteger, primary_key=True)
+    title_hash = Column(LargeBinary, unique=True, nullable=False)  # md5 digest of title
+    title = Column(Text, nullable=False)
+
+
+class UserRollup(Base):
+    """Per-user visit summary behind /api/reports/all.
+
+    Maintained incrementally by the visit writers in crud.py inside the
+    ingest transaction; `python -m backend.manage rebuild-rollups`
+    reconciles it with visits.
+    """
+
+    __tablename__ = "user_rollups"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    # Indexed for the sort and active-within filters of /api/reports/all
+    total_visits = Column(BigInteger, nullable=False, default=0, index=True)
+    unique_urls = Column(BigInteger, nullable=False, default=0)
+    last_activity = Column(DateTime(timezone=True), index=True)
+    computers = Column(ARRAY(String))  # sorted, distinct
+
+
+class UserUrl(Base):
+    """URLs each user has visited, so unique_urls can be counted incrementally."""
+
+    __tablename__ = "user_urls"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    url_hash = Column(LargeBinary, primary_key=True)  # md5 digest of url, as in visit_urls
+
+
+class UserDailyRollup(Base):
+    """Visits and distinct URLs per user per local day (ROLLUP_TIMEZONE).
+
+    Recomputed from visits by the rollup compactor (rollups.py) for days
+    queued in user_daily_rollup_queue.
+    """
+
+    __tablename__ = "user_daily_rollups"
+    __table_args__ = (Index("ix_user_daily_rollups_homegroup_day", "homegroup", "day"),)
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    # The user's homegroup when the day was compacted ('' for none), so
+    # past activity stays with the homegroup it happened in.
+    homegroup = Column(String, nullable=False, default="")
+    visits = Column(Integer, nullable=False, default=0)
+    unique_urls = Column(Integer, nullable=False, default=0)
+
+
+class HomegroupRollup(Base):
+    """Visits and active users per homegroup per day or week (starting Monday).
+
+    Derived from user_daily_rollups by the compactor; the fleet series is
+    the sum over homegroups.
+    """
+
+    __tablename__ = "homegroup_rollups"
+    __table_args__ = (Index("ix_homegroup_rollups_bucket_start", "bucket", "start"),)
+
+    homegroup = Column(String, primary_key=True)
+    bucket = Column(String, primary_key=True)  # "day" or "week"
+    start = Column(Date, primary_key=True)
+    visits = Column(BigInteger, nullable=False, default=0)
+    active_users = Column(Integer, nullable=False, default=0)
+
+
+class UserDailyDomain(Base):
+    """Visits per user per local day per domain.
+
+    Compacted together with user_daily_rollups; only visits with a domain
+    are counted.
+    """
+
+    __tablename__ = "user_daily_domains"
+    __table_args__ = (Index("ix_user_daily_domains_homegroup_day", "homegroup", "day"),)
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    domain = Column(String, primary_key=True)
+    homegroup = Column(String, nullable=False, default="")  # as in user_daily_rollups
+    visits = Column(Integer, nullable=False, default=0)
+
+
+class HomegroupDailyDomain(Base):
+    """Visits per homegroup per local day per domain, derived from user_daily_domains."""
+
+    __tablename__ = "homegroup_daily_domains"
+    __table_args__ = (Index("ix_homegroup_daily_domains_day", "day"),)
+
+    homegroup = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)
+    domain = Column(String, primary_key=True)
+    visits = Column(BigInteger, nullable=False, default=0)
+
+
+class FleetDailyDomain(Base):
+    """Visits per local day per domain across all homegroups.
+
+    Kept separately because summing the homegroup rows of a long window
+    reads every homegroup's domains for every day.
+    """
+
+    __tablename__ = "fleet_daily_domains"
+
+    day = Column(Date, primary_key=True)
+    domain = Column(String, primary_key=True)
+    visits = Column(BigInteger, nullable=False, default=0)
+
+
+class UserDailyRollupQueue(Base):
+    """(user, day) pairs with new visits whose daily rollup is stale."""
+
+    __tablename__ = "user_daily_rollup_queue"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)
+
+
 class DashboardRoleEnum(str, PyEnum):
     admin = "admin"
     user = "user"
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import os
+import random
+import time
+from typing import Optional
+
+# Collectors are told when to sync next instead of all polling on the fixed
+# sync_interval_minutes. Under load the delay grows with ingest queue depth
+# and database write latency; jitter spreads collectors that synced together.
+SYNC_BASE_SECONDS = float(os.getenv("SYNC_BASE_SECONDS", "300"))
+SYNC_MIN_SECONDS = float(os.getenv("SYNC_MIN_SECONDS", "60"))
+SYNC_MAX_SECONDS = float(os.getenv("SYNC_MAX_SECONDS", "1800"))
+SYNC_JITTER = float(os.getenv("SYNC_JITTER", "0.25"))  # +/- fraction of the delay
+# Most the delay grows under load, as a multiple of the base interval. The
+# point is to spread collectors out, not to slow them down: a collector
+# backed off further misses whole syncs, and a fleet told to wait long
+# comes back together as the next burst.
+SYNC_MAX_BACKOFF = float(os.getenv("SYNC_MAX_BACKOFF", "2"))
+# Load at which the delay starts to grow beyond the base interval.
+SYNC_TARGET_QUEUE_REPORTS = int(os.getenv("SYNC_TARGET_QUEUE_REPORTS", "200"))
+SYNC_TARGET_DB_LATENCY_MS = float(os.getenv("SYNC_TARGET_DB_LATENCY_MS", "250"))
+# Latency observations lose half their weight every this many seconds, so an
+# idle server stops advising a backoff caused by an old burst.
+SYNC_LATENCY_HALF_LIFE_SECONDS = float(os.getenv("SYNC_LATENCY_HALF_LIFE_SECONDS", "30"))
+
+
+class LatencyTracker:
+    """Exponentially weighted ingest transaction latency that decays when idle."""
+
+    def __init__(self, alpha: float = 0.2, half_life: float = SYNC_LATENCY_HALF_LIFE_SECONDS):
+        self.alpha = alpha
+        self.half_life = half_life
+        self._value = 0.0
+        self._updated = 0.0
+        self.observations = 0
+
+    def _decayed(self, now: float) -> float:
+        if not self._value or self.half_life <= 0:
+            return self._value
+        return self._value * 0.5 ** ((now - self._updated) / self.half_life)
+
+    def observe(self, seconds: float, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        current = self._decayed(now)
+        self._value = seconds if not self.observations else current + self.alpha * (seconds - current)
+        self._updated = now
+        self.observations += 1
+
+    def value(self, now: Optional[float] = None) -> float:
+        return self._decayed(time.monotonic() if now is None else now)
+
+
+class SyncAdvisor:
+    def __init__(self, base_seconds: float = SYNC_BASE_SECONDS, rng: Optional[random.Random] = None):
+        self.base_seconds = base_seconds
+        self.latency = LatencyTracker()
+        self.rng = rng or random.Random()
+        self.advised = 0
+        self.backed_off = 0
+
+    def configure(self, sync_interval_minutes):
+        """Follow the sync interval of the current secure config."""
+        try:
+            minutes = float(sync_interval_minutes)
+        except (TypeError, ValueError):
+            return
+        if minutes > 0:
+            self.base_seconds = minutes * 60
+
+    def pressure(self, queue_depth: int, db_latency: Optional[float] = None) -> float:
+        """Load relative to the targets; above 1 means collectors should back off."""
+        if db_latency is None:
+            db_latency = self.latency.value()
+        return max(
+            queue_depth / SYNC_TARGET_QUEUE_REPORTS if SYNC_TARGET_QUEUE_REPORTS > 0 else 0.0,
+            db_latency * 1000 / SYNC_TARGET_DB_LATENCY_MS if SYNC_TARGET_DB_LATENCY_MS > 0 else 0.0,
+        )
+
+    def next_sync_seconds(self, queue_depth: int, db_latency: Optional[float] = None) -> int:
+        """Recommended delay before a collector's next sync, with jitter."""
+        pressure = self.pressure(queue_depth, db_latency)
+        delay = self.base_seconds * min(max(1.0, pressure), SYNC_MAX_BACKOFF)
+        delay *= 1 + self.rng.uniform(-SYNC_JITTER, SYNC_JITTER)
+        self.advised += 1
+        if pressure > 1:
+            self.backed_off += 1
+        return int(round(min(SYNC_MAX_SECONDS, max(SYNC_MIN_SECONDS, delay))))
+
+    def snapshot(self, queue_depth: int) -> dict:
+        return {
+            "base_seconds": self.base_seconds,
+            "min_seconds": SYNC_MIN_SECONDS,
+            "max_seconds": SYNC_MAX_SECONDS,
+            "max_backoff": SYNC_MAX_BACKOFF,
+            "jitter": SYNC_JITTER,
+            "db_latency_ms": round(self.latency.value() * 1000, 3),
+            "pressure": round(self.pressure(queue_depth), 3),
+            "advised": self.advised,
+            "backed_off": self.backed_off,
+        }
+
+
+sync_advisor = SyncAdvisor()
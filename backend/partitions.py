@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import re
+from datetime import date, datetime
+from typing import Dict, List, Optional, Sequence
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import text
+
+from .crud import VISIT_COLUMNS, subtract_user_rollups
+from .database import engine
+from .rollups import EXPIRE_ROLLUP_DAYS, ROLLUP_TIMEZONE
+
+# visits is range partitioned by month of visit_time. Months start at local
+# midnight in ROLLUP_TIMEZONE, so dropping a month removes whole rollup days.
+VISIT_PARTITION_MONTHS_AHEAD = int(os.getenv("VISIT_PARTITION_MONTHS_AHEAD", "3"))
+# Whole months of visits kept before the current one; 0 keeps visits forever.
+VISIT_RETENTION_MONTHS = int(os.getenv("VISIT_RETENTION_MONTHS", "0"))
+VISIT_PARTITION_CHECK_SECONDS = float(os.getenv("VISIT_PARTITION_CHECK_SECONDS", "3600"))
+# DETACH PARTITION briefly locks visits; give up (and retry on the next
+# check) rather than queue ingest behind a long-running report query.
+VISIT_PARTITION_LOCK_TIMEOUT = os.getenv("VISIT_PARTITION_LOCK_TIMEOUT", "5s")
+
+DEFAULT_PARTITION = "visits_default"
+_MONTH_PARTITION = re.compile(r"^visits_(\d{4})_(\d{2})$")
+_VISIT_TIME = VISIT_COLUMNS.index("visit_time")
+
+_PARTITION_LOCK = text("SELECT pg_try_advisory_xact_lock(hashtext('visit_partitions'))")
+_IS_PARTITIONED = text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('visits')")
+_PARTITIONS = text("""
+SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = to_regclass('visits')
+""")
+
+
+def add_months(month: date, months: int) -> date:
+    year, index = divmod(month.year * 12 + month.month - 1 + months, 12)
+    return date(year, index + 1, 1)
+
+
+def current_month() -> date:
+    return datetime.now(ZoneInfo(ROLLUP_TIMEZONE)).date().replace(day=1)
+
+
+def month_start(month: date) -> datetime:
+    """Local midnight starting *month* in ROLLUP_TIMEZONE."""
+    return datetime(month.year, month.month, 1, tzinfo=ZoneInfo(ROLLUP_TIMEZONE))
+
+
+def partition_name(month: date) -> str:
+    return f"visits_{month:%Y_%m}"
+
+
+def retention_cutoff() -> Optional[datetime]:
+    """Oldest visit_time kept by the retention policy, or None if there is none."""
+    if VISIT_RETENTION_MONTHS <= 0:
+        return None
+    return month_start(add_months(current_month(), -VISIT_RETENTION_MONTHS))
+
+
+def drop_expired_records(records: Sequence[tuple]) -> List[tuple]:
+    """Skip visit records the retention policy would drop anyway."""
+    cutoff = retention_cutoff()
+    if cutoff is None:
+        return list(records)
+    return [r for r in records if r[_VISIT_TIME] >= cutoff]
+
+
+async def is_partitioned(conn) -> bool:
+    return bool(await conn.scalar(_IS_PARTITIONED))
+
+
+async def month_partitions(conn) -> Dict[date, str]:
+    months = {}
+    for (name,) in (await conn.execute(_PARTITIONS)).all():
+        match = _MONTH_PARTITION.match(name)
+        if match:
+            months[date(int(match[1]), int(match[2]), 1)] = name
+    return months
+
+
+async def create_month_partition(conn, month: date):
+    """Create the partition for *month*, moving in any rows the default partition holds for it."""
+    name = partition_name(month)
+    lo, hi = month_start(month), month_start(add_months(month, 1))
+    bounds = f"FOR VALUES FROM ('{lo.isoformat()}') TO ('{hi.isoformat()}')"
+    range_params = {"lo": lo, "hi": hi}
+    stray = await conn.scalar(text(
+        f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE visit_time >= :lo AND visit_time < :hi)"
+    ), range_params)
+    if not stray:
+        await conn.execute(text(f"CREATE TABLE {name} PARTITION OF visits {bounds}"))
+        return
+    # Bounds covering rows in the default partition are rejected, so those
+    # rows are moved into a detached table that is then attached.
+    await conn.execute(text(f"CREATE TABLE {name} (LIKE visits INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+    await conn.execute(text(f"""
+        WITH moved AS (
+            DELETE FROM {DEFAULT_PARTITION} WHERE visit_time >= :lo AND visit_time < :hi RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    """), range_params)
+    await conn.execute(text(f"ALTER TABLE visits ATTACH PARTITION {name} {bounds}"))
+
+
+async def ensure_partitions(conn, first: date, last: date) -> int:
+    """Create the month partitions from *first* to *last* and the default partition."""
+    await conn.execute(text(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF visits DEFAULT"))
+    existing = await month_partitions(conn)
+    created = 0
+    month = first
+    while month <= last:
+        if month not in existing:
+            await create_month_partition(conn, month)
+            created += 1
+        month = add_months(month, 1)
+    return created
+
+
+async def try_partition_lock(conn) -> bool:
+    """Serialize partition changes across server processes (transaction scoped)."""
+    return bool(await conn.scalar(_PARTITION_LOCK))
+
+
+async def drop_partition(conn, name: str):
+    await conn.execute(text(f"SET LOCAL lock_timeout = '{VISIT_PARTITION_LOCK_TIMEOUT}'"))
+    await conn.execute(text(f"ALTER TABLE visits DETACH PARTITION {name}"))
+    await conn.execute(text(f"DROP TABLE {name}"))
+
+
+async def expire_rollups(conn, cutoff_month: date):
+    """Remove rollup days before *cutoff_month* once their visits are gone."""
+    for sql in EXPIRE_ROLLUP_DAYS:
+        await conn.execute(text(sql), {"cutoff": cutoff_month})
+
+
+class PartitionManager:
+    """Background task creating upcoming visit partitions and dropping expired ones."""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self.partitioned: Optional[bool] = None
+        self.created = 0
+        self.dropped = 0
+        self.last_error: Optional[str] = None
+
+    async def maintain(self):
+        async with engine.begin() as conn:
+            self.partitioned = await is_partitioned(conn)
+            if not self.partitioned or not await try_partition_lock(conn):
+                return
+            first = current_month()
+            self.created += await ensure_partitions(conn, first, add_months(first, VISIT_PARTITION_MONTHS_AHEAD))
+        if VISIT_RETENTION_MONTHS > 0:
+            await self.drop_expired()
+
+    async def drop_expired(self) -> int:
+        """Detach and drop month partitions older than the retention cutoff.
+
+        Rollup days before the cutoff are removed with them, and the
+        dropped visits are subtracted from the per-user totals in the same
+        transaction, before the detach locks visits.
+        """
+        cutoff_month = add_months(current_month(), -VISIT_RETENTION_MONTHS)
+        cutoff = month_start(cutoff_month)
+        async with engine.begin() as conn:
+            if not await try_partition_lock(conn):
+                return 0
+            expired = [name for month, name in sorted((await month_partitions(conn)).items()) if month < cutoff_month]
+            await subtract_user_rollups(conn, [*expired, DEFAULT_PARTITION], cutoff)
+            for name in expired:
+                await drop_partition(conn, name)
+            stray = (await conn.execute(
+                text(f"DELETE FROM {DEFAULT_PARTITION} WHERE visit_time < :cutoff"), {"cutoff": cutoff}
+            )).rowcount
+            if not expired and not stray:
+                return 0
+            await expire_rollups(conn, cutoff_month)
+        self.dropped += len(expired)
+        print(f"✅ Retention dropped {len(expired)} visit partitions before {cutoff_month:%Y-%m}")
+        return len(expired)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(VISIT_PARTITION_CHECK_SECONDS)
+            try:
+                await self.maintain()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"⚠️  Visit partition maintenance failed: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def snapshot(self) -> dict:
+        cutoff = retention_cutoff()
+        return {
+            "partitioned": self.partitioned,
+            "months_ahead": VISIT_PARTITION_MONTHS_AHEAD,
+            "retention_months": VISIT_RETENTION_MONTHS,
+            "retention_cutoff": cutoff.isoformat() if cutoff else None,
+            "partitions_created": self.created,
+            "partitions_dropped": self.dropped,
+            "last_error": self.last_error,
+        }
+
+
+visit_partitions = PartitionManager()
@@ -0,0 +1,372 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import itertools
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+
+from .dbstats import query_shape
+
+# A request is profiled when it carries `X-Profile: <PROFILE_TOKEN>`, or as
+# one in every PROFILE_SAMPLE_RATE requests. Both are off by default.
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_SAMPLE_RATE = int(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# How often the stack of the event loop thread is sampled while a profile runs
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+PROFILE_MAX_STATEMENTS = int(os.getenv("PROFILE_MAX_STATEMENTS", "500"))
+# Statements slower than this are logged with their plan; 0 disables the log
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "1000"))
+SLOW_QUERY_KEEP = int(os.getenv("SLOW_QUERY_KEEP", "100"))
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "true").lower() in ("1", "true", "yes")
+# A query shape is explained at most once per interval; later slow runs reuse the plan
+SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS = float(os.getenv("SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS", "300"))
+
+_PROFILE_HEADER = b"x-profile"
+_PROFILE_ID_HEADER = b"x-profile-id"
+# Only these are explained; EXPLAIN without ANALYZE plans them without running them
+_EXPLAINABLE = re.compile(r"^\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+_MAX_STACK_DEPTH = 64
+_MAX_QUERY_CHARS = 10000
+
+_current_profile: contextvars.ContextVar[Optional["RequestProfile"]] = contextvars.ContextVar(
+    "current_profile", default=None,
+)
+
+
+def _utcnow() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def params_shape(parameters, executemany: bool = False):
+    """Types (and lengths) of bound values, without the values themselves."""
+    if executemany:
+        rows = list(parameters or ())
+        return {"rows": len(rows), "row": params_shape(rows[0]) if rows else []}
+    values = list(parameters.values()) if isinstance(parameters, dict) else list(parameters or ())
+    if len(values) > 20:
+        return {"values": len(values), "types": dict(Counter(type(v).__name__ for v in values))}
+    return [
+        f"{type(v).__name__}[{len(v)}]" if isinstance(v, (str, bytes, list, tuple)) else type(v).__name__
+        for v in values
+    ]
+
+
+def _frame_name(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse(frame) -> str:
+    """Root-first ``;``-separated stack, the collapsed format flame graph tools read."""
+    names = []
+    while frame is not None and len(names) < _MAX_STACK_DEPTH:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class RequestProfile:
+    """Stack samples and SQL statements of one request."""
+
+    def __init__(self, id: int, method: str, path: str, reason: str, task: Optional[asyncio.Task]):
+        self.id = id
+        self.method = method
+        self.path = path
+        self.route: Optional[str] = None
+        self.reason = reason
+        self.task = task
+        self.started_at = _utcnow()
+        self._started = time.perf_counter()
+        self.wall_seconds: Optional[float] = None
+        self.status: Optional[int] = None
+        # Samples taken while this request's task was running, and while others were
+        self.samples: Counter = Counter()
+        self.other_samples = 0
+        self.idle_samples = 0
+        self.statements: List[dict] = []
+        self.statements_dropped = 0
+        self.sql_seconds = 0.0
+        self.other_statements = 0
+        self.other_sql_seconds = 0.0
+
+    def add_statement(self, statement: str, parameters, executemany: bool, elapsed: float):
+        self.sql_seconds += elapsed
+        if len(self.statements) >= PROFILE_MAX_STATEMENTS:
+            self.statements_dropped += 1
+            return
+        self.statements.append({
+            "offset_ms": round((time.perf_counter() - self._started - elapsed) * 1000, 3),
+            "ms": round(elapsed * 1000, 3),
+            "query": statement[:_MAX_QUERY_CHARS],
+            "params": params_shape(parameters, executemany),
+        })
+
+    def finish(self, status: Optional[int]):
+        self.wall_seconds = time.perf_counter() - self._started
+        self.status = status
+        self.task = None
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "reason": self.reason,
+            "started_at": self.started_at,
+            "status": self.status,
+            "wall_ms": round(self.wall_seconds * 1000, 3) if self.wall_seconds is not None else None,
+            "sql_ms": round(self.sql_seconds * 1000, 3),
+            "statements": len(self.statements) + self.statements_dropped,
+            "samples": sum(self.samples.values()),
+        }
+
+    def detail(self, limit: int = 100) -> dict:
+        return {
+            **self.summary(),
+            "interval_ms": PROFILE_INTERVAL_MS,
+            "other_task_samples": self.other_samples,
+            "idle_samples": self.idle_samples,
+            "stacks": [{"stack": stack, "samples": n} for stack, n in self.samples.most_common(limit)],
+            "statement_list": self.statements,
+            "statements_dropped": self.statements_dropped,
+            "other_statements": self.other_statements,
+            "other_sql_ms": round(self.other_sql_seconds * 1000, 3),
+        }
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {n}\n" for stack, n in self.samples.items())
+
+
+class StackSampler:
+    """Thread sampling the event loop thread's stack while profiles are running.
+
+    Samples taken while the profiled request's task is running count
+    towards its stacks; samples of other tasks and of the idle loop are
+    only counted, since a request shares the loop with everything else.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profiles: Dict[int, RequestProfile] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+
+    def add(self, profile: RequestProfile):
+        with self._lock:
+            self._profiles[profile.id] = profile
+            if self._thread is None:
+                self._loop = asyncio.get_running_loop()
+                self._loop_thread_id = threading.get_ident()
+                self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+                self._thread.start()
+
+    def remove(self, profile: RequestProfile):
+        with self._lock:
+            self._profiles.pop(profile.id, None)
+
+    def _run(self):
+        interval = PROFILE_INTERVAL_MS / 1000
+        while True:
+            time.sleep(interval)
+            with self._lock:
+                if not self._profiles:
+                    self._thread = None
+                    return
+                frame = sys._current_frames().get(self._loop_thread_id)
+                try:
+                    task = asyncio.current_task(self._loop)
+                except RuntimeError:
+                    task = None
+                stack = None
+                for profile in self._profiles.values():
+                    if task is None:
+                        profile.idle_samples += 1
+                    elif task is profile.task and frame is not None:
+                        if stack is None:
+                            stack = _collapse(frame)
+                        profile.samples[stack] += 1
+                    else:
+                        profile.other_samples += 1
+
+
+class Profiler:
+    def __init__(self):
+        self._ids = itertools.count(1)
+        self._requests = itertools.count(1)
+        self.sampler = StackSampler()
+        self.active: Dict[int, RequestProfile] = {}
+        self.profiles: "OrderedDict[int, RequestProfile]" = OrderedDict()
+
+    def reason(self, scope) -> Optional[str]:
+        """Why the request of *scope* is profiled, or None if it is not."""
+        if PROFILE_TOKEN:
+            for name, value in scope["headers"]:
+                if name == _PROFILE_HEADER:
+                    if secrets.compare_digest(value, PROFILE_TOKEN.encode()):
+                        return "header"
+                    break
+        if PROFILE_SAMPLE_RATE > 0 and next(self._requests) % PROFILE_SAMPLE_RATE == 0:
+            return "sample"
+        return None
+
+    def begin(self, scope, reason: str) -> RequestProfile:
+        profile = RequestProfile(next(self._ids), scope["method"], scope["path"], reason, asyncio.current_task())
+        self.active[profile.id] = profile
+        self.sampler.add(profile)
+        return profile
+
+    def finish(self, profile: RequestProfile, status: Optional[int]):
+        self.sampler.remove(profile)
+        self.active.pop(profile.id, None)
+        profile.finish(status)
+        self.profiles[profile.id] = profile
+        while len(self.profiles) > PROFILE_KEEP:
+            self.profiles.popitem(last=False)
+
+    def record_statement(self, statement: str, parameters, executemany: bool, elapsed: float):
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.add_statement(statement, parameters, executemany, elapsed)
+            return
+        for other in self.active.values():
+            other.other_statements += 1
+            other.other_sql_seconds += elapsed
+
+    def list(self) -> List[dict]:
+        return [p.summary() for p in reversed(self.profiles.values())]
+
+    def get(self, id: int) -> Optional[RequestProfile]:
+        return self.profiles.get(id)
+
+
+profiler = Profiler()
+
+
+class ProfilingMiddleware:
+    """Profile the requests ``profiler`` picks; the response names the profile in ``X-Profile-Id``."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        reason = profiler.reason(scope) if scope["type"] == "http" else None
+        if reason is None:
+            await self.app(scope, receive, send)
+            return
+        profile = profiler.begin(scope, reason)
+        token = _current_profile.set(profile)
+        status = None
+
+        async def profiled_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", []), (_PROFILE_ID_HEADER, str(profile.id).encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, profiled_send)
+        finally:
+            _current_profile.reset(token)
+            profile.route = getattr(scope.get("route"), "path", None)
+            profiler.finish(profile, status)
+
+
+class SlowQueryLog:
+    """Statements over SLOW_QUERY_MS with the shape of their parameters and their plan."""
+
+    def __init__(self):
+        self.entries: deque = deque(maxlen=SLOW_QUERY_KEEP)
+        self.logged = 0
+        self._engine = None
+        self._plans: Dict[str, tuple] = {}
+        self._explaining = False
+        self._tasks: set = set()
+
+    def record(self, statement: str, parameters, executemany: bool, elapsed: float):
+        shape = query_shape(statement)
+        entry = {
+            "at": _utcnow(),
+            "ms": round(elapsed * 1000, 3),
+            "query": statement[:_MAX_QUERY_CHARS],
+            "params": params_shape(parameters, executemany),
+            "explain": None,
+        }
+        self.entries.append(entry)
+        self.logged += 1
+        print(f"⚠️  Slow query ({elapsed * 1000:.0f} ms): {shape[:200]}")
+        if not SLOW_QUERY_EXPLAIN or self._engine is None or not _EXPLAINABLE.match(statement):
+            return
+        cached = self._plans.get(shape)
+        if cached and time.monotonic() - cached[0] < SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS:
+            entry["explain"] = cached[1]
+            return
+        if self._explaining:
+            # One EXPLAIN at a time, so a burst of slow queries does not take more connections
+            return
+        self._explaining = True
+        if executemany:
+            parameters = next(iter(parameters), ())
+        values = list(parameters.values()) if isinstance(parameters, dict) else list(parameters or ())
+        task = asyncio.get_running_loop().create_task(self._explain(entry, shape, statement, values))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _explain(self, entry: dict, shape: str, statement: str, values: list):
+        try:
+            async with self._engine.connect() as conn:
+                raw = await conn.get_raw_connection()
+                # The driver connection directly: no cursor events, so this is never logged itself
+                rows = await raw.driver_connection.fetch("EXPLAIN " + statement, *values)
+            plan = "\n".join(row[0] for row in rows)
+            self._plans[shape] = (time.monotonic(), plan)
+            entry["explain"] = plan
+        except Exception as e:
+            entry["explain_error"] = str(e)
+        finally:
+            self._explaining = False
+
+    def snapshot(self, limit: int = 50) -> dict:
+        return {
+            "threshold_ms": SLOW_QUERY_MS,
+            "explain": SLOW_QUERY_EXPLAIN,
+            "logged": self.logged,
+            "entries": list(reversed(self.entries))[:limit],
+        }
+
+
+slow_queries = SlowQueryLog()
+
+
+def _before(conn, cursor, statement, parameters, context, executemany):
+    context._profile_started = time.perf_counter()
+
+
+def _after(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_profile_started", None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    if profiler.active:
+        profiler.record_statement(statement, parameters, executemany, elapsed)
+    if SLOW_QUERY_MS > 0 and elapsed * 1000 >= SLOW_QUERY_MS:
+        slow_queries.record(statement, parameters, executemany, elapsed)
+
+
+def instrument(engine):
+    """Feed *engine*'s statements (an AsyncEngine) to the profiler and the slow-query log."""
+    slow_queries._engine = engine
+    event.listen(engine.sync_engine, "before_cursor_execute", _before)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after)
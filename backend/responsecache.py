@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+
+from .metrics import report_cache_lookups, report_query_seconds
+
+# Report responses are cached per endpoint and parameters until ingest
+# writes visits for the users they cover. Time-relative filters (days,
+# active_days) also change results as time passes, so entries expire after
+# RESPONSE_CACHE_TTL_SECONDS; this also bounds staleness when another
+# process (a second worker, `manage rebuild-rollups`) changed the data.
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "60"))
+
+
+class ReportGenerations:
+    """Counters bumped after ingest commits visits.
+
+    ``fleet`` changes on every write; a user's counter only when that user
+    was written, so cached pages of other users stay valid.
+    """
+
+    def __init__(self):
+        self.fleet = 0
+        self._users: Dict[str, int] = {}
+
+    def bump(self, usernames: Iterable[str]):
+        self.fleet += 1
+        for username in usernames:
+            self._users[username] = self.fleet
+
+    def user(self, username: str) -> int:
+        return self._users.get(username, 0)
+
+
+report_generations = ReportGenerations()
+
+
+class CachedResponse:
+    __slots__ = ("body", "etag", "generation", "created")
+
+    def __init__(self, body: bytes, generation: int, created: float):
+        self.body = body
+        self.etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+        self.generation = generation
+        self.created = created
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+class ResponseCache:
+    """Bounded LRU of serialized JSON responses with ETag revalidation.
+
+    ETags hash the body, so a client revalidating with If-None-Match gets a
+    304 when the cached entry is current, and also when a recomputed body
+    turns out to be unchanged.
+    """
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES, ttl: float = RESPONSE_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Tuple, CachedResponse]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.not_modified = 0
+
+    def get(self, key: Tuple, generation: int) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is not None and (
+            entry.generation != generation or time.monotonic() - entry.created > self.ttl
+        ):
+            del self._entries[key]
+            self.stale += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: Tuple, generation: int, body: bytes) -> CachedResponse:
+        entry = self._entries[key] = CachedResponse(body, generation, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+
+    async def respond(
+        self,
+        request: Request,
+        endpoint: str,
+        params: dict,
+        generation: int,
+        compute: Callable[[], Awaitable],
+    ) -> Response:
+        """Serve *endpoint* for *params* from the cache, or from ``compute()``.
+
+        *generation* must be read before computing, so a write that commits
+        meanwhile leaves the new entry already out of date rather than
+        hiding that write.
+        """
+        key = (endpoint, tuple(sorted(params.items())))
+        entry = self.get(key, generation) if RESPONSE_CACHE_ENABLED else None
+        if entry is None:
+            report_cache_lookups.inc(endpoint, "miss")
+            started = time.perf_counter()
+            data = await compute()
+            report_query_seconds.observe(time.perf_counter() - started, endpoint)
+            body = json.dumps(jsonable_encoder(data), separators=(",", ":")).encode()
+            entry = self.put(key, generation, body) if RESPONSE_CACHE_ENABLED else CachedResponse(body, generation, 0.0)
+        else:
+            report_cache_lookups.inc(endpoint, "hit")
+
+        # Browsers must revalidate, but may reuse the body on a 304
+        headers = {"ETag": entry.etag, "Cache-Control": "private, no-cache"}
+        if _etag_matches(request.headers.get("If-None-Match"), entry.etag):
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        return Response(entry.body, media_type="application/json", headers=headers)
+
+    def snapshot(self) -> dict:
+        return {
+            "enabled": RESPONSE_CACHE_ENABLED,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+            "not_modified": self.not_modified,
+            "fleet_generation": report_generations.fleet,
+        }
+
+
+response_cache = ResponseCache()
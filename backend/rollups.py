@@ -0,0 +1,521 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from datetime import date, timedelta
+from typing import List, Optional
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .database import AsyncSessionLocal
+
+# Daily rollups bucket visits by local calendar day in this zone. Changing it
+# requires `python -m backend.manage rebuild-rollups`.
+ROLLUP_TIMEZONE = str(ZoneInfo(os.getenv("ROLLUP_TIMEZONE", "UTC")))
+ROLLUP_COMPACT_SECONDS = float(os.getenv("ROLLUP_COMPACT_SECONDS", "30"))
+ROLLUP_COMPACT_BATCH = int(os.getenv("ROLLUP_COMPACT_BATCH", "2000"))
+TIMESERIES_MAX_DAYS = int(os.getenv("TIMESERIES_MAX_DAYS", "1095"))
+
+
+def local_day_sql(column: str) -> str:
+    """SQL for the ROLLUP_TIMEZONE calendar day of timestamptz *column*."""
+    return f"({column} AT TIME ZONE '{ROLLUP_TIMEZONE}')::date"
+
+
+# Only one compactor (across server processes) folds days at a time, so
+# homegroup rows are never recomputed from two different snapshots.
+_COMPACT_LOCK = text("SELECT pg_try_advisory_xact_lock(hashtext('user_daily_rollups'))")
+
+# Takes a batch of queued (user, day) pairs, skipping any an uncommitted
+# ingest transaction is still re-queuing, and recomputes them and their
+# per-domain counts from visits. Returns how many were taken and the
+# (homegroup, day) pairs they touched, old homegroups included.
+_COMPACT_DAYS = text(f"""
+WITH picked AS (
+    DELETE FROM user_daily_rollup_queue q
+    USING (
+        SELECT user_id, day FROM user_daily_rollup_queue
+        ORDER BY user_id, day
+        LIMIT :batch
+        FOR UPDATE SKIP LOCKED
+    ) p
+    WHERE q.user_id = p.user_id AND q.day = p.day
+    RETURNING q.user_id, q.day
+), previous AS (
+    SELECT r.homegroup, r.day FROM user_daily_rollups r JOIN picked p USING (user_id, day)
+), fresh AS (
+    SELECT p.user_id, p.day, coalesce(usr.homegroup, '') AS homegroup,
+           count(v.id) AS visits,
+           count(DISTINCT coalesce(decode(md5(v.url), 'hex'), u.url_hash)) AS unique_urls
+    FROM picked p
+    JOIN users usr ON usr.id = p.user_id
+    LEFT JOIN visits v
+           ON v.user_id = p.user_id
+          AND v.visit_time >= (p.day::timestamp AT TIME ZONE '{ROLLUP_TIMEZONE}')
+          AND v.visit_time < ((p.day + 1)::timestamp AT TIME ZONE '{ROLLUP_TIMEZONE}')
+    LEFT JOIN visit_urls u ON u.id = v.url_id
+    GROUP BY p.user_id, p.day, usr.homegroup
+), dropped AS (
+    DELETE FROM user_daily_rollups r USING fresh f
+    WHERE r.user_id = f.user_id AND r.day = f.day AND f.visits = 0
+), upserted AS (
+    INSERT INTO user_daily_rollups AS r (user_id, day, homegroup, visits, unique_urls)
+    SELECT user_id, day, homegroup, visits, unique_urls FROM fresh WHERE visits > 0
+    ORDER BY user_id, day
+    ON CONFLICT (user_id, day) DO UPDATE SET
+        homegroup = EXCLUDED.homegroup, visits = EXCLUDED.visits, unique_urls = EXCLUDED.unique_urls
+), domain_fresh AS (
+    SELECT p.user_id, p.day, v.domain, coalesce(usr.homegroup, '') AS homegroup, count(*) AS visits
+    FROM picked p
+    JOIN users usr ON usr.id = p.user_id
+    JOIN visits v
+      ON v.user_id = p.user_id
+     AND v.visit_time >= (p.day::timestamp AT TIME ZONE '{ROLLUP_TIMEZONE}')
+     AND v.visit_time < ((p.day + 1)::timestamp AT TIME ZONE '{ROLLUP_TIMEZONE}')
+    WHERE v.domain IS NOT NULL
+    GROUP BY p.user_id, p.day, v.domain, usr.homegroup
+), domains_dropped AS (
+    DELETE FROM user_daily_domains d USING picked p
+    WHERE d.user_id = p.user_id AND d.day = p.day
+      AND NOT EXISTS (
+          SELECT 1 FROM domain_fresh f WHERE f.user_id = d.user_id AND f.day = d.day AND f.domain = d.domain
+      )
+), domains_upserted AS (
+    INSERT INTO user_daily_domains AS d (user_id, day, domain, homegroup, visits)
+    SELECT user_id, day, domain, homegroup, visits FROM domain_fresh
+    ORDER BY user_id, day, domain
+    ON CONFLICT (user_id, day, domain) DO UPDATE SET
+        homegroup = EXCLUDED.homegroup, visits = EXCLUDED.visits
+), touched AS (
+    SELECT homegroup, day FROM fresh UNION SELECT homegroup, day FROM previous
+)
+SELECT (SELECT count(*) FROM picked) AS taken,
+       coalesce(array_agg(homegroup), '{{}}') AS homegroups,
+       coalesce(array_agg(day), '{{}}') AS days
+FROM touched
+""")
+
+# Recomputes the day and week homegroup rows containing the touched days.
+# Runs after _COMPACT_DAYS in the same transaction, so it sees its writes.
+_COMPACT_HOMEGROUPS = text("""
+WITH touched AS (
+    SELECT * FROM unnest(CAST(:homegroups AS varchar[]), CAST(:days AS date[])) AS t(homegroup, day)
+), targets AS (
+    SELECT homegroup, 'day' AS bucket, day AS start, 1 AS length FROM touched
+    UNION
+    SELECT homegroup, 'week', CAST(date_trunc('week', CAST(day AS timestamp)) AS date), 7 FROM touched
+), fresh AS (
+    SELECT t.homegroup, t.bucket, t.start,
+           coalesce(sum(r.visits), 0) AS visits,
+           count(DISTINCT r.user_id) AS active_users
+    FROM targets t
+    LEFT JOIN user_daily_rollups r
+           ON r.homegroup = t.homegroup AND r.day >= t.start AND r.day < t.start + t.length
+    GROUP BY t.homegroup, t.bucket, t.start
+), dropped AS (
+    DELETE FROM homegroup_rollups g USING fresh f
+    WHERE g.homegroup = f.homegroup AND g.bucket = f.bucket AND g.start = f.start AND f.visits = 0
+)
+INSERT INTO homegroup_rollups AS g (homegroup, bucket, start, visits, active_users)
+SELECT homegroup, bucket, start, visits, active_users FROM fresh WHERE visits > 0
+ORDER BY homegroup, bucket, start
+ON CONFLICT (homegroup, bucket, start) DO UPDATE SET
+    visits = EXCLUDED.visits, active_users = EXCLUDED.active_users
+""")
+
+# Recomputes the per-domain counts of the touched homegroup days.
+_COMPACT_HOMEGROUP_DOMAINS = text("""
+WITH touched AS (
+    SELECT * FROM unnest(CAST(:homegroups AS varchar[]), CAST(:days AS date[])) AS t(homegroup, day)
+), fresh AS (
+    SELECT t.homegroup, t.day, d.domain, sum(d.visits) AS visits
+    FROM touched t
+    JOIN user_daily_domains d ON d.homegroup = t.homegroup AND d.day = t.day
+    GROUP BY t.homegroup, t.day, d.domain
+), dropped AS (
+    DELETE FROM homegroup_daily_domains g USING touched t
+    WHERE g.homegroup = t.homegroup AND g.day = t.day
+      AND NOT EXISTS (
+          SELECT 1 FROM fresh f WHERE f.homegroup = g.homegroup AND f.day = g.day AND f.domain = g.domain
+      )
+)
+INSERT INTO homegroup_daily_domains AS g (homegroup, day, domain, visits)
+SELECT homegroup, day, domain, visits FROM fresh
+ORDER BY homegroup, day, domain
+ON CONFLICT (homegroup, day, domain) DO UPDATE SET visits = EXCLUDED.visits
+""")
+
+# Recomputes the fleet-wide per-domain counts of the touched days.
+_COMPACT_FLEET_DOMAINS = text("""
+WITH touched AS (
+    SELECT DISTINCT day FROM unnest(CAST(:days AS date[])) AS t(day)
+), fresh AS (
+    SELECT t.day, g.domain, sum(g.visits) AS visits
+    FROM touched t
+    JOIN homegroup_daily_domains g ON g.day = t.day
+    GROUP BY t.day, g.domain
+), dropped AS (
+    DELETE FROM fleet_daily_domains f USING touched t
+    WHERE f.day = t.day
+      AND NOT EXISTS (SELECT 1 FROM fresh n WHERE n.day = f.day AND n.domain = f.domain)
+)
+INSERT INTO fleet_daily_domains AS f (day, domain, visits)
+SELECT day, domain, visits FROM fresh
+ORDER BY day, domain
+ON CONFLICT (day, domain) DO UPDATE SET visits = EXCLUDED.visits
+""")
+
+# Queue every (user, day) that has visits or a rollup row, to build or
+# reconcile the daily rollups of an existing database.
+QUEUE_ALL_DAYS = [
+    f"""
+    INSERT INTO user_daily_rollup_queue (user_id, day)
+    SELECT DISTINCT user_id, {local_day_sql('visit_time')} FROM visits
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    INSERT INTO user_daily_rollup_queue (user_id, day)
+    SELECT user_id, day FROM user_daily_rollups
+    ON CONFLICT DO NOTHING
+    """,
+]
+
+# Removes rollup days before :cutoff when retention drops their visits.
+# Homegroup weeks starting before it are removed too, and the kept days of
+# such a week are queued, so the compactor rebuilds it from those days.
+EXPIRE_ROLLUP_DAYS = [
+    "DELETE FROM user_daily_rollup_queue WHERE day < :cutoff",
+    "DELETE FROM user_daily_rollups WHERE day < :cutoff",
+    "DELETE FROM user_daily_domains WHERE day < :cutoff",
+    "DELETE FROM homegroup_daily_domains WHERE day < :cutoff",
+    "DELETE FROM fleet_daily_domains WHERE day < :cutoff",
+    "DELETE FROM homegroup_rollups WHERE start < :cutoff",
+    """
+    INSERT INTO user_daily_rollup_queue (user_id, day)
+    SELECT user_id, day FROM user_daily_rollups
+    WHERE day >= :cutoff AND day < CAST(:cutoff AS date) + 7
+    ON CONFLICT DO NOTHING
+    """,
+]
+
+
+# Recompute user_urls and user_rollups from visits. Rows are only written
+# where they differ, so the command doubles as a consistency check.
+USER_ROLLUP_REBUILD = [
+    "LOCK TABLE user_urls, user_rollups IN SHARE ROW EXCLUSIVE MODE",
+    "TRUNCATE user_urls",
+    """
+    INSERT INTO user_urls (user_id, url_hash)
+    SELECT DISTINCT v.user_id, coalesce(decode(md5(v.url), 'hex'), u.url_hash)
+    FROM visits v LEFT JOIN visit_urls u ON u.id = v.url_id
+    """,
+    """
+    CREATE TEMP TABLE user_rollups_fresh ON COMMIT DROP AS
+    SELECT v.user_id,
+           count(*) AS total_visits,
+           (SELECT count(*) FROM user_urls uu WHERE uu.user_id = v.user_id) AS unique_urls,
+           max(v.visit_time) AS last_activity,
+           array_agg(DISTINCT v.computer_name ORDER BY v.computer_name)
+               FILTER (WHERE v.computer_name IS NOT NULL) AS computers
+    FROM visits v
+    GROUP BY v.user_id
+    """,
+]
+
+# Take visits that are about to be dropped or archived out of user_urls and
+# user_rollups, in the transaction that removes them. {removed} selects the
+# removed rows (user_id, url, url_id, computer_name, visit_time); {remaining}
+# is true for a row rv of visits that stays. Users whose newest visit is
+# removed get last_activity looked up again. Only the affected users' rows
+# are locked, in user_id order like ingest, so ingest keeps running. A URL
+# or computer leaves a user's totals once no remaining visit has it.
+USER_ROLLUP_SUBTRACT = [
+    """
+    CREATE TEMP TABLE removed_visits (
+        user_id integer, url_hash bytea, computer_name varchar, visits bigint, last_visit timestamptz
+    ) ON COMMIT DROP
+    """,
+    """
+    INSERT INTO removed_visits
+    SELECT v.user_id, coalesce(decode(md5(v.url), 'hex'), u.url_hash) AS url_hash, v.computer_name,
+           count(*) AS visits, max(v.visit_time) AS last_visit
+    FROM ({removed}) v LEFT JOIN visit_urls u ON u.id = v.url_id
+    GROUP BY 1, 2, 3
+    """,
+    """
+    SELECT 1 FROM user_rollups
+    WHERE user_id IN (SELECT user_id FROM removed_visits)
+    ORDER BY user_id
+    FOR UPDATE
+    """,
+    """
+    WITH gone_urls AS (
+        DELETE FROM user_urls uu
+        USING (SELECT DISTINCT user_id, url_hash FROM removed_visits) d
+        WHERE uu.user_id = d.user_id AND uu.url_hash = d.url_hash
+          AND NOT EXISTS (
+              SELECT 1 FROM visits rv LEFT JOIN visit_urls u ON u.id = rv.url_id
+              WHERE rv.user_id = d.user_id AND coalesce(decode(md5(rv.url), 'hex'), u.url_hash) = d.url_hash
+                AND {remaining}
+          )
+        RETURNING uu.user_id
+    ), gone_computers AS (
+        SELECT d.user_id, array_agg(DISTINCT d.computer_name) AS names
+        FROM removed_visits d
+        WHERE d.computer_name IS NOT NULL
+          AND NOT EXISTS (
+              SELECT 1 FROM visits rv
+              WHERE rv.user_id = d.user_id AND rv.computer_name = d.computer_name AND {remaining}
+          )
+        GROUP BY d.user_id
+    )
+    UPDATE user_rollups ur SET
+        total_visits = ur.total_visits - t.visits,
+        unique_urls = ur.unique_urls - coalesce(g.urls, 0),
+        computers = CASE WHEN c.names IS NULL THEN ur.computers ELSE NULLIF(ARRAY(
+            SELECT n FROM unnest(ur.computers) AS n WHERE n <> ALL(c.names) ORDER BY n
+        ), '{{}}') END,
+        last_activity = CASE WHEN ur.last_activity > t.last_visit THEN ur.last_activity ELSE (
+            SELECT max(rv.visit_time) FROM visits rv WHERE rv.user_id = ur.user_id AND {remaining}
+        ) END
+    FROM (SELECT user_id, sum(visits) AS visits, max(last_visit) AS last_visit FROM removed_visits GROUP BY user_id) t
+    LEFT JOIN (SELECT user_id, count(*) AS urls FROM gone_urls GROUP BY user_id) g USING (user_id)
+    LEFT JOIN gone_computers c USING (user_id)
+    WHERE ur.user_id = t.user_id
+    """,
+    """
+    DELETE FROM user_rollups
+    WHERE total_visits <= 0 AND user_id IN (SELECT user_id FROM removed_visits)
+    """,
+]
+
+# Applied after USER_ROLLUP_REBUILD; their row counts are the corrections.
+USER_ROLLUP_RECONCILE = [
+    """
+    DELETE FROM user_rollups r
+    WHERE NOT EXISTS (SELECT 1 FROM user_rollups_fresh f WHERE f.user_id = r.user_id)
+    """,
+    """
+    INSERT INTO user_rollups AS r (user_id, total_visits, unique_urls, last_activity, computers)
+    SELECT user_id, total_visits, unique_urls, last_activity, computers FROM user_rollups_fresh
+    ON CONFLICT (user_id) DO UPDATE SET
+        total_visits = EXCLUDED.total_visits,
+        unique_urls = EXCLUDED.unique_urls,
+        last_activity = EXCLUDED.last_activity,
+        computers = EXCLUDED.computers
+    WHERE (r.total_visits, r.unique_urls, r.last_activity, r.computers)
+          IS DISTINCT FROM (EXCLUDED.total_visits, EXCLUDED.unique_urls, EXCLUDED.last_activity, EXCLUDED.computers)
+    """,
+]
+
+
+class RollupCompactor:
+    """Background task that folds queued days into the daily rollup tables."""
+
+    def __init__(self, session_factory=AsyncSessionLocal):
+        self.session_factory = session_factory
+        self._task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.days = 0
+        self.seconds = 0.0
+        self.last_error: Optional[str] = None
+
+    async def compact_once(self, batch: int = ROLLUP_COMPACT_BATCH) -> int:
+        """Recompute up to *batch* queued user-days and the homegroup rows they touch.
+
+        Returns how many user-days were taken (0 while another process is
+        compacting).
+        """
+        started = time.perf_counter()
+        async with self.session_factory() as db:
+            if not await db.scalar(_COMPACT_LOCK):
+                return 0
+            taken, homegroups, days = (await db.execute(_COMPACT_DAYS, {"batch": batch})).one()
+            if days:
+                touched = {"homegroups": homegroups, "days": days}
+                await db.execute(_COMPACT_HOMEGROUPS, touched)
+                await db.execute(_COMPACT_HOMEGROUP_DOMAINS, touched)
+                await db.execute(_COMPACT_FLEET_DOMAINS, {"days": days})
+            await db.commit()
+        self.runs += 1
+        self.days += taken
+        self.seconds += time.perf_counter() - started
+        return taken
+
+    async def compact_all(self) -> int:
+        """Compact until the queue is empty, apart from days still being written."""
+        total = 0
+        while True:
+            taken = await self.compact_once()
+            total += taken
+            if taken < ROLLUP_COMPACT_BATCH:
+                return total
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(ROLLUP_COMPACT_SECONDS)
+            try:
+                await self.compact_all()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"⚠️  Rollup compaction failed: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def snapshot(self, db: AsyncSession) -> dict:
+        pending = await db.scalar(text("SELECT count(*) FROM user_daily_rollup_queue"))
+        return {
+            "timezone": ROLLUP_TIMEZONE,
+            "interval_seconds": ROLLUP_COMPACT_SECONDS,
+            "pending_days": pending,
+            "runs": self.runs,
+            "days_compacted": self.days,
+            "seconds": round(self.seconds, 6),
+            "last_error": self.last_error,
+        }
+
+
+rollup_compactor = RollupCompactor()
+
+
+# ---------------------------- time series -----------------------------
+
+_USER_SERIES = text("""
+SELECT CAST(date_trunc(:bucket, CAST(day AS timestamp)) AS date) AS bucket,
+       sum(visits) AS visits,
+       sum(unique_urls) AS unique_urls
+FROM user_daily_rollups
+WHERE user_id = :user_id AND day BETWEEN :start AND :end
+GROUP BY 1
+""")
+
+_HOMEGROUP_SERIES = text("""
+SELECT start AS bucket, visits, active_users
+FROM homegroup_rollups
+WHERE homegroup = :homegroup AND bucket = :bucket AND start BETWEEN :start AND :end
+""")
+
+_FLEET_SERIES = text("""
+SELECT start AS bucket, sum(visits) AS visits, sum(active_users) AS active_users
+FROM homegroup_rollups
+WHERE bucket = :bucket AND start BETWEEN :start AND :end
+GROUP BY start
+""")
+
+
+def series_buckets(start: date, end: date, bucket: str) -> List[date]:
+    """Every bucket start from *start* to *end*; week buckets start on *start*."""
+    step = timedelta(days=7 if bucket == "week" else 1)
+    buckets = []
+    current = start
+    while current <= end:
+        buckets.append(current)
+        current += step
+    return buckets
+
+
+async def activity_series(
+    db: AsyncSession,
+    start: date,
+    end: date,
+    bucket: str = "day",
+    user_id: Optional[int] = None,
+    homegroup: Optional[str] = None,
+) -> List[dict]:
+    """Visits and active users per day/week for a user, a homegroup or the fleet.
+
+    Buckets without activity are included with zeros. For a user,
+    activeUsers is 1 for buckets with any visit; uniqueUrls is only given
+    for a user's days, since distinct URLs do not add up across days or
+    users.
+    """
+    if bucket == "week":
+        start -= timedelta(days=start.weekday())
+    params = {"bucket": bucket, "start": start, "end": end}
+    if user_id is not None:
+        stmt = _USER_SERIES
+        params["user_id"] = user_id
+    elif homegroup is not None:
+        stmt = _HOMEGROUP_SERIES
+        params["homegroup"] = homegroup
+    else:
+        stmt = _FLEET_SERIES
+    rows = {r.bucket: r for r in (await db.execute(stmt, params)).all()}
+    per_user_day = user_id is not None and bucket == "day"
+    points = []
+    for b in series_buckets(start, end, bucket):
+        r = rows.get(b)
+        points.append({
+            "start": b.isoformat(),
+            "visits": int(r.visits) if r else 0,
+            "activeUsers": (1 if user_id is not None else int(r.active_users)) if r else 0,
+            "uniqueUrls": (int(r.unique_urls) if r else 0) if per_user_day else None,
+        })
+    return points
+
+
+# ---------------------------- top domains -----------------------------
+
+_USER_DOMAINS = text("""
+SELECT domain, sum(visits) AS visits
+FROM user_daily_domains
+WHERE user_id = :user_id AND day BETWEEN :start AND :end
+GROUP BY domain
+ORDER BY visits DESC, domain
+LIMIT :limit
+""")
+
+_HOMEGROUP_DOMAINS = text("""
+SELECT domain, sum(visits) AS visits
+FROM homegroup_daily_domains
+WHERE homegroup = :homegroup AND day BETWEEN :start AND :end
+GROUP BY domain
+ORDER BY visits DESC, domain
+LIMIT :limit
+""")
+
+_FLEET_DOMAINS = text("""
+SELECT domain, sum(visits) AS visits
+FROM fleet_daily_domains
+WHERE day BETWEEN :start AND :end
+GROUP BY domain
+ORDER BY visits DESC, domain
+LIMIT :limit
+""")
+
+
+async def top_domains(
+    db: AsyncSession,
+    start: date,
+    end: date,
+    limit: int = 10,
+    user_id: Optional[int] = None,
+    homegroup: Optional[str] = None,
+) -> List[dict]:
+    """Most visited domains from *start* to *end* for a user, a homegroup or the fleet."""
+    params = {"start": start, "end": end, "limit": limit}
+    if user_id is not None:
+        stmt = _USER_DOMAINS
+        params["user_id"] = user_id
+    elif homegroup is not None:
+        stmt = _HOMEGROUP_DOMAINS
+        params["homegroup"] = homegroup
+    else:
+        stmt = _FLEET_DOMAINS
+    rows = (await db.execute(stmt, params)).all()
+    return [{"domain": r.domain, "visits": int(r.visits)} for r in rows]
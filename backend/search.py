@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import os
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# visits.search_vector holds the title (weight A) and the words of the URL
+# (weight B; host, path and query split on punctuation, so search terms
+# typed into a search engine match too). It is filled by a trigger on
+# insert, which covers every ingest path and both storage modes.
+SEARCH_CONFIG = "english"
+# Longest time range one search may cover; each month adds a partition scan
+SEARCH_MAX_DAYS = int(os.getenv("SEARCH_MAX_DAYS", "92"))
+# Matches ranked per search. A term found in a large share of visits would
+# otherwise rank all of them; past this only the newest matches are ranked
+# and the response is marked truncated.
+SEARCH_MAX_MATCHES = int(os.getenv("SEARCH_MAX_MATCHES", "20000"))
+
+VISIT_SEARCH_DDL = [
+    f"""
+    CREATE OR REPLACE FUNCTION visit_search_vector(title text, url text) RETURNS tsvector
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+        SELECT setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(title, '')), 'A')
+            || setweight(to_tsvector('{SEARCH_CONFIG}', regexp_replace(coalesce(url, ''), '[^[:alnum:]]+', ' ', 'g')), 'B')
+    $$
+    """,
+    # Interned rows carry ids; their text is already in the dictionaries
+    """
+    CREATE OR REPLACE FUNCTION visits_fill_search_vector() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF NEW.search_vector IS NULL THEN
+            NEW.search_vector := visit_search_vector(
+                coalesce(NEW.title, (SELECT title FROM visit_titles WHERE id = NEW.title_id)),
+                coalesce(NEW.url, (SELECT url FROM visit_urls WHERE id = NEW.url_id))
+            );
+        END IF;
+        RETURN NEW;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE TRIGGER visits_search_vector BEFORE INSERT ON visits
+    FOR EACH ROW EXECUTE FUNCTION visits_fill_search_vector()
+    """,
+]
+
+# Matches are collected first, so the planner finds them through the GIN
+# index rather than walking another index of visits and filtering; only the
+# rows of the returned page are joined to the URL/title dictionaries. The
+# cap keeps the newest matches, so a truncated search ranks a deterministic
+# set: the most recent part of the range.
+_SEARCH_VISITS = f"""
+WITH matched AS MATERIALIZED (
+    SELECT v.id, v.user_id, v.visit_time, v.title, v.url, v.title_id, v.url_id, v.computer_name,
+           ts_rank(v.search_vector, query) AS rank
+    FROM visits v, websearch_to_tsquery('{SEARCH_CONFIG}', :q) AS query
+    WHERE v.search_vector @@ query
+      AND v.visit_time >= :since AND v.visit_time < :until
+      {{homegroup}}
+    ORDER BY v.visit_time DESC, v.id DESC
+    LIMIT :max_matches
+), page AS (
+    SELECT m.*, usr.username, usr.homegroup, count(*) OVER () AS total
+    FROM matched m JOIN users usr ON usr.id = m.user_id
+    ORDER BY m.rank DESC, m.visit_time DESC, m.id DESC
+    LIMIT :limit OFFSET :offset
+)
+SELECT p.username, p.homegroup, p.visit_time,
+       coalesce(p.title, t.title) AS title, coalesce(p.url, u.url) AS url, p.computer_name, p.rank, p.total
+FROM page p
+LEFT JOIN visit_urls u ON u.id = p.url_id
+LEFT JOIN visit_titles t ON t.id = p.title_id
+ORDER BY p.rank DESC, p.visit_time DESC, p.id DESC
+"""
+
+_COUNT_VISITS = f"""
+SELECT count(*) FROM (
+    SELECT 1 FROM visits v
+    WHERE v.search_vector @@ websearch_to_tsquery('{SEARCH_CONFIG}', :q)
+      AND v.visit_time >= :since AND v.visit_time < :until
+      {{homegroup}}
+    LIMIT :max_matches
+) matched
+"""
+
+
+async def search_visits(
+    db: AsyncSession,
+    q: str,
+    since: datetime,
+    until: datetime,
+    limit: int,
+    offset: int = 0,
+    homegroup: Optional[str] = None,
+) -> dict:
+    """Visits whose title or URL match the web-search style query *q*, best match first.
+
+    The GIN index on search_vector finds the matches; the time range limits
+    the scan to the partitions it covers. Ties in rank go to the newest visit.
+    At most SEARCH_MAX_MATCHES matches, the newest ones, are ranked;
+    ``truncated`` tells the caller that older matches were left out and to
+    narrow the query or the range.
+    """
+    params = {
+        "q": q, "since": since, "until": until, "limit": limit, "offset": offset,
+        "max_matches": SEARCH_MAX_MATCHES + 1,
+    }
+    where_homegroup = ""
+    if homegroup:
+        where_homegroup = "AND v.user_id = ANY(ARRAY(SELECT id FROM users WHERE homegroup = :homegroup))"
+        params["homegroup"] = homegroup
+    rows = (await db.execute(text(_SEARCH_VISITS.format(homegroup=where_homegroup)), params)).all()
+    if rows:
+        total = rows[0].total
+    elif offset:
+        # Past the last page: the window count above had no row to ride on
+        total = await db.scalar(text(_COUNT_VISITS.format(homegroup=where_homegroup)), params)
+    else:
+        total = 0
+    truncated = total > SEARCH_MAX_MATCHES
+    return {
+        "total": min(total, SEARCH_MAX_MATCHES),
+        "truncated": truncated,
+        "items": [
+            {
+                "username": r.username,
+                "homegroup": r.homegroup,
+                "timestamp": r.visit_time.isoformat(),
+                "title": r.title,
+                "url": r.url,
+                "computerName": r.computer_name,
+                "rank": round(r.rank, 6),
+            }
+            for r in rows
+        ],
+    }
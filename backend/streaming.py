@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import os
+import time
+import zlib
+from typing import AsyncIterator, Optional
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore
+
+from .database import AsyncSessionLocal
+from .decoding import ReportDecodeError, decode_user_info, decode_visit
+from .dedup import visit_watermarks
+from .ingest import store_reports
+from .metrics import ingest_commit_seconds
+from .pacing import sync_advisor
+
+# Visits are written (and committed) in chunks of this size, so memory per
+# request is bounded by the chunk rather than the payload.
+STREAM_CHUNK_VISITS = int(os.getenv("STREAM_CHUNK_VISITS", "5000"))
+STREAM_MAX_LINE_BYTES = int(os.getenv("STREAM_MAX_LINE_BYTES", str(1024 * 1024)))
+# Upper bound on decompressed bytes produced from one network chunk at a time.
+_DECOMPRESS_STEP = 256 * 1024
+# zstd input is fed in slices of this size; a slice expanding to more than
+# _ZSTD_MAX_STEP_OUTPUT bytes (a ratio no NDJSON reaches) is rejected as a
+# decompression bomb before the output is buffered.
+_ZSTD_INPUT_STEP = 4096
+_ZSTD_MAX_STEP_OUTPUT = 64 * _DECOMPRESS_STEP
+
+
+class UnsupportedEncoding(ValueError):
+    pass
+
+
+class StreamFormatError(ValueError):
+    def __init__(self, message: str, line: Optional[int] = None):
+        super().__init__(message)
+        self.line = line
+
+
+class BodyEncodingError(StreamFormatError):
+    """The compressed body is invalid, truncated or expands too far."""
+
+
+class _BoundedSink:
+    """Collects a zstd stream_writer's output, refusing more than *limit* bytes between takes."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.parts: list = []
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.size > self.limit:
+            raise BodyEncodingError("zstd body expands beyond the allowed ratio")
+        self.parts.append(data)
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        self.size = 0
+        return data
+
+
+_ZSTD_MAGIC = 0xFD2FB528
+_ZSTD_SKIPPABLE_MAGIC = 0x184D2A50  # low 4 bits are free
+
+
+class _ZstdFrames:
+    """Follows the frame and block headers of a zstd body (RFC 8878).
+
+    The stream_writer used for decoding does not report where a frame
+    ends, so this tells a complete body from one cut off mid-frame. Only
+    headers are read; block contents are skipped.
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self._buf = b""
+        self._need = 4
+        self._state = "magic"
+        self._skip = 0
+        self._checksum = False
+
+    @property
+    def complete(self) -> bool:
+        return self.frames > 0 and self._state == "magic" and not self._buf and not self._skip
+
+    def feed(self, data: bytes):
+        pos = 0
+        while pos < len(data):
+            if self._skip:
+                step = min(self._skip, len(data) - pos)
+                self._skip -= step
+                pos += step
+                continue
+            step = min(self._need - len(self._buf), len(data) - pos)
+            self._buf += data[pos:pos + step]
+            pos += step
+            if len(self._buf) == self._need:
+                header, self._buf = self._buf, b""
+                self._parse(int.from_bytes(header, "little"))
+
+    def _expect(self, state: str, need: int, skip: int = 0):
+        self._state, self._need, self._skip = state, need, skip
+
+    def _parse(self, value: int):
+        if self._state == "magic":
+            if value == _ZSTD_MAGIC:
+                self._expect("descriptor", 1)
+            elif (value & ~0xF) == _ZSTD_SKIPPABLE_MAGIC:
+                self._expect("skippable", 4)
+            else:
+                raise BodyEncodingError("Invalid zstd body: unknown frame magic")
+        elif self._state == "skippable":
+            self._expect("magic", 4, skip=value)
+        elif self._state == "descriptor":
+            single_segment = value >> 5 & 1
+            content_size = (single_segment, 2, 4, 8)[value >> 6]
+            self._checksum = bool(value >> 2 & 1)
+            window = 0 if single_segment else 1
+            self._expect("block", 3, skip=window + (0, 1, 2, 4)[value & 3] + content_size)
+        else:
+            block_type, size = value >> 1 & 3, value >> 3
+            if block_type == 3:
+                raise BodyEncodingError("Invalid zstd body: reserved block type")
+            skip = 1 if block_type == 1 else size  # an RLE block holds one byte
+            if value & 1:
+                self.frames += 1
+                self._expect("magic", 4, skip=skip + (4 if self._checksum else 0))
+            else:
+                self._expect("block", 3, skip=skip)
+
+
+async def decompress_stream(chunks: AsyncIterator[bytes], encoding: str) -> AsyncIterator[bytes]:
+    """Incrementally decode a request body sent with Content-Encoding *encoding*."""
+    encoding = (encoding or "identity").strip().lower()
+    if encoding == "identity":
+        async for chunk in chunks:
+            yield chunk
+    elif encoding == "gzip":
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            async for chunk in chunks:
+                data = chunk
+                while data:
+                    yield decoder.decompress(data, _DECOMPRESS_STEP)
+                    data = decoder.unconsumed_tail
+            yield decoder.flush()
+        except zlib.error as exc:
+            raise BodyEncodingError(f"Invalid gzip body: {exc}")
+        if not decoder.eof:
+            raise BodyEncodingError("Truncated gzip body")
+    elif encoding == "zstd":
+        if zstandard is None:
+            raise UnsupportedEncoding("zstd support requires the zstandard package")
+        sink = _BoundedSink(_ZSTD_MAX_STEP_OUTPUT)
+        decoder = zstandard.ZstdDecompressor().stream_writer(sink, write_size=_DECOMPRESS_STEP)
+        frames = _ZstdFrames()
+        try:
+            async for chunk in chunks:
+                frames.feed(chunk)
+                for start in range(0, len(chunk), _ZSTD_INPUT_STEP):
+                    decoder.write(chunk[start:start + _ZSTD_INPUT_STEP])
+                    yield sink.take()
+        except zstandard.ZstdError as exc:
+            raise BodyEncodingError(f"Invalid zstd body: {exc}")
+        if not frames.complete:
+            raise BodyEncodingError("Truncated zstd body")
+    else:
+        raise UnsupportedEncoding(f"Unsupported Content-Encoding: {encoding}")
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Split a byte stream into non-blank lines without buffering the whole body."""
+    buffer = b""
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        buffer += chunk
+        lines = buffer.split(b"\n")
+        buffer = lines.pop()
+        if len(buffer) > STREAM_MAX_LINE_BYTES:
+            raise StreamFormatError(f"Line exceeds {STREAM_MAX_LINE_BYTES} bytes")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+
+class _Chunk:
+    """A slice of a streamed report, shaped like ReportIn for store_reports."""
+
+    __slots__ = ("UserInfo", "Visits")
+
+    def __init__(self, info, visits: list):
+        self.UserInfo = info
+        self.Visits = visits
+
+
+class _StreamWriter:
+    """Writes one streamed report in committed chunks.
+
+    Chunks are filtered against the watermarks as they were before the
+    stream started; the new watermarks are only published once the last
+    chunk is committed, since a stream need not be in time order.
+    """
+
+    def __init__(self, info, session_factory):
+        self.info = info
+        self.session_factory = session_factory
+        self.received = 0
+        self.inserted = 0
+        self.latest: dict = {}
+
+    async def write(self, visits: list):
+        # A session per chunk keeps slow uploads from pinning a connection
+        # while the next chunk is still on the wire.
+        async with self.session_factory() as db:
+            started = time.perf_counter()
+            stored = await store_reports(db, [_Chunk(self.info, visits)])
+            await db.commit()
+            elapsed = time.perf_counter() - started
+            sync_advisor.latency.observe(elapsed)
+            ingest_commit_seconds.observe(elapsed)
+        stored.publish_caches()
+        visit_watermarks.latest(stored.records, into=self.latest)
+        self.received += len(visits)
+        self.inserted += stored.inserted
+
+    def finish(self):
+        visit_watermarks.merge(self.latest)
+
+
+async def ingest_ndjson(
+    chunks: AsyncIterator[bytes],
+    encoding: str = "identity",
+    session_factory=AsyncSessionLocal,
+) -> dict:
+    """Ingest an NDJSON report: a UserInfo header line followed by one visit per line.
+
+    Chunks are committed as they fill up. A malformed line aborts the stream,
+    but chunks already committed are kept; re-sending the report is safe
+    because duplicates are skipped.
+    """
+    writer: Optional[_StreamWriter] = None
+    pending: list = []
+    line_no = 0
+    async for line in iter_lines(decompress_stream(chunks, encoding)):
+        line_no += 1
+        try:
+            if writer is None:
+                writer = _StreamWriter(decode_user_info(line), session_factory)
+                continue
+            pending.append(decode_visit(line))
+        except ReportDecodeError as exc:
+            raise StreamFormatError(str(exc), line=line_no)
+        if len(pending) >= STREAM_CHUNK_VISITS:
+            await writer.write(pending)
+            pending = []
+
+    if writer is None:
+        raise StreamFormatError("Missing UserInfo header line", line=1)
+    if pending:
+        await writer.write(pending)
+    writer.finish()
+    if writer.received == 0:
+        raise StreamFormatError("Visits list cannot be empty")
+    return {"visits": writer.received, "inserted": writer.inserted}
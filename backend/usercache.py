@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, Optional, Sequence, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .crud import upsert_users
+from .database import AsyncSessionLocal
+
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "50000"))
+# Entries older than this are upserted again, so rows changed or deleted
+# outside ingest are picked up.
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "600"))
+# How often coalesced last_seen_at bumps for cached users are written.
+LAST_SEEN_FLUSH_SECONDS = float(os.getenv("LAST_SEEN_FLUSH_SECONDS", "60"))
+
+_FLUSH_LAST_SEEN = text("""
+UPDATE users SET last_seen_at = GREATEST(users.last_seen_at, seen.ts)
+FROM unnest(CAST(:ids AS integer[]), CAST(:ts AS timestamptz[])) AS seen(id, ts)
+WHERE users.id = seen.id
+""")
+
+
+def user_digest(info) -> bytes:
+    """Hash of the profile columns upsert_users writes for *info*."""
+    fields = (info.Username, info.DisplayName, info.FirstName, info.LastName, info.Department, info.Email)
+    return hashlib.blake2b(repr(fields).encode(), digest_size=16).digest()
+
+
+class UserCache:
+    """Bounded LRU of username -> (user_id, profile digest).
+
+    Users whose profile is unchanged skip the upsert entirely; their
+    last_seen_at is coalesced in memory and written by ``flush_last_seen``.
+    Entries are only added after the transaction that upserted them has
+    committed, and expire after *ttl* seconds, so a row changed or deleted
+    by something other than ingest is only trusted for that long.
+    """
+
+    def __init__(self, max_entries: int = USER_CACHE_MAX_ENTRIES, ttl: float = USER_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # username -> (user_id, profile digest, time cached)
+        self._entries: "OrderedDict[str, Tuple[int, bytes, float]]" = OrderedDict()
+        self._last_seen: Dict[int, datetime] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.last_seen_flushes = 0
+        self.last_seen_rows = 0
+
+    def lookup(self, username: str, digest: bytes) -> Optional[int]:
+        entry = self._entries.get(username)
+        if entry is not None and time.monotonic() - entry[2] > self.ttl:
+            del self._entries[username]
+            self.expired += 1
+            entry = None
+        if entry is None or entry[1] != digest:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(username)
+        self.hits += 1
+        return entry[0]
+
+    def remember(self, entries: Dict[str, Tuple[int, bytes]]):
+        now = time.monotonic()
+        for username, (user_id, digest) in entries.items():
+            self._entries[username] = (user_id, digest, now)
+            self._entries.move_to_end(username)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def forget(self, usernames: Sequence[str]):
+        """Drop *usernames*, e.g. after a write referencing their cached ids failed."""
+        for username in usernames:
+            self._entries.pop(username, None)
+
+    def touch(self, user_ids: Sequence[int]):
+        now = datetime.now(timezone.utc)
+        for user_id in user_ids:
+            self._last_seen[user_id] = now
+
+    async def flush_last_seen(self, session_factory=AsyncSessionLocal):
+        if not self._last_seen:
+            return
+        pending, self._last_seen = self._last_seen, {}
+        try:
+            async with session_factory() as db:
+                await db.execute(_FLUSH_LAST_SEEN, {"ids": list(pending), "ts": list(pending.values())})
+                await db.commit()
+        except Exception:
+            # Keep the bumps for the next attempt, without moving newer ones back
+            for user_id, ts in pending.items():
+                self._last_seen.setdefault(user_id, ts)
+            raise
+        self.last_seen_flushes += 1
+        self.last_seen_rows += len(pending)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(LAST_SEEN_FLUSH_SECONDS)
+            try:
+                await self.flush_last_seen()
+            except Exception as e:
+                print(f"⚠️  last_seen_at flush failed: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush_last_seen()
+
+    def snapshot(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "pending_last_seen": len(self._last_seen),
+            "last_seen_flushes": self.last_seen_flushes,
+            "last_seen_rows": self.last_seen_rows,
+        }
+
+
+user_cache = UserCache()
+
+
+async def resolve_users(db: AsyncSession, infos: Sequence) -> Tuple[Dict[str, int], Dict[str, Tuple[int, bytes]]]:
+    """Map usernames to ids, upserting only users that are new or changed.
+
+    Returns the username -> id map and the cache entries to ``remember``
+    once the caller's transaction commits.
+    """
+    latest = {info.Username: info for info in infos}
+    user_ids: Dict[str, int] = {}
+    changed = {}
+    for username, info in latest.items():
+        digest = user_digest(info)
+        user_id = user_cache.lookup(username, digest)
+        if user_id is None:
+            changed[username] = digest
+        else:
+            user_ids[username] = user_id
+    entries: Dict[str, Tuple[int, bytes]] = {}
+    if changed:
+        upserted = await upsert_users(db, [latest[u] for u in changed])
+        user_ids.update(upserted)
+        entries = {u: (upserted[u], changed[u]) for u in upserted}
+    return user_ids, entries
@@ -1,3 +1,5 @@
+from datetime import datetime
+
 from passlib.context import CryptContext
 from typing import cast, Any
 
@@ -105,4 +107,26 @@ def decrypt_secure_config(encrypted_config: dict) -> dict:
         return json.loads(config_json)
         
     except Exception as e:
-        raise RuntimeError(f"Failed to decrypt secure config: {str(e)}") from e
\ No newline at end of file
+        raise RuntimeError(f"Failed to decrypt secure config: {str(e)}") from e
+
+
+# ---------------------------------------------------------------------------
+# Keyset Pagination Cursors
+# ---------------------------------------------------------------------------
+
+def encode_visit_cursor(visit_time: datetime, visit_id: int) -> str:
+    """Opaque cursor for the (visit_time, id) position of the last row of a page."""
+    return base64.urlsafe_b64encode(f"{visit_time.isoformat()}|{visit_id}".encode()).decode().rstrip("=")
+
+
+def decode_visit_cursor(cursor: str):
+    """Inverse of encode_visit_cursor. Raises ValueError for malformed cursors."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        visit_time, visit_id = raw.split("|")
+        parsed = datetime.fromisoformat(visit_time)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+    if parsed.tzinfo is None:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return parsed, int(visit_id)
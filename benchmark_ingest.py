@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Ingest Benchmark for Browser Reporter
+  write:  visit write throughput (rows/sec) of the COPY and executemany paths
+          against the database configured by DATABASE_URL (writes are rolled back)
+  decode: CPU cost of turning a /api/reports/data body into insert-ready tuples
+          with the Pydantic and fast (msgspec) decoders; no database needed
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from backend.database import engine, AsyncSessionLocal
+from backend.migrations import migrate
+from backend import decoding
+from backend.crud import upsert_user, visit_records
+from backend.ingest import write_visits
+from backend.schemas import ReportIn, UserInfoIn, VisitIn
+
+
+def make_visits(count: int, offset: int = 0) -> list:
+    now_ms = int(time.time() * 1000) - offset * count * 1000
+    return [
+        VisitIn(
+            Url=f"https://example{random.randint(1, 500)}.com/page/{i}",
+            Title=f"Example page {i}",
+            VisitTime=now_ms - i * 1000,
+            ComputerName="BENCH-PC-01",
+        )
+        for i in range(count)
+    ]
+
+
+async def run_path(path: str, rows_per_report: int, reports: int) -> float:
+    """Write *reports* reports through *path* and return rows/sec."""
+    async with AsyncSessionLocal() as db:
+        user_id = await upsert_user(db, UserInfoIn(Username="benchmark.user", Department="BENCH"))
+        # Distinct visit times per report so no row is skipped as a duplicate
+        batches = [visit_records(user_id, make_visits(rows_per_report, i)) for i in range(reports)]
+        started = time.perf_counter()
+        for records in batches:
+            await write_visits(db, records, path=path)
+        elapsed = time.perf_counter() - started
+        await db.rollback()
+    return rows_per_report * reports / elapsed
+
+
+async def write_benchmark(sizes: list, reports: int):
+    await migrate()
+
+    print("🚀 Browser Reporter Ingest Benchmark (write)")
+    print("=" * 50)
+    print(f"{'visits/report':>14} {'executemany':>14} {'copy':>14} {'speedup':>8}")
+    for size in sizes:
+        many = await run_path("executemany", size, reports)
+        copy = await run_path("copy", size, reports)
+        print(f"{size:>14} {many:>12,.0f}/s {copy:>12,.0f}/s {copy / many:>7.1f}x")
+    await engine.dispose()
+
+
+def make_body(visits: int) -> bytes:
+    info = {"Username": "benchmark.user", "DisplayName": "Benchmark User", "Department": "BENCH"}
+    return json.dumps({
+        "Username": info["Username"],
+        "UserInfo": info,
+        "Visits": [v.model_dump() for v in make_visits(visits)],
+    }).encode()
+
+
+def time_decoder(decode, body: bytes, min_seconds: float = 0.5) -> float:
+    """Return seconds per body for *decode* (body -> insert-ready tuples)."""
+    runs = 0
+    started = time.perf_counter()
+    while True:
+        report = decode(body)
+        visit_records(1, report.Visits)
+        runs += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds:
+            return elapsed / runs
+
+
+def decode_benchmark(sizes: list):
+    def fastapi_default(body):
+        # What FastAPI did for `report: ReportIn`: json.loads, then validate
+        return ReportIn.model_validate(json.loads(body))
+
+    def fast(body):
+        return decoding.decode_report(body)
+
+    if not decoding.fast_decoder_enabled():
+        print("⚠️  msgspec missing or INGEST_DECODER != fast; the fast column uses Pydantic")
+
+    print("🚀 Browser Reporter Ingest Benchmark (decode)")
+    print("=" * 50)
+    print(f"{'visits/report':>14} {'pydantic':>14} {'fast':>14} {'speedup':>8}")
+    for size in sizes:
+        body = make_body(size)
+        slow_s = time_decoder(fastapi_default, body)
+        fast_s = time_decoder(fast, body)
+        print(f"{size:>14} {slow_s * 1000:>11.3f}ms {fast_s * 1000:>11.3f}ms {slow_s / fast_s:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="mode", required=True)
+    write = sub.add_parser("write", help="COPY vs executemany rows/sec")
+    write.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    write.add_argument("--reports", type=int, default=20, help="reports written per size and path")
+    decode = sub.add_parser("decode", help="Pydantic vs fast decoder time per report")
+    decode.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 50000])
+    args = parser.parse_args()
+    if args.mode == "write":
+        asyncio.run(write_benchmark(args.sizes, args.reports))
+    else:
+        decode_benchmark(args.sizes)
@@ -0,0 +1,85 @@
+import pytest
+
+from backend import admission as admission_module
+from backend.admission import AdmissionController, BucketSet, TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A controllable time.monotonic for the admission module."""
+    now = [1000.0]
+    monkeypatch.setattr(admission_module.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_bucket_refills_at_rate_up_to_burst():
+    bucket = TokenBucket(burst=5, now=0)
+    bucket.tokens = 0
+    bucket.refill(rate=2, burst=5, now=1)
+    assert bucket.tokens == 2
+    bucket.refill(rate=2, burst=5, now=100)
+    assert bucket.tokens == 5
+
+
+def test_bucket_set_evicts_least_recently_used():
+    buckets = BucketSet(rate=1, burst=1, max_entries=2)
+    buckets.get("a", 0)
+    buckets.get("b", 0)
+    buckets.get("a", 0)
+    buckets.get("c", 0)
+    assert list(buckets._buckets) == ["a", "c"]
+
+
+def test_wait_time_until_next_token():
+    buckets = BucketSet(rate=4, burst=1)
+    bucket = buckets.get("a", 0)
+    assert buckets.wait_time(bucket) == 0
+    bucket.tokens = 0.5
+    assert buckets.wait_time(bucket) == 0.125
+
+
+def test_key_bucket_rejects_beyond_burst(clock, monkeypatch):
+    monkeypatch.setattr(admission_module, "ADMISSION_KEY_RATE", 1)
+    monkeypatch.setattr(admission_module, "ADMISSION_KEY_BURST", 3)
+    controller = AdmissionController()
+    assert [controller.admit("key", None) for _ in range(3)] == [None] * 3
+    assert controller.admit("key", None) == 1
+    clock[0] += 1
+    assert controller.admit("key", None) is None
+    assert controller.keys.rejected == 1
+
+
+def test_collectors_share_no_bucket_without_a_computer_name(clock, monkeypatch):
+    monkeypatch.setattr(admission_module, "ADMISSION_CLIENT_ENABLED", True)
+    monkeypatch.setattr(admission_module, "ADMISSION_CLIENT_BURST", 1)
+    controller = AdmissionController()
+    assert [controller.admit("key", None) for _ in range(5)] == [None] * 5
+    assert controller.clients._buckets == {}
+
+
+def test_throttled_collector_does_not_spend_key_tokens(clock, monkeypatch):
+    monkeypatch.setattr(admission_module, "ADMISSION_CLIENT_ENABLED", True)
+    monkeypatch.setattr(admission_module, "ADMISSION_CLIENT_RATE", 1)
+    monkeypatch.setattr(admission_module, "ADMISSION_CLIENT_BURST", 1)
+    controller = AdmissionController()
+    assert controller.admit("key", "pc-1") is None
+    key_tokens = controller.keys._buckets[admission_module.key_label("key")].tokens
+    assert controller.admit("key", "pc-1") == 1
+    assert controller.admit("key", "pc-2") is None
+    assert controller.keys._buckets[admission_module.key_label("key")].tokens == key_tokens - 1
+    assert controller.clients.rejected == 1
+
+
+def test_collector_buckets_on_by_default(clock):
+    controller = AdmissionController()
+    results = [controller.admit("key", "pc-1") for _ in range(50)]
+    assert results[:20] == [None] * 20
+    assert all(r is not None for r in results[20:])
+    assert controller.admit("key", "pc-2") is None
+
+
+def test_collector_buckets_can_be_disabled(clock, monkeypatch):
+    monkeypatch.setattr(admission_module, "ADMISSION_CLIENT_ENABLED", False)
+    controller = AdmissionController()
+    assert [controller.admit("key", "pc-1") for _ in range(50)] == [None] * 50
+    assert controller.clients._buckets == {}
@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from backend import batching, ingest
+from backend.batching import IngestBatcher, IngestStopped
+from backend.schemas import ReportIn
+
+
+def make_report(computer: str) -> ReportIn:
+    return ReportIn.model_validate({
+        "Username": "alice",
+        "UserInfo": {"Username": "alice"},
+        "Visits": [{"Url": "https://example.com", "Title": "Example", "VisitTime": 1700000000000, "ComputerName": computer}],
+    })
+
+
+@pytest.fixture
+def written(monkeypatch):
+    """Reports the batcher wrote, with the database write replaced by a short sleep."""
+    reports = []
+
+    async def fake_ingest(batch, session_factory):
+        await asyncio.sleep(0.05)
+        reports.extend(batch)
+        return sum(len(r.Visits) for r in batch), [None] * len(batch)
+
+    monkeypatch.setattr(batching, "ingest_reports_isolated", fake_ingest)
+    return reports
+
+
+def test_stop_writes_every_queued_report(written):
+    async def scenario():
+        batcher = IngestBatcher(session_factory=None)
+        batcher.start()
+        submits = [asyncio.create_task(batcher.submit(make_report(f"pc-{i}"))) for i in range(50)]
+        await asyncio.sleep(0)
+        await batcher.stop()
+        return await asyncio.gather(*submits, return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert results == [None] * 50
+    assert len(written) == 50
+
+
+def test_submit_after_stop_is_rejected(written):
+    async def scenario():
+        batcher = IngestBatcher(session_factory=None)
+        batcher.start()
+        batcher._stopping = True
+        with pytest.raises(IngestStopped):
+            await batcher.submit(make_report("pc"))
+        batcher._stopping = False
+        await batcher.stop()
+
+    asyncio.run(scenario())
+
+
+def test_stop_timeout_fails_unwritten_reports(monkeypatch):
+    async def hang(batch, session_factory):
+        await asyncio.sleep(60)
+
+    monkeypatch.setattr(batching, "ingest_reports_isolated", hang)
+    monkeypatch.setattr(batching, "INGEST_BATCH_STOP_TIMEOUT_SECONDS", 0.1)
+
+    async def scenario():
+        batcher = IngestBatcher(session_factory=None)
+        batcher.start()
+        submits = [asyncio.create_task(batcher.submit(make_report(f"pc-{i}"))) for i in range(5)]
+        await asyncio.sleep(0.05)
+        await batcher.stop()
+        return await asyncio.wait_for(asyncio.gather(*submits, return_exceptions=True), 1)
+
+    results = asyncio.run(scenario())
+    assert len(results) == 5
+    assert all(isinstance(r, IngestStopped) for r in results)
+
+
+def test_isolated_ingest_fails_fast_when_the_database_is_down(monkeypatch):
+    attempts = []
+
+    async def refuse(db, reports):
+        attempts.append(len(reports))
+        raise ConnectionRefusedError("Connect call failed")
+
+    class Session:
+        async def __aenter__(self):
+            return None
+
+        async def __aexit__(self, *exc):
+            return False
+
+    monkeypatch.setattr(ingest, "ingest_reports", refuse)
+    visits, errors = asyncio.run(ingest.ingest_reports_isolated([make_report(f"pc-{i}") for i in range(4)], Session))
+    assert visits == 0
+    assert attempts == [4]
+    assert len(errors) == 4 and all(isinstance(e, ConnectionRefusedError) for e in errors)
@@ -0,0 +1,56 @@
+import os
+import time
+
+from backend import metrics
+from backend.metrics import MetricsWriter, Registry
+
+
+def make_registry():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests", ("route",))
+    latency = registry.histogram("latency_seconds", "Latency", (0.1, 1.0))
+    registry.gauge("queue_depth", "Queue depth", lambda: {(): 7})
+    return registry, requests, latency
+
+
+def test_render_adds_up_states():
+    registry, requests, latency = make_registry()
+    requests.inc("/a", amount=2)
+    latency.observe(0.5)
+    text = registry.render([registry.state(), registry.state()])
+    assert 'browser_reporter_requests_total{route="/a"} 4' in text
+    assert 'browser_reporter_latency_seconds_bucket{le="1"} 2' in text
+    assert "browser_reporter_queue_depth 14" in text
+
+
+def test_retire_keeps_counters_and_histograms_but_not_gauges():
+    registry, requests, latency = make_registry()
+    requests.inc("/a")
+    latency.observe(0.05)
+    retired = registry.retire([registry.state(), registry.state()])
+    assert retired["browser_reporter_requests_total"] == [[["/a"], 2]]
+    assert retired["browser_reporter_latency_seconds"] == [[[], [2, 0, 0, 0.1]]]
+    assert "browser_reporter_queue_depth" not in retired
+
+
+def test_exited_workers_keep_their_counts(tmp_path, monkeypatch):
+    registry, requests, _ = make_registry()
+    monkeypatch.setattr(metrics, "registry", registry)
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+    requests.inc("/a", amount=3)
+
+    stopped = MetricsWriter()
+    stopped.path = str(tmp_path / "worker-1.json")
+    stopped.retire(stopped.path, registry.state())
+
+    crashed = str(tmp_path / "worker-2.json")
+    metrics._write(crashed, registry.state())
+    old = time.time() - 3600
+    os.utime(crashed, (old, old))
+
+    scraper = MetricsWriter()
+    scraper.path = str(tmp_path / "worker-3.json")
+    text = registry.render([registry.state(), *scraper.other_states()])
+    assert 'browser_reporter_requests_total{route="/a"} 9' in text
+    assert "browser_reporter_queue_depth 7" in text
+    assert not os.path.exists(crashed)
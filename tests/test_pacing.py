@@ -0,0 +1,44 @@
+import random
+
+import pytest
+
+from backend import pacing
+from backend.pacing import SyncAdvisor
+from simulate_sync import MIN_THROUGHPUT, simulate
+
+
+def test_delay_is_the_base_interval_on_an_idle_server(monkeypatch):
+    monkeypatch.setattr(pacing, "SYNC_JITTER", 0)
+    assert SyncAdvisor(base_seconds=300).next_sync_seconds(0, 0.01) == 300
+
+
+def test_delay_backs_off_at_most_sync_max_backoff(monkeypatch):
+    monkeypatch.setattr(pacing, "SYNC_JITTER", 0)
+    advisor = SyncAdvisor(base_seconds=300)
+    assert advisor.next_sync_seconds(pacing.SYNC_TARGET_QUEUE_REPORTS * 3 // 2) == 450
+    assert advisor.next_sync_seconds(pacing.SYNC_TARGET_QUEUE_REPORTS * 100) == 300 * pacing.SYNC_MAX_BACKOFF
+
+
+def test_jitter_spreads_delays():
+    advisor = SyncAdvisor(base_seconds=300, rng=random.Random(1))
+    delays = {advisor.next_sync_seconds(0) for _ in range(50)}
+    assert len(delays) > 10
+    assert min(delays) >= 300 * (1 - pacing.SYNC_JITTER) and max(delays) <= 300 * (1 + pacing.SYNC_JITTER)
+
+
+@pytest.fixture(scope="module")
+def fleet():
+    """The simulate_sync.py defaults: 3000 collectors logging in within a minute, 15 reports/sec capacity."""
+    return {mode: simulate(mode, collectors=3000, capacity=15, minutes=60, login_window=60, seed=1)
+            for mode in ("fixed", "advised")}
+
+
+def test_advised_schedule_flattens_the_peak(fleet):
+    fixed, advised = fleet["fixed"], fleet["advised"]
+    assert advised["peak_rps"] <= fixed["peak_rps"] / 2
+    assert advised["max_queue"] < fixed["max_queue"] / 10
+
+
+def test_advised_schedule_keeps_the_sync_rate(fleet):
+    fixed, advised = fleet["fixed"], fleet["advised"]
+    assert advised["settled_per_minute"] >= MIN_THROUGHPUT * fixed["settled_per_minute"]
@@ -0,0 +1,68 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from backend import main
+from backend.archive import ArchiveWriter, VisitArchive
+
+NOW = datetime(2026, 6, 1, tzinfo=timezone.utc)
+
+
+def make_visit(visit_id: int, days_ago: int, **extra) -> SimpleNamespace:
+    return SimpleNamespace(
+        id=visit_id, visit_time=NOW - timedelta(days=days_ago), title=f"Page {visit_id}",
+        url=f"https://example.com/{visit_id}", computer_name="pc-1", **extra,
+    )
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def scalar_one_or_none(self):
+        return self.rows[0]
+
+    def all(self):
+        return self.rows
+
+
+class FakeSession:
+    """Answers the user id lookup, then the visits query, with fixed rows."""
+
+    def __init__(self, visits):
+        self.results = [FakeResult([1]), FakeResult(visits)]
+
+    async def execute(self, query):
+        return self.results.pop(0)
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    """An archive holding visits 1-3 of alice, months before the live ones."""
+    writer = ArchiveWriter(str(tmp_path), "test")
+    for visit_id in (1, 2, 3):
+        writer.write("2025-12", make_visit(visit_id, 200 - visit_id, username="alice", homegroup="", domain="example.com"))
+    archive = VisitArchive(str(tmp_path))
+    archive.add(writer.finish())
+    monkeypatch.setattr(main, "visit_archive", archive)
+    return archive
+
+
+def page(limit, **params):
+    kwargs = dict(days=None, cursor=None, q=None, url=None, title=None, computer=None, include_archived=True)
+    kwargs.update(params)
+    live = [make_visit(5, 1), make_visit(4, 2)]
+    return asyncio.run(main._reports_user_page(FakeSession(live), "alice", limit=limit, **kwargs))
+
+
+def test_unpaged_request_lists_live_and_archived_visits(archive):
+    result = page(None)
+    assert [v["url"].rsplit("/", 1)[1] for v in result] == ["5", "4", "3", "2", "1"]
+
+
+def test_paged_request_continues_into_the_archive(archive):
+    first = page(3)
+    assert [v["url"].rsplit("/", 1)[1] for v in first["items"]] == ["5", "4", "3"]
+    assert first["nextCursor"] is not None
@@ -0,0 +1,53 @@
+import asyncio
+import gzip
+
+import pytest
+import zstandard
+
+from backend.streaming import BodyEncodingError, _ZstdFrames, decompress_stream
+
+NDJSON = b"".join(b'{"Url": "https://example.com/%d", "VisitTime": %d}\n' % (i, i) for i in range(5000))
+
+
+def decode(body: bytes, encoding: str, chunk: int = 1000) -> bytes:
+    async def chunks():
+        for start in range(0, len(body), chunk):
+            yield body[start:start + chunk]
+
+    async def collect():
+        return b"".join([part async for part in decompress_stream(chunks(), encoding)])
+
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize("encoding, compress", [
+    ("gzip", gzip.compress),
+    ("zstd", zstandard.ZstdCompressor().compress),
+    ("zstd", zstandard.ZstdCompressor(write_checksum=True, write_content_size=False).compress),
+])
+def test_complete_body_decodes(encoding, compress):
+    assert decode(compress(NDJSON), encoding) == NDJSON
+
+
+@pytest.mark.parametrize("encoding, compress", [
+    ("gzip", gzip.compress),
+    ("zstd", zstandard.ZstdCompressor().compress),
+])
+def test_truncated_body_is_rejected(encoding, compress):
+    body = compress(NDJSON)
+    for cut in (len(body) // 2, len(body) - 1):
+        with pytest.raises(BodyEncodingError, match="Truncated"):
+            decode(body[:cut], encoding)
+
+
+def test_zstd_frames_follow_concatenated_and_skippable_frames():
+    compressor = zstandard.ZstdCompressor()
+    skippable = (0x184D2A53).to_bytes(4, "little") + (3).to_bytes(4, "little") + b"abc"
+    body = compressor.compress(NDJSON[:1000]) + skippable + compressor.compress(NDJSON[1000:])
+    assert decode(body, "zstd", chunk=7) == NDJSON
+
+    frames = _ZstdFrames()
+    frames.feed(body[:-1])
+    assert not frames.complete
+    frames.feed(body[-1:])
+    assert frames.complete and frames.frames == 2
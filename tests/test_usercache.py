@@ -0,0 +1,21 @@
+from backend import usercache
+from backend.usercache import UserCache
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(usercache.time, "monotonic", lambda: now[0])
+    cache = UserCache(max_entries=10, ttl=60)
+    cache.remember({"alice": (1, b"digest")})
+    assert cache.lookup("alice", b"digest") == 1
+    now[0] += 61
+    assert cache.lookup("alice", b"digest") is None
+    assert cache.expired == 1
+
+
+def test_changed_profile_and_forgotten_users_miss():
+    cache = UserCache(max_entries=10, ttl=60)
+    cache.remember({"alice": (1, b"digest"), "bob": (2, b"digest")})
+    assert cache.lookup("alice", b"other") is None
+    cache.forget(["bob"])
+    assert cache.lookup("bob", b"digest") is None